@@ -0,0 +1,400 @@
+"""
+Load test of the API through its real routes and middleware.  Seeds a large
+group, a long message history, a user with many friends and a crowd of
+searchable usernames, then runs each scenario and reports latency
+percentiles, requests per second and queries per request as JSON:
+
+    python -m benchmarks.bench_api --output run.json
+    python -m benchmarks.bench_api --baseline run.json
+
+The run fails, exiting 1, when any request fails.  With --baseline it also
+fails when a scenario runs more queries per request than the baseline's,
+or its p50 or p95 is both more than --tolerance and more than --min-delta
+milliseconds slower.  A scenario that looks slower is run again, up to
+--retries times, keeping its best percentiles, so one noisy run doesn't
+fail it.  The same seed gives the same data, so runs on one machine
+compare.
+
+By default requests go through the test client in this process, against a
+throwaway database.  With --url they go over HTTP to a server started
+from this checkout, for example gunicorn with the uvicorn worker, after
+seeding the database that server uses.  Point its settings at a scratch
+database first.  Queries per request are only counted in process, as
+they don't depend on how the requests arrive.
+"""
+from benchmarks.common import setup_django
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import io
+import json
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+import http.client
+
+Request = namedtuple('Request', ['method', 'path', 'body', 'content_type'])
+
+# Compared against the baseline, a regression when beyond both the
+# tolerance and the minimum delta
+LATENCY_KEYS = ('p50_ms', 'p95_ms')
+
+SEARCH_WORDS = ['reader', 'chapter', 'novel', 'author', 'margin']
+ADJECTIVES = ['quiet', 'bold', 'curious', 'sleepy', 'eager', 'gentle', 'wry', 'brisk']
+
+
+def seed(args):
+    """
+    Deterministic data for the scenarios.  Reuses what an earlier run with
+    the same seed left in the database.
+    """
+    from django.contrib.auth import get_user_model
+    from django.core.management import call_command
+    from rest_framework.authtoken.models import Token
+    from messageServer.models import Conversation, Group, Message
+    import random
+    User = get_user_model()
+
+    name = f"benchmark {args.seed}"
+    group = Group.objects.filter(name=name).first()
+    if group is None:
+        rng = random.Random(args.seed)
+        group = Group.objects.create(name=name)
+        users = User.objects.bulk_create([
+            User(
+                email=f"bench{args.seed}_{i}@example.com",
+                username=f"{rng.choice(ADJECTIVES)}_{rng.choice(SEARCH_WORDS)}_{args.seed}_{i}"
+            )
+            for i in range(args.users)
+        ])
+        group.members.add(*users[:args.members])
+        reader = users[0]
+        reader.friends.add(*users[1:args.friends + 1])
+
+        history = Conversation.objects.create(book_title=f"{name} history", group=group)
+        Conversation.objects.create(book_title=f"{name} burst", group=group)
+        members = users[:args.members]
+        for start in range(0, args.messages, 1000):
+            Message.objects.bulk_create([
+                Message(
+                    sender=members[i % len(members)],
+                    sender_username=members[i % len(members)].username,
+                    conversation=history,
+                    text=f"message {i}: {rng.choice(SEARCH_WORDS)} {rng.choice(ADJECTIVES)} thoughts on chapter {i % 40}"
+                )
+                for i in range(start, min(start + 1000, args.messages))
+            ])
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        call_command('rebuild_conversation_summaries', stdout=io.StringIO())
+
+    reader = User.objects.get(email=f"bench{args.seed}_0@example.com")
+    token, _ = Token.objects.get_or_create(user=reader)
+    conversations = {c.book_title: c for c in Conversation.objects.filter(group=group)}
+    return {
+        'token': token.key,
+        'reader': reader,
+        'group': group,
+        'history': conversations[f"{name} history"],
+        'burst': conversations[f"{name} burst"],
+        'picture': png_bytes(),
+    }
+
+
+def png_bytes():
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('RGB', (512, 512), (200, 120, 40)).save(output, format='PNG')
+    return output.getvalue()
+
+
+def multipart(field, filename, data, content_type):
+    boundary = 'benchmarkboundary'
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    ).encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+"""
+Scenarios.  Each returns the i-th request, given the decoded response to
+the previous request of the same worker, or None for its first.
+"""
+
+def large_group_members(data, i, previous):
+    return Request('GET', f"/groups/{data['group'].id}/get_member_list", None, None)
+
+
+def long_history(data, i, previous):
+    # Pages back through the history, starting again at the newest page
+    # once it runs out
+    query = {'limit': 50}
+    if previous and previous.get('before_cursor'):
+        query['before'] = previous['before_cursor']
+    return Request('GET', f"/messages/{data['history'].id}?{urllib.parse.urlencode(query)}", None, None)
+
+
+def many_friends(data, i, previous):
+    return Request('GET', '/users/get_friends_list', None, None)
+
+
+def typeahead_search(data, i, previous):
+    # A user typing each word one letter at a time
+    word = SEARCH_WORDS[(i // 6) % len(SEARCH_WORDS)]
+    return Request('GET', f"/users/search/{word[:1 + i % 6]}", None, None)
+
+
+def send_burst(data, i, previous):
+    body = json.dumps({
+        'sender': str(data['reader'].id),
+        'sender_username': data['reader'].username,
+        'conversation': str(data['burst'].id),
+        'text': f"burst message {i}",
+    }).encode()
+    return Request('POST', '/messages/send', body, 'application/json')
+
+
+def picture_upload(data, i, previous):
+    body, content_type = multipart('picture', 'picture.png', data['picture'], 'image/png')
+    return Request('POST', '/users/set_picture', body, content_type)
+
+
+SCENARIOS = {
+    'large_group_members': large_group_members,
+    'long_history': long_history,
+    'many_friends': many_friends,
+    'typeahead_search': typeahead_search,
+    'send_burst': send_burst,
+    'picture_upload': picture_upload,
+}
+
+
+class InProcessDriver:
+    """
+    The Django test client, through the full middleware stack, one request
+    at a time
+    """
+    concurrency = 1
+
+    def __init__(self, token):
+        from rest_framework.test import APIClient
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+
+    def send(self, request):
+        response = self.client.generic(
+            request.method, request.path, request.body or b'', request.content_type or 'application/octet-stream'
+        )
+        return response.status_code, response.content
+
+    def queries(self):
+        """
+        Total queries and requests recorded so far
+        """
+        from messageServer import metrics
+        totals = metrics.snapshot()
+        histograms = [value for (name, _), value in totals.items() if name == metrics.QUERIES]
+        return sum(h[-1] for h in histograms), sum(sum(h[:-1]) for h in histograms)
+
+
+class HTTPDriver:
+    """
+    Keep-alive HTTP connections to a running server, one per worker thread
+    """
+
+    def __init__(self, url, token, concurrency):
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.prefix = parsed.path.rstrip('/')
+        self.token = token
+        self.concurrency = concurrency
+        self.local = threading.local()
+
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+        return self.local.connection
+
+    def send(self, request):
+        headers = {'Authorization': f'Token {self.token}'}
+        if request.content_type:
+            headers['Content-Type'] = request.content_type
+        connection = self.connection()
+        try:
+            connection.request(request.method, self.prefix + request.path, body=request.body, headers=headers)
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            return 0, b''
+
+    def queries(self):
+        return None
+
+
+def percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_scenario(driver, scenario, data, requests, warmup):
+    def worker(indexes):
+        timings, errors, previous = [], 0, None
+        for i in indexes:
+            request = scenario(data, i, previous)
+            start = time.perf_counter()
+            status, body = driver.send(request)
+            elapsed = time.perf_counter() - start
+            if i >= 0:
+                timings.append(elapsed * 1000)
+                errors += not 200 <= status < 300
+            try:
+                previous = json.loads(body) if 200 <= status < 300 else None
+            except ValueError:
+                previous = None
+        return timings, errors
+
+    worker(range(-warmup, 0))
+    before = driver.queries()
+    start = time.perf_counter()
+    if driver.concurrency == 1:
+        results = [worker(range(requests))]
+    else:
+        slices = [range(n, requests, driver.concurrency) for n in range(driver.concurrency)]
+        with ThreadPoolExecutor(max_workers=driver.concurrency) as pool:
+            results = list(pool.map(worker, slices))
+    elapsed = time.perf_counter() - start
+    after = driver.queries()
+
+    timings = [timing for worker_timings, _ in results for timing in worker_timings]
+    queries_per_request = None
+    if before is not None and after[1] > before[1]:
+        queries_per_request = round((after[0] - before[0]) / (after[1] - before[1]), 2)
+    return {
+        'requests': len(timings),
+        'errors': sum(errors for _, errors in results),
+        'requests_per_second': round(len(timings) / elapsed, 1),
+        'p50_ms': round(percentile(timings, 0.50), 3),
+        'p95_ms': round(percentile(timings, 0.95), 3),
+        'p99_ms': round(percentile(timings, 0.99), 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+        'queries_per_request': queries_per_request,
+    }
+
+
+def slower(current, previous, tolerance, min_delta_ms):
+    """
+    The percentiles of current beyond both the tolerance and the minimum
+    delta of previous's
+    """
+    return [
+        key for key in LATENCY_KEYS
+        if current[key] > previous[key] * (1 + tolerance) and current[key] - previous[key] > min_delta_ms
+    ]
+
+
+def regressions(result, baseline, tolerance, min_delta_ms):
+    found = []
+    for name, current in result['scenarios'].items():
+        if current['errors']:
+            found.append(f"{name}: {current['errors']} failed request(s)")
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous is None:
+            continue
+        for key in slower(current, previous, tolerance, min_delta_ms):
+            found.append(f"{name}: {key} {current[key]} against {previous[key]}")
+        if (current['queries_per_request'] is not None and previous.get('queries_per_request') is not None
+                and current['queries_per_request'] > previous['queries_per_request']):
+            found.append(
+                f"{name}: queries_per_request {current['queries_per_request']} against {previous['queries_per_request']}"
+            )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='run only these, may be repeated')
+    parser.add_argument('--requests', type=int, default=200, help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--users', type=int, default=3000)
+    parser.add_argument('--members', type=int, default=1000)
+    parser.add_argument('--friends', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--url', help='a running server to load instead of the in-process test client')
+    parser.add_argument('--concurrency', type=int, default=4, help='parallel connections with --url')
+    parser.add_argument('--output', help='write the results here as well as to stdout')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slow down against the baseline')
+    parser.add_argument('--min-delta', type=float, default=5.0,
+                        help='milliseconds a percentile may slow down by whatever the tolerance')
+    parser.add_argument('--retries', type=int, default=2, help='runs again of a scenario slower than the baseline')
+    args = parser.parse_args()
+
+    setup_django(test_database=args.url is None)
+    if args.url is None:
+        from django.test import override_settings
+        import tempfile
+        # Uploaded pictures go to a scratch directory, not media/.  Their
+        # variants are built inline, as the in-memory test database can't
+        # take writes from the picture threads, so picture_upload times
+        # the resizing too.
+        override_settings(
+            MEDIA_ROOT=tempfile.mkdtemp(prefix='bench_media_'), PICTURE_PROCESS_WORKERS=0
+        ).enable()
+
+    data = seed(args)
+    if args.url is None:
+        driver = InProcessDriver(data['token'])
+    else:
+        driver = HTTPDriver(args.url, data['token'], args.concurrency)
+
+    result = {
+        'settings': {
+            key: getattr(args, key) for key in ('requests', 'seed', 'users', 'members', 'friends', 'messages', 'url')
+        },
+        'concurrency': driver.concurrency,
+        'scenarios': {},
+    }
+    for name in args.scenario or SCENARIOS:
+        result['scenarios'][name] = run_scenario(driver, SCENARIOS[name], data, args.requests, args.warmup)
+        print(f"{name}: {json.dumps(result['scenarios'][name])}", file=sys.stderr)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    for _ in range(args.retries):
+        retry = [
+            name for name, current in result['scenarios'].items()
+            if name in baseline.get('scenarios', {})
+            and slower(current, baseline['scenarios'][name], args.tolerance, args.min_delta)
+        ]
+        for name in retry:
+            current = result['scenarios'][name]
+            again = run_scenario(driver, SCENARIOS[name], data, args.requests, args.warmup)
+            print(f"{name} again: {json.dumps(again)}", file=sys.stderr)
+            current['errors'] += again['errors']
+            for key in LATENCY_KEYS:
+                current[key] = min(current[key], again[key])
+
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+
+    found = regressions(result, baseline, args.tolerance, args.min_delta)
+    for regression in found:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    if found:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
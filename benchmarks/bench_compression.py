@@ -0,0 +1,73 @@
+"""
+Bytes saved and CPU spent by each response encoding the server can use, on
+a message history page and a member list rendered the way the API renders
+them.  Encodings whose package isn't installed are skipped.
+"""
+from benchmarks.common import measure, setup_django
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth import get_user_model
+    from messageServer.compression import BrotliCodec, GzipCodec, ZstdCodec, available_codecs
+    from messageServer.models import Conversation, Group, Message
+    from messageServer.renderers import FastJSONRenderer
+    from messageServer.serializers import message_rows, message_values, user_rows, user_values
+    User = get_user_model()
+
+    group = Group.objects.create(name='benchmark group')
+    users = User.objects.bulk_create([
+        User(email=f"user{i}@example.com", username=f"reader_{i}") for i in range(args.users)
+    ])
+    group.members.add(*users)
+    conversation = Conversation.objects.create(book_title='benchmark', group=group)
+    Message.objects.bulk_create([
+        Message(
+            sender=users[i % len(users)],
+            sender_username=users[i % len(users)].username,
+            conversation=conversation,
+            text=f"message number {i}: I thought chapter {i % 30} was the best one so far"
+        )
+        for i in range(args.messages)
+    ])
+
+    renderer = FastJSONRenderer()
+    payloads = [
+        (f"{args.messages} messages", renderer.render({'messages': message_rows(message_values(
+            Message.objects.filter(conversation=conversation).order_by('-created_at', '-id')
+        ))})),
+        (f"{args.users} members", renderer.render({'users': user_rows(user_values(group.members.all()))})),
+    ]
+
+    available = {codec.name for codec in available_codecs()}
+    codecs = [GzipCodec(1), GzipCodec(6), GzipCodec(9)]
+    if 'br' in available:
+        codecs += [BrotliCodec(4), BrotliCodec(11)]
+    if 'zstd' in available:
+        codecs += [ZstdCodec(3), ZstdCodec(19)]
+    skipped = {'br', 'zstd'} - available
+    if skipped:
+        print(f"Skipping {', '.join(sorted(skipped))}, install brotli and zstandard to include them")
+
+    for title, body in payloads:
+        print(f"{title}: {len(body)} bytes")
+        for codec in codecs:
+            compressed = codec.compress(body)
+            median, _ = measure(lambda: codec.compress(body), args.repeat)
+            saved = 100 * (1 - len(compressed) / len(body))
+            throughput = len(body) / 1024 / 1024 / (median / 1000)
+            print(
+                f"  {codec.name:>4} level {codec.level:<2}  {len(compressed):8} bytes  "
+                f"saved {saved:5.1f}%  {median:7.3f} ms  {throughput:7.1f} MB/s"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+ModelSerializer plus the stock JSONRenderer against the values() fast path
+plus FastJSONRenderer, for a page of messages and a member list.  Both paths
+have to render the same bytes.
+"""
+from benchmarks.common import measure, report, setup_django
+import argparse
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth import get_user_model
+    from rest_framework.renderers import JSONRenderer
+    from messageServer.models import Conversation, Group, Message
+    from messageServer.renderers import FastJSONRenderer
+    from messageServer.serializers import (
+        MessageSerializer, UserSerializer, message_rows, message_values, user_rows, user_values
+    )
+    User = get_user_model()
+
+    group = Group.objects.create(name='benchmark group')
+    users = User.objects.bulk_create([
+        User(email=f"user{i}@example.com", username=f"user{i}") for i in range(args.users)
+    ])
+    group.members.add(*users)
+    conversation = Conversation.objects.create(book_title='benchmark', group=group)
+    Message.objects.bulk_create([
+        Message(
+            sender=users[i % len(users)],
+            sender_username=users[i % len(users)].username,
+            conversation=conversation,
+            text=f"message number {i} with a few more words to look like chat"
+        )
+        for i in range(args.messages)
+    ])
+    messages = Message.objects.filter(conversation=conversation).order_by('-created_at', '-id')
+    members = group.members.all()
+
+    def messages_slow():
+        return JSONRenderer().render({'messages': MessageSerializer(messages, many=True).data})
+
+    def messages_fast():
+        return FastJSONRenderer().render({'messages': message_rows(message_values(messages))})
+
+    def members_slow():
+        return JSONRenderer().render({'users': UserSerializer(members, many=True).data})
+
+    def members_fast():
+        return FastJSONRenderer().render({'users': user_rows(user_values(members))})
+
+    assert messages_slow() == messages_fast()
+    assert members_slow() == members_fast()
+
+    report(f"{args.messages} messages", [
+        ('ModelSerializer + JSONRenderer', measure(messages_slow, args.repeat)),
+        ('values() + FastJSONRenderer', measure(messages_fast, args.repeat)),
+    ])
+    report(f"{args.users} members", [
+        ('ModelSerializer + JSONRenderer', measure(members_slow, args.repeat)),
+        ('values() + FastJSONRenderer', measure(members_fast, args.repeat)),
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Shared setup for the benchmarks.  Each one runs against a throwaway test
+database, so it can be run from a checkout without touching db.sqlite3:
+
+    python -m benchmarks.bench_serializers
+"""
+import os
+import statistics
+import time
+
+
+def setup_django(test_database=True):
+    """
+    Without test_database the benchmark uses the database in settings
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chonMessageServer.settings')
+    import django
+    django.setup()
+    if not test_database:
+        return
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def measure(function, repeat=20):
+    """
+    Median and best wall time of function in milliseconds
+    """
+    function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), min(timings)
+
+
+def report(title, results):
+    print(title)
+    width = max(len(name) for name, _ in results)
+    baseline = results[0][1][0]
+    for name, (median, best) in results:
+        print(f"  {name:<{width}}  median {median:8.2f} ms  best {best:8.2f} ms  {baseline / median:5.2f}x")
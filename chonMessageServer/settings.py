@@ -42,6 +42,14 @@ else:
 cred = credentials.Certificate('firebase/service_key.json')
 firebase_admin.initialize_app(cred)
 
+# Push notifications go through the outbox and are sent by the
+# dispatch_notifications command.  Set this to also drain it from a
+# background thread in each web worker right after a message is committed.
+PUSH_DISPATCH_IN_PROCESS = 'PUSH_DISPATCH_IN_PROCESS' in os.environ
+# Sent and failed outbox rows are kept this long for inspection, run
+# manage.py prune_push_outbox daily, see deploy_tools/prune-systemd.
+PUSH_OUTBOX_RETENTION_DAYS = 7
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -64,21 +72,50 @@ AUTHENTICATION_BACKENDS = [
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         #'messageServer.authentication.CustomAuthenticationBackend',
-        'rest_framework.authentication.TokenAuthentication',
+        'messageServer.authentication.SignedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
+    ],
+    # Same output as the stock JSONRenderer, through orjson when installed.
+    # Clients may ask for and send MessagePack instead.
+    'DEFAULT_RENDERER_CLASSES': [
+        'messageServer.renderers.FastJSONRenderer',
+        'messageServer.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'rest_framework.parsers.JSONParser',
+        'messageServer.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
     ]
 }
 
+# Lifetime of signed auth tokens, and how many users and for how long each
+# process keeps in memory to check them without a query
+SIGNED_TOKEN_MAX_AGE_SECONDS = 30 * 24 * 60 * 60
+SIGNED_TOKEN_USER_CACHE_SIZE = 1024
+SIGNED_TOKEN_USER_CACHE_SECONDS = 60
+
 MIDDLEWARE = [
+    'messageServer.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'messageServer.compression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'messageServer.replicas.ReplicaStickinessMiddleware',
+    'messageServer.profiling.ProfilingMiddleware',
 ]
 
+# Responses smaller than this go out uncompressed, and compressed request
+# bodies may inflate to at most COMPRESSION_MAX_REQUEST_BYTES
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSION_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+COMPRESSION_MAX_REQUEST_BYTES = 10 * 1024 * 1024
+
 ROOT_URLCONF = 'chonMessageServer.urls'
 
 TEMPLATES = [
@@ -98,6 +135,27 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'chonMessageServer.wsgi.application'
+ASGI_APPLICATION = 'chonMessageServer.asgi.application'
+
+# Pub/sub used to push live events to websockets.  The in memory layer only
+# reaches sockets in the same process, which is all a single daphne process
+# needs.  Set REDIS_URL (and pip install channels-redis) to fan out across
+# several server processes.
+if 'REDIS_URL' in os.environ:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [os.environ['REDIS_URL']],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
 
 
 # Database
@@ -110,6 +168,57 @@ DATABASES = {
     }
 }
 
+DATABASE_ROUTERS = []
+
+# Shard databases messages are spread over by conversation, as a comma
+# separated list of database names (SQLite files here).  Create each with
+# manage.py migrate --database=messagesN, then move existing messages with
+# manage.py rebalance_message_shards.  Run the test suite without it,
+# test_shards sets up its own shards.
+if 'MESSAGE_SHARDS' in os.environ:
+    MESSAGE_SHARDS = []
+    for number, name in enumerate(os.environ['MESSAGE_SHARDS'].split(','), start=1):
+        alias = f'messages{number}'
+        DATABASES[alias] = {
+            **DATABASES['default'],
+            'NAME': name.strip(),
+        }
+        MESSAGE_SHARDS.append(alias)
+    DATABASE_ROUTERS.append('messageServer.shards.ShardRouter')
+
+# Read replicas for the heavy GET views, as a comma separated list of
+# database names (SQLite files here) kept in sync with the default one.
+# After a write a user reads from the primary for REPLICA_STICKY_SECONDS.
+# Run the test suite without it, test_replicas sets up its own replica.
+if 'DATABASE_REPLICAS' in os.environ:
+    DATABASE_REPLICAS = []
+    for number, name in enumerate(os.environ['DATABASE_REPLICAS'].split(','), start=1):
+        alias = f'replica{number}'
+        DATABASES[alias] = {
+            **DATABASES['default'],
+            'NAME': name.strip(),
+            'TEST': {'MIRROR': 'default'},
+        }
+        DATABASE_REPLICAS.append(alias)
+    DATABASE_ROUTERS.append('messageServer.replicas.ReplicaRouter')
+    REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+    # Which users are stuck to the primary has to be seen by every worker,
+    # so the cache is Redis with REDIS_URL and files on this host otherwise
+    if 'REDIS_URL' in os.environ:
+        CACHES = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                'LOCATION': os.environ['REDIS_URL'],
+            },
+        }
+    else:
+        CACHES = {
+            'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': os.environ.get('CACHE_DIR', os.path.join(BASE_DIR, 'cache')),
+            },
+        }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -152,6 +261,47 @@ STATIC_URL = 'static/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Largest profile, group or conversation picture accepted, checked while
+# the upload streams in
+PICTURE_UPLOAD_MAX_BYTES = 10 * 1024 * 1024
+
+# Messages older than MESSAGE_ARCHIVE_AFTER_DAYS are moved out of the
+# database by the archive_messages command, into gzipped segment files of
+# at most MESSAGE_ARCHIVE_SEGMENT_MESSAGES messages under
+# MESSAGE_ARCHIVE_ROOT.  Not under MEDIA_ROOT, which nginx serves publicly.
+MESSAGE_ARCHIVE_ROOT = os.environ.get('MESSAGE_ARCHIVE_ROOT', os.path.join(BASE_DIR, 'message_archive'))
+MESSAGE_ARCHIVE_AFTER_DAYS = 365
+MESSAGE_ARCHIVE_SEGMENT_MESSAGES = 5000
+
+# Change events behind /sync are kept SYNC_EVENT_RETENTION_DAYS, run
+# manage.py prune_change_events daily, see deploy_tools/prune-systemd.  Clients with older cursors have to
+# bootstrap again.  On a database other than SQLite, which commits writes
+# one at a time, set SYNC_SETTLE_SECONDS to longer than any write
+# transaction so sync cursors never pass an event still being committed.
+SYNC_EVENT_RETENTION_DAYS = 30
+SYNC_SETTLE_SECONDS = 0
+
+# Request metrics at /metrics.  Each worker writes its totals to a file in
+# METRICS_DIR at most every METRICS_FLUSH_SECONDS so any of them can answer
+# for all; without it a scrape only sees the worker it reaches.  Outside
+# DEBUG the endpoint needs METRICS_TOKEN as a bearer token.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_SECONDS = 5
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# With PROFILE_DIR set, staff can profile a request by sending X-Profile:
+# pstats or X-Profile: collapsed, and PROFILE_SAMPLE_RATE of all requests
+# are profiled in PROFILE_FORMAT.  The profiles, with each request's SQL,
+# are written to PROFILE_DIR.  Without it profiling costs nothing.
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_FORMAT = 'pstats'
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Processes that resize and re-encode uploaded pictures.  0 does the work
+# inline, after the request's transaction commits
+PICTURE_PROCESS_WORKERS = int(os.environ.get('PICTURE_PROCESS_WORKERS', 2))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
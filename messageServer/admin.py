@@ -1,3 +1,63 @@
 from django.contrib import admin
+from django.core.exceptions import ValidationError
+from .models import Message
+from .shards import is_sharded, shard_aliases
 
-# Register your models here.
+
+class ShardListFilter(admin.SimpleListFilter):
+    """
+    Picks which shard the message list shows, since one list can't span
+    several databases
+    """
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shard_aliases()]
+
+    def queryset(self, request, queryset):
+        # MessageAdmin.get_queryset already picked the shard
+        return queryset
+
+    def choices(self, changelist):
+        current = self.value() or shard_aliases()[0]
+        for alias in shard_aliases():
+            yield {
+                'selected': alias == current,
+                'query_string': changelist.get_query_string({self.parameter_name: alias}),
+                'display': alias,
+            }
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ['sender_username', 'conversation_id', 'text', 'created_at']
+    search_fields = ['text', 'sender_username']
+    raw_id_fields = ['sender', 'conversation']
+
+    def get_list_filter(self, request):
+        return [ShardListFilter] if is_sharded() else []
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if is_sharded():
+            alias = request.GET.get(ShardListFilter.parameter_name)
+            queryset = queryset.using(alias if alias in shard_aliases() else shard_aliases()[0])
+        return queryset
+
+    def get_object(self, request, object_id, from_field=None):
+        if not is_sharded():
+            return super().get_object(request, object_id, from_field)
+        for messages in Message.objects.filter(pk=object_id).per_shard():
+            try:
+                return messages.get()
+            except (Message.DoesNotExist, ValidationError):
+                continue
+        return None
+
+    def get_readonly_fields(self, request, obj=None):
+        # Moving a message to another conversation could move it to another
+        # shard
+        if obj is not None and is_sharded():
+            return ['conversation']
+        return []
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class MessageserverConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'messageServer'
+
+    def ready(self):
+        # Connects the live event publisher, the search index, the version
+        # counter, the archive clean up and the query timing signals, and
+        # registers the sync commit order check
+        from . import archive, metrics, realtime, search, sync, versions
@@ -0,0 +1,250 @@
+"""
+Cold storage for old messages.  archive_messages moves messages older than
+MESSAGE_ARCHIVE_AFTER_DAYS out of the database into gzipped JSON lines
+segments, one directory per conversation under MESSAGE_ARCHIVE_ROOT:
+
+    <root>/<conversation hex>/index.json
+    <root>/<conversation hex>/000001.jsonl.gz
+
+Segments are only ever added, never rewritten, so a segment once read can
+be cached for good.  index.json lists them with the (created_at, id) range
+each covers and is replaced atomically after a new segment is in place.
+get_messages reads archived messages back through page_with_archive once a
+client pages past the oldest message still in the database.
+"""
+from collections import namedtuple
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+from .models import Conversation, Message
+from .pagination import decode_cursor, keyset_page
+from .serializers import MESSAGE_ROW_FIELDS
+import datetime
+import functools
+import gzip
+import json
+import os
+import shutil
+import uuid
+
+INDEX_NAME = 'index.json'
+
+# Same fields as message_values rows, so message_rows and page_cursors take
+# either
+ArchivedMessage = namedtuple('ArchivedMessage', MESSAGE_ROW_FIELDS)
+
+
+def archive_root():
+    return settings.MESSAGE_ARCHIVE_ROOT
+
+
+def archive_after_days():
+    return settings.MESSAGE_ARCHIVE_AFTER_DAYS
+
+
+def segment_messages():
+    return settings.MESSAGE_ARCHIVE_SEGMENT_MESSAGES
+
+
+def conversation_dir(conversation_id):
+    return os.path.join(archive_root(), conversation_id.hex)
+
+
+def _key(created_at, pk):
+    return [created_at.isoformat(), pk.hex]
+
+
+def _parse_key(key):
+    return datetime.datetime.fromisoformat(key[0]), uuid.UUID(key[1])
+
+
+def read_index(conversation_id):
+    """
+    The conversation's index, or None if nothing of it is archived
+    """
+    try:
+        with open(os.path.join(conversation_dir(conversation_id), INDEX_NAME)) as index_file:
+            return json.load(index_file)
+    except FileNotFoundError:
+        return None
+
+
+def _write_atomically(path, data):
+    temporary = f"{path}.tmp"
+    with open(temporary, 'wb') as output:
+        output.write(data)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(temporary, path)
+
+
+@functools.lru_cache(maxsize=64)
+def read_segment(path):
+    """
+    Every message in a segment, oldest first
+    """
+    conversation_id = uuid.UUID(os.path.basename(os.path.dirname(path)))
+    with gzip.open(path, 'rt', encoding='utf-8') as segment:
+        return tuple(
+            ArchivedMessage(
+                id=uuid.UUID(pk),
+                sender=uuid.UUID(sender),
+                sender_username=sender_username,
+                conversation=conversation_id,
+                text=text,
+                created_at=datetime.datetime.fromisoformat(created_at)
+            )
+            for pk, sender, sender_username, text, created_at in map(json.loads, segment)
+        )
+
+
+def append_segment(conversation_id, rows):
+    """
+    Write rows, oldest first, as the conversation's next segment, list it
+    in the index and return the index
+    """
+    directory = conversation_dir(conversation_id)
+    os.makedirs(directory, exist_ok=True)
+    index = read_index(conversation_id) or {'conversation': conversation_id.hex, 'message_count': 0, 'segments': []}
+
+    name = f"{len(index['segments']) + 1:06d}.jsonl.gz"
+    lines = ''.join(
+        json.dumps([row.id.hex, row.sender.hex, row.sender_username, row.text, row.created_at.isoformat()]) + '\n'
+        for row in rows
+    )
+    _write_atomically(os.path.join(directory, name), gzip.compress(lines.encode('utf-8')))
+
+    index['segments'].append({
+        'name': name,
+        'count': len(rows),
+        'first': _key(rows[0].created_at, rows[0].id),
+        'last': _key(rows[-1].created_at, rows[-1].id),
+    })
+    index['message_count'] += len(rows)
+    _write_atomically(os.path.join(directory, INDEX_NAME), json.dumps(index).encode('utf-8'))
+    return index
+
+
+def last_segment_ids(conversation_id, index):
+    if not index or not index['segments']:
+        return set()
+    path = os.path.join(conversation_dir(conversation_id), index['segments'][-1]['name'])
+    return {row.id for row in read_segment(path)}
+
+
+def archive_conversation(conversation_id, cutoff, batch_size=None):
+    """
+    Move the conversation's messages created before cutoff into segments
+    and return how many were moved.  Each segment is written before its
+    messages are deleted, and messages already in the last segment are
+    only deleted, so an interrupted run can simply be repeated.  The
+    conversation's archived_message_count is copied from the index before
+    each delete rather than added to, so a repeat also puts it right.
+    """
+    batch_size = batch_size or segment_messages()
+    messages = Message.objects.filter(conversation=conversation_id, created_at__lt=cutoff)
+    moved = 0
+    while True:
+        rows = list(
+            messages.order_by('created_at', 'id').values_list(*MESSAGE_ROW_FIELDS, named=True)[:batch_size]
+        )
+        if not rows:
+            return moved
+        index = read_index(conversation_id)
+        done = last_segment_ids(conversation_id, index)
+        rows = [ArchivedMessage(*row) for row in rows]
+        fresh = [row for row in rows if row.id not in done]
+        if fresh:
+            index = append_segment(conversation_id, fresh)
+        Conversation.objects.filter(pk=conversation_id).update(archived_message_count=index['message_count'])
+        Message.objects.filter(conversation=conversation_id, id__in=[row.id for row in rows]).delete()
+        moved += len(fresh)
+
+
+def archive_messages(older_than_days=None, batch_size=None):
+    """
+    Archive every conversation's messages older than older_than_days and
+    return how many conversations and messages were archived
+    """
+    days = archive_after_days() if older_than_days is None else older_than_days
+    cutoff = timezone.now() - datetime.timedelta(days=days)
+    old = Message.objects.filter(created_at__lt=cutoff).order_by().values_list('conversation', flat=True).distinct()
+    conversation_ids = {conversation_id for shard in old.per_shard() for conversation_id in shard}
+    moved = 0
+    for conversation_id in sorted(conversation_ids):
+        moved += archive_conversation(conversation_id, cutoff, batch_size)
+    return len(conversation_ids), moved
+
+
+def archived_rows(conversation_id, index, limit, before=None, after=None):
+    """
+    Up to limit archived messages older than before, newest first, or
+    newer than after, oldest first.  Only segments overlapping the range
+    are read.
+    """
+    directory = conversation_dir(conversation_id)
+    segments = [(_parse_key(segment['first']), _parse_key(segment['last']), segment['name']) for segment in index['segments']]
+    if after is None:
+        segments.sort(key=lambda segment: segment[1], reverse=True)
+    else:
+        segments.sort(key=lambda segment: segment[0])
+
+    rows = []
+    for first, last, name in segments:
+        if before is not None and first >= before:
+            continue
+        if after is not None and last <= after:
+            continue
+        # Segments are read newest first, or oldest first walking forward,
+        # so once enough rows are in hand a segment entirely past the
+        # limit-th one can't contribute
+        if len(rows) >= limit:
+            edge = (rows[limit - 1].created_at, rows[limit - 1].id)
+            if (after is None and last < edge) or (after is not None and first > edge):
+                break
+        for row in read_segment(os.path.join(directory, name)):
+            key = (row.created_at, row.id)
+            if (before is None or key < before) and (after is None or key > after):
+                rows.append(row)
+        rows.sort(key=lambda row: (row.created_at, row.id), reverse=after is None)
+    return rows[:limit]
+
+
+def page_with_archive(conversation_id, queryset, limit, before=None, after=None):
+    """
+    keyset_page over the conversation's messages, carrying on into the
+    archive past the oldest message still in the database.  Archived
+    messages are all older than the ones left, so the archive is only read
+    when a page reaches it.
+    """
+    rows, has_more = keyset_page(queryset, limit, before=before, after=after)
+    if after is None and has_more:
+        return rows, has_more
+    index = read_index(conversation_id)
+    if index is None or not index['segments']:
+        return rows, has_more
+
+    if after is None:
+        if rows:
+            bound = (rows[-1].created_at, rows[-1].id)
+        else:
+            bound = decode_cursor(before) if before is not None else None
+        rows = rows + archived_rows(conversation_id, index, limit - len(rows) + 1, before=bound)
+        return rows[:limit], len(rows) > limit
+
+    cursor = decode_cursor(after)
+    newer = archived_rows(conversation_id, index, limit + 1, after=cursor)
+    if not newer:
+        return rows, has_more
+    oldest_first = newer + rows[::-1]
+    page = oldest_first[:limit]
+    page.reverse()
+    return page, has_more or len(oldest_first) > limit
+
+
+@receiver(post_delete, sender=Conversation)
+def delete_conversation_archive(sender, instance=None, **kwargs):
+    directory = conversation_dir(instance.pk)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory, ignore_errors=True)
@@ -1,7 +1,21 @@
 from messageServer.models import User
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
 from django.contrib.auth.backends import ModelBackend
+from django.core import signing
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authentication import TokenAuthentication
 from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+import copy
 import logging
+import threading
+import time
+import uuid
 
 logger = logging.getLogger('django')
 
@@ -23,3 +37,131 @@ class CustomAuthenticationBackend(object):
             return User.objects.get(username=username)
         except User.DoesNotExist:
             return None
+
+
+SIGNED_TOKEN_SALT = 'messageServer.authentication.signed-token'
+
+
+def signed_token_max_age():
+    return getattr(settings, 'SIGNED_TOKEN_MAX_AGE_SECONDS', 30 * 24 * 60 * 60)
+
+
+def is_signed_token(key):
+    # Table tokens are 40 hex characters, signed ones always contain the
+    # signer's separator
+    return ':' in key
+
+
+def issue_signed_token(user):
+    """
+    A token carrying the user id and token version under an HMAC of the
+    secret key, so checking it needs no Token row.  Returns the key and when
+    it expires.
+    """
+    key = signing.TimestampSigner(salt=SIGNED_TOKEN_SALT).sign(f"{user.id.hex}:{user.token_version}")
+    return key, timezone.now() + timedelta(seconds=signed_token_max_age())
+
+
+def revoke_signed_tokens(user):
+    """
+    Invalidate every signed token issued to user so far.  Other processes
+    may still accept them until their cached copy of the user expires.
+    """
+    User.objects.filter(pk=user.pk).update(token_version=F('token_version') + 1)
+    user.token_version += 1
+    user_cache.discard(user.pk)
+
+
+class UserCache:
+    """
+    Small LRU of users by id for signed token checks.  Entries live for a
+    short while so revocations and profile changes made by other processes
+    still get through.  Hands out copies so requests can't share instances.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def size(self):
+        return getattr(settings, 'SIGNED_TOKEN_USER_CACHE_SIZE', 1024)
+
+    def ttl(self):
+        return getattr(settings, 'SIGNED_TOKEN_USER_CACHE_SECONDS', 60)
+
+    def get(self, user_id):
+        if self.size() <= 0:
+            return User.objects.filter(pk=user_id).first()
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(user_id)
+                return copy.copy(entry[0])
+
+        user = User.objects.filter(pk=user_id).first()
+        if user is None:
+            return None
+        with self.lock:
+            self.entries[user_id] = (user, now + self.ttl())
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.size():
+                self.entries.popitem(last=False)
+        return copy.copy(user)
+
+    def discard(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+user_cache = UserCache()
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_cached_user(sender, instance=None, **kwargs):
+    user_cache.discard(instance.pk)
+
+
+class SignedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that also accepts signed tokens.  Both use the
+    Authorization: Token <key> header, so clients move over just by logging
+    in again with token_type=signed.
+    """
+
+    def authenticate_credentials(self, key):
+        if not is_signed_token(key):
+            return super().authenticate_credentials(key)
+
+        try:
+            value = signing.TimestampSigner(salt=SIGNED_TOKEN_SALT).unsign(key, max_age=signed_token_max_age())
+        except signing.SignatureExpired:
+            raise AuthenticationFailed('Token has expired.')
+        except signing.BadSignature:
+            raise AuthenticationFailed('Invalid token.')
+
+        user_hex, _, version = value.partition(':')
+        user = user_cache.get(uuid.UUID(user_hex))
+        if user is None or not user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        if str(user.token_version) != version:
+            raise AuthenticationFailed('Token has been revoked.')
+        return (user, key)
+
+
+def user_for_token(key):
+    """
+    Resolve an API token the same way the REST views do, for connections
+    that never pass through DRF such as websockets
+    """
+    try:
+        user, _ = SignedTokenAuthentication().authenticate_credentials(key)
+    except AuthenticationFailed:
+        return None
+    return user
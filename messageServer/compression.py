@@ -0,0 +1,278 @@
+"""
+Response compression negotiated from Accept-Encoding, and decompression of
+request bodies sent with Content-Encoding.  gzip is always available, br and
+zstd when the brotli and zstandard packages are installed.
+
+Compressing a secret next to text an attacker chooses leaks the secret
+through the compressed length, given the attacker can make the victim's
+client send many requests (BREACH).  Responses that hand out auth tokens
+are compression_exempt.  Other authenticated responses, which carry emails
+next to message text, are only sent to requests carrying the client's
+token header, which another site can't add, or its session cookie, which
+SameSite=Lax keeps off the cross site requests the attack needs.
+"""
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+import functools
+import io
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 6}
+DEFAULT_MIN_BYTES = 1024
+DEFAULT_CONTENT_TYPES = ('application/json', 'application/msgpack', 'text/')
+
+# Request bodies are inflated this much at a time, so a small body that
+# inflates to something huge is caught without holding all of it
+DECOMPRESS_CHUNK_BYTES = 64 * 1024
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+class GzipCodec:
+    name = 'gzip'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compressobj(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        compressor = self.compressobj()
+        return compressor.compress(data) + compressor.flush()
+
+    def stream(self):
+        compressor = self.compressobj()
+        return (
+            lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush
+        )
+
+    def decompress(self, data, max_bytes):
+        decompressor = zlib.decompressobj(31)
+        output = bytearray()
+        pending = data
+        while pending and not decompressor.eof:
+            output += decompressor.decompress(pending, DECOMPRESS_CHUNK_BYTES)
+            if len(output) > max_bytes:
+                raise BodyTooLarge()
+            pending = decompressor.unconsumed_tail
+        if not decompressor.eof:
+            raise ValueError('Truncated gzip body')
+        return bytes(output)
+
+
+class BrotliCodec:
+    name = 'br'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.level)
+
+    def stream(self):
+        compressor = brotli.Compressor(quality=self.level)
+        return lambda chunk: compressor.process(chunk) + compressor.flush(), compressor.finish
+
+
+class ZstdCodec:
+    name = 'zstd'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def stream(self):
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        return (
+            lambda chunk: compressor.compress(chunk) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+            compressor.flush
+        )
+
+    def decompress(self, data, max_bytes):
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+                output = reader.read(max_bytes + 1)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+        if len(output) > max_bytes:
+            raise BodyTooLarge()
+        return output
+
+
+def available_codecs():
+    """
+    Codecs this process can use, in the order preferred when a client
+    accepts several equally
+    """
+    levels = {**DEFAULT_LEVELS, **getattr(settings, 'COMPRESSION_LEVELS', {})}
+    codecs = []
+    if zstandard is not None:
+        codecs.append(ZstdCodec(levels['zstd']))
+    if brotli is not None:
+        codecs.append(BrotliCodec(levels['br']))
+    codecs.append(GzipCodec(levels['gzip']))
+    return codecs
+
+
+def request_codecs():
+    # Brotli has no bounded decompression, so it is only used for responses
+    return {codec.name: codec for codec in available_codecs() if hasattr(codec, 'decompress')}
+
+
+def parse_accept_encoding(header):
+    accepted = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+def choose_codec(header, codecs):
+    """
+    The codec the client weighs highest, ties going to the server's order
+    """
+    accepted = parse_accept_encoding(header)
+    best, best_quality = None, 0.0
+    for codec in codecs:
+        quality = accepted.get(codec.name, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = codec, quality
+    return best
+
+
+def compression_exempt(view_func):
+    """
+    Send view_func's responses uncompressed, for those holding a secret
+    """
+    @functools.wraps(view_func)
+    def wrapper(*args, **kwargs):
+        response = view_func(*args, **kwargs)
+        response.compression_exempt = True
+        return response
+    return wrapper
+
+
+def compress_chunks(codec, chunks):
+    # Flushed after every chunk so a streamed response, like the event
+    # stream, reaches the client as it is produced
+    compress, finish = codec.stream()
+    for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+async def compress_chunks_async(codec, chunks):
+    compress, finish = codec.stream()
+    async for chunk in chunks:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compresses responses the client accepts in zstd, br or gzip, and
+    inflates compressed request bodies before anything reads them.  Goes
+    near the top of MIDDLEWARE, like GZipMiddleware.
+
+    COMPRESSION_MIN_BYTES skips responses too small to be worth it,
+    COMPRESSION_LEVELS sets the level per encoding and
+    COMPRESSION_CONTENT_TYPES the content type prefixes compressed.
+    """
+
+    def process_request(self, request):
+        encoding = request.headers.get('Content-Encoding', '').strip().lower()
+        if not encoding or encoding == 'identity':
+            return None
+
+        codecs = request_codecs()
+        codec = codecs.get(encoding)
+        if codec is None:
+            response = JsonResponse({'error': f'Unsupported Content-Encoding {encoding}'}, status=415)
+            response['Accept-Encoding'] = ', '.join(codecs)
+            return response
+
+        max_bytes = getattr(settings, 'COMPRESSION_MAX_REQUEST_BYTES', 10 * 1024 * 1024)
+        try:
+            body = codec.decompress(request.body, max_bytes)
+        except BodyTooLarge:
+            return JsonResponse({'error': 'Request body is too large'}, status=413)
+        except (ValueError, zlib.error) as e:
+            return JsonResponse({'error': f'Invalid {encoding} body: {e}'}, status=400)
+
+        request._body = body
+        request._stream = io.BytesIO(body)
+        request.META['CONTENT_LENGTH'] = str(len(body))
+        del request.META['HTTP_CONTENT_ENCODING']
+        request.__dict__.pop('headers', None)
+        return None
+
+    def process_response(self, request, response):
+        min_bytes = getattr(settings, 'COMPRESSION_MIN_BYTES', DEFAULT_MIN_BYTES)
+        if not response.streaming and len(response.content) < min_bytes:
+            return response
+        if response.has_header('Content-Encoding') or not 200 <= response.status_code < 300:
+            return response
+        if getattr(response, 'compression_exempt', False):
+            return response
+        content_type = response.get('Content-Type', '').lower()
+        content_types = getattr(settings, 'COMPRESSION_CONTENT_TYPES', DEFAULT_CONTENT_TYPES)
+        if not content_type.startswith(tuple(content_types)):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        codec = choose_codec(request.headers.get('Accept-Encoding', ''), available_codecs())
+        if codec is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                response.streaming_content = compress_chunks_async(codec, response.streaming_content)
+            else:
+                response.streaming_content = compress_chunks(codec, response.streaming_content)
+            del response.headers['Content-Length']
+        else:
+            compressed = codec.compress(response.content)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        # The compressed bytes differ from what a strong ETag promised
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = codec.name
+        return response
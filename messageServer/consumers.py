@@ -0,0 +1,60 @@
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from urllib.parse import parse_qs
+from .authentication import user_for_token
+from .realtime import EventSubscription
+
+CLOSE_UNAUTHORIZED = 4401
+
+
+def token_from_scope(scope):
+    """
+    Take the API token from an Authorization: Token <key> header, or from
+    ?token=<key> for clients that can't set headers on a websocket
+    """
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            keyword, _, key = value.decode('latin1').partition(' ')
+            if keyword == 'Token' and key:
+                return key.strip()
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    return query.get('token', [None])[0]
+
+
+@database_sync_to_async
+def authenticate_scope(scope):
+    key = token_from_scope(scope)
+    if not key:
+        return None
+    return user_for_token(key)
+
+
+class MessageConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Pushes new messages, new conversations and membership changes in the
+    user's groups as they are committed
+    """
+
+    async def connect(self):
+        self.subscription = None
+        user = await authenticate_scope(self.scope)
+        if user is None:
+            await self.close(code=CLOSE_UNAUTHORIZED)
+            return
+
+        self.subscription = EventSubscription(self.channel_layer, self.channel_name, user)
+        await self.subscription.start()
+        await self.accept()
+
+    async def disconnect(self, code):
+        if self.subscription is not None:
+            await self.subscription.close()
+
+    async def receive_json(self, content, **kwargs):
+        if content.get('type') == 'ping':
+            await self.send_json({'type': 'pong'})
+
+    async def change_event(self, message):
+        event = message['event']
+        if await self.subscription.accept(event):
+            await self.send_json(event)
@@ -0,0 +1,58 @@
+"""
+Picture resizing and re-encoding.  Kept free of Django imports so it can run
+in a freshly spawned worker process.
+"""
+from PIL import Image, ImageOps
+import io
+
+# Square crops served for avatars and list rows, in pixels
+PICTURE_SIZES = (48, 128, 512)
+
+# The re-encoded original is scaled to fit inside this box
+FULL_SIZE = 2048
+
+PICTURE_FORMATS = {
+    'jpeg': 'jpg',
+    'webp': 'webp',
+}
+
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+
+def encode(image, image_format):
+    """
+    Encode without copying over EXIF, ICC or any other metadata
+    """
+    output = io.BytesIO()
+    if image_format == 'jpeg':
+        if image.mode != 'RGB':
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+            image = background
+        image.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    else:
+        image.save(output, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return output.getvalue()
+
+
+def render_variants(data, sizes=PICTURE_SIZES):
+    """
+    Re-encode an uploaded picture.  Returns the full size JPEG and a map of
+    format to size to encoded square crop.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        source.seek(0)
+        image = ImageOps.exif_transpose(source)
+        image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+
+    full = image.copy()
+    full.thumbnail((FULL_SIZE, FULL_SIZE), Image.LANCZOS)
+    full_jpeg = encode(full, 'jpeg')
+
+    variants = {image_format: {} for image_format in PICTURE_FORMATS}
+    for size in sizes:
+        square = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        for image_format in PICTURE_FORMATS:
+            variants[image_format][str(size)] = encode(square, image_format)
+    return full_jpeg, variants
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from messageServer.archive import archive_after_days, archive_messages, segment_messages
+
+
+class Command(BaseCommand):
+    help = 'Move old messages out of the database into compressed per conversation archive segments'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None,
+                            help=f'Archive messages older than this (default {archive_after_days()})')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help=f'Most messages per segment (default {segment_messages()})')
+
+    def handle(self, *args, **options):
+        conversations, messages = archive_messages(options['older_than_days'], options['batch_size'])
+        self.stdout.write(f"Archived {messages} message(s) from {conversations} conversation(s)")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from messageServer.notifications import CLAIM_BATCH_SIZE, dispatch_pending
+import time
+
+
+class Command(BaseCommand):
+    help = 'Send queued push notifications from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain what is due now and exit')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when nothing is due')
+        parser.add_argument('--batch-size', type=int, default=CLAIM_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        while True:
+            handled = dispatch_pending(limit=options['batch_size'])
+            if handled:
+                self.stdout.write(f"Dispatched {handled} notification(s)")
+                continue
+            if options['once']:
+                return
+            close_old_connections()
+            time.sleep(options['interval'])
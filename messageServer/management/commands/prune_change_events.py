@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from messageServer.sync import prune_events
+
+
+class Command(BaseCommand):
+    help = 'Delete change events older than the sync retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None,
+                            help=f'Delete events older than this (default {settings.SYNC_EVENT_RETENTION_DAYS})')
+
+    def handle(self, *args, **options):
+        deleted = prune_events(options['older_than_days'])
+        self.stdout.write(f"Deleted {deleted} change event(s)")
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from messageServer.notifications import prune_outbox
+
+
+class Command(BaseCommand):
+    help = 'Delete sent and failed push notifications older than the outbox retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, default=None,
+                            help=f'Delete rows older than this (default {settings.PUSH_OUTBOX_RETENTION_DAYS})')
+
+    def handle(self, *args, **options):
+        deleted = prune_outbox(options['older_than_days'])
+        self.stdout.write(f"Deleted {deleted} push notification(s)")
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from messageServer.models import Message
+from messageServer.search import index_messages
+from messageServer.shards import is_sharded, shard_aliases, shard_for
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def move_messages(messages, source, target):
+    """
+    Copy messages into target and then delete them from source.  Copies
+    that are already there are skipped, so an interrupted run can simply be
+    repeated.
+    """
+    # bulk_create stamps created_at with the current time, so put the
+    # original times back afterwards
+    created_at = {message.id: message.created_at for message in messages}
+    with transaction.atomic(using=target):
+        Message.objects.using(target).bulk_create(messages, ignore_conflicts=True)
+        for message in messages:
+            message.created_at = created_at[message.id]
+        Message.objects.using(target).bulk_update(messages, ['created_at'])
+        index_messages(messages, target)
+    with transaction.atomic(using=source):
+        Message.objects.using(source).filter(id__in=list(created_at)).delete()
+
+
+class Command(BaseCommand):
+    help = 'Move messages into the shard their conversation hashes to, after MESSAGE_SHARDS is set or changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError('MESSAGE_SHARDS is not set, messages stay in the default database')
+
+        batch_size = options['batch_size']
+        for source in [DEFAULT_DB_ALIAS, *shard_aliases()]:
+            moved = 0
+            last_id = None
+            while True:
+                batch = Message.objects.using(source).order_by('id')
+                if last_id is not None:
+                    batch = batch.filter(id__gt=last_id)
+                batch = list(batch[:batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                misplaced = {}
+                for message in batch:
+                    target = shard_for(message.conversation_id)
+                    if target != source:
+                        misplaced.setdefault(target, []).append(message)
+                for target, messages in misplaced.items():
+                    move_messages(messages, source, target)
+                    moved += len(messages)
+            self.stdout.write(f"Moved {moved} message(s) out of {source}")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from messageServer.summaries import rebuild_conversation_summaries
+
+
+class Command(BaseCommand):
+    help = 'Recompute the last message and message count kept on each conversation'
+
+    def handle(self, *args, **options):
+        count = rebuild_conversation_summaries()
+        self.stdout.write(f"Rebuilt summaries of {count} conversations")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from messageServer.search import create_search_indexes, fts5_available, rebuild_message_index, rebuild_user_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full text indexes for user and message search'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        using = options['database']
+        if not fts5_available(using):
+            raise CommandError('This database has no FTS5 support, search falls back to plain queries')
+
+        create_search_indexes(using)
+        rebuild_user_index(using)
+        self.stdout.write("Rebuilt user index")
+        count = rebuild_message_index(using)
+        self.stdout.write(f"Rebuilt message index with {count} messages")
@@ -0,0 +1,301 @@
+from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models.constants import OnConflict
+from rest_framework.authtoken.models import Token
+from messageServer.models import Conversation, Group, Message, PREVIEW_LENGTH
+from messageServer.search import fts5_available, index_message_rows, rebuild_user_index
+from messageServer.shards import shard_for
+import datetime
+import itertools
+import operator
+import random
+import time
+import uuid
+
+User = get_user_model()
+
+DEFAULT_BATCH_SIZE = 5000
+# Distinct message texts, drawn from rather than built per message
+TEXT_POOL_SIZE = 10000
+
+WORDS = (
+    'the book chapter ending character plot twist author reader favourite slow fast loved hated '
+    'think maybe really honestly page scene villain hero letter twenty night morning finished '
+    'start again why how what when dialogue quote line cover sequel series library borrowed'
+).split()
+
+
+def seeded_uuid(rng):
+    return uuid.UUID(int=rng.getrandbits(128), version=4)
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+class RowInserter:
+    """
+    executemany straight into a model's table, for the tables with the most
+    rows.  Skips building a model instance and running the whole
+    get_db_prep_save chain for every value, which is most of the cost of
+    bulk_create at this scale, and leaves created_at as given.
+    """
+
+    def __init__(self, model, field_names, ignore_conflicts=False):
+        self.fields = [model._meta.get_field(name) for name in field_names]
+        self.table = model._meta.db_table
+        self.on_conflict = OnConflict.IGNORE if ignore_conflicts else None
+        self.prepared = {}
+
+    def _adapter(self, field, connection):
+        target = field.target_field if field.is_relation else field
+        kind = target.get_internal_type()
+        if kind == 'UUIDField':
+            return None if connection.features.has_native_uuid_field else operator.attrgetter('hex')
+        if kind == 'DateTimeField':
+            return self._datetime_adapter(connection)
+        if kind in ('CharField', 'TextField'):
+            return None
+        return lambda value: target.get_db_prep_save(value, connection)
+
+    def _datetime_adapter(self, connection):
+        # The backend's adapter looks up settings and converts time zones on
+        # every call.  Where all it does is render the time in the
+        # connection's zone as text, as on SQLite, do just that.
+        adapt = connection.ops.adapt_datetimefield_value
+        if not settings.USE_TZ:
+            return adapt
+        zone = connection.timezone
+
+        def render(value):
+            return str(value.astimezone(zone).replace(tzinfo=None))
+
+        sample = datetime.datetime(2001, 2, 3, 4, 5, 6, 789, tzinfo=datetime.timezone.utc)
+        return render if adapt(sample) == render(sample) else adapt
+
+    def _prepare(self, alias):
+        if alias not in self.prepared:
+            connection = connections[alias]
+            ops = connection.ops
+            columns = ', '.join(ops.quote_name(field.column) for field in self.fields)
+            statement = (
+                f"{ops.insert_statement(on_conflict=self.on_conflict)} {ops.quote_name(self.table)} ({columns}) "
+                f"VALUES ({', '.join(['%s'] * len(self.fields))}) "
+                f"{ops.on_conflict_suffix_sql(self.fields, self.on_conflict, None, None) or ''}"
+            )
+            self.prepared[alias] = (statement, [self._adapter(field, connection) for field in self.fields])
+        return self.prepared[alias]
+
+    def insert(self, rows, using=DEFAULT_DB_ALIAS):
+        statement, adapters = self._prepare(using)
+        values = [
+            [value if adapt is None else adapt(value) for adapt, value in zip(adapters, row)]
+            for row in rows
+        ]
+        with connections[using].cursor() as cursor:
+            cursor.executemany(statement, values)
+
+
+class Command(BaseCommand):
+    help = 'Bulk insert a synthetic dataset of users, groups, friends, conversations and messages for scale testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--groups', type=int, default=1000)
+        parser.add_argument('--members-per-group', type=int, default=20,
+                            help='Average members per group, sizes vary from 2 to twice this')
+        parser.add_argument('--friends-per-user', type=int, default=50, help='Average friends per user')
+        parser.add_argument('--conversations-per-group', type=int, default=3)
+        parser.add_argument('--messages', type=int, default=1000000,
+                            help='Spread over the conversations with a long tail, a few get most of them')
+        parser.add_argument('--days', type=int, default=365, help='Messages are dated over this many days up to now')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='scale', help='Usernames and emails start with this')
+        parser.add_argument('--password', default=None,
+                            help='Password of every user, hashed once.  Without it none can log in with one.')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--no-search-index', action='store_true',
+                            help='Skip the message search index, about half the time for messages.  rebuild_search_index can fill it later.')
+
+    def handle(self, *args, **options):
+        self.check_shape(options)
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.prefix = options['prefix']
+        if User.objects.filter(username__startswith=f"{self.prefix}_").exists():
+            raise CommandError(f"Users named {self.prefix}_... already exist, pick another --prefix")
+
+        users = self.timed('users', self.create_users, options['users'], make_password(options['password']))
+        groups = self.timed('groups', self.create_groups, users, options['groups'], options['members_per_group'])
+        self.timed('friendships', self.create_friendships, users, options['friends_per_user'])
+        conversations = self.timed('conversations', self.create_conversations, groups, options['conversations_per_group'])
+        self.timed(
+            'messages', self.create_messages, users, groups, conversations,
+            options['messages'], options['days'], not options['no_search_index']
+        )
+
+    def check_shape(self, options):
+        for name in ('users', 'groups', 'members_per_group', 'friends_per_user', 'conversations_per_group', 'messages', 'days'):
+            if options[name] < 0:
+                raise CommandError(f"--{name.replace('_', '-')} can't be negative")
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        if options['groups'] and options['users'] < 2:
+            raise CommandError('Groups need at least 2 --users to be members')
+        if options['messages'] and not (options['groups'] and options['conversations_per_group']):
+            raise CommandError('Messages need --groups and --conversations-per-group to go in')
+
+    def timed(self, name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        count = len(result) if isinstance(result, list) else result
+        self.stdout.write(f"Created {count} {name} in {time.perf_counter() - start:.1f}s")
+        return result
+
+    def create_users(self, count, password):
+        """
+        Users without their post_save signals, so tokens and the search
+        index are filled here in bulk.  Returns (id, username) pairs.
+        """
+        users = [(seeded_uuid(self.rng), f"{self.prefix}_{i}") for i in range(count)]
+        for batch in batches(users, self.batch_size):
+            with transaction.atomic():
+                User.objects.bulk_create([
+                    User(id=pk, username=username, email=f"{username}@example.com", password=password)
+                    for pk, username in batch
+                ])
+                Token.objects.bulk_create([Token(key=Token.generate_key(), user_id=pk) for pk, _ in batch])
+        if fts5_available():
+            rebuild_user_index(batch_size=self.batch_size)
+        return users
+
+    def create_groups(self, users, count, members_per_group):
+        """
+        Returns (id, member indexes) pairs
+        """
+        memberships = RowInserter(User.groups.through, ['user', 'group'])
+        groups = []
+        for batch in batches(range(count), self.batch_size):
+            batch_groups = []
+            for i in batch:
+                size = min(len(users), self.rng.randint(2, max(2, 2 * members_per_group - 2)))
+                batch_groups.append((seeded_uuid(self.rng), self.rng.sample(range(len(users)), size)))
+            with transaction.atomic():
+                Group.objects.bulk_create([
+                    Group(id=pk, name=f"{self.prefix} group {n}") for n, (pk, _) in enumerate(batch_groups, start=len(groups))
+                ])
+                for rows in batches(
+                    ((users[member][0], pk) for pk, members in batch_groups for member in members), self.batch_size
+                ):
+                    memberships.insert(rows)
+            groups += batch_groups
+        return groups
+
+    def create_friendships(self, users, friends_per_user):
+        """
+        Both directions of each friendship, as User.friends is symmetrical.
+        Returns how many pairs were drawn, repeats are skipped on insert.
+        """
+        friendships = RowInserter(User.friends.through, ['from_user', 'to_user'], ignore_conflicts=True)
+        pairs = 0
+        # Each user picks half their friends and is picked for the other half
+        picks = friends_per_user // 2
+        if picks == 0 or len(users) < 2:
+            return pairs
+
+        def rows():
+            nonlocal pairs
+            for i, (pk, _) in enumerate(users):
+                for j in self.rng.sample(range(len(users) - 1), min(picks, len(users) - 1)):
+                    friend = users[j if j < i else j + 1][0]
+                    pairs += 1
+                    yield pk, friend
+                    yield friend, pk
+
+        for batch in batches(rows(), self.batch_size):
+            with transaction.atomic():
+                friendships.insert(batch)
+        return pairs
+
+    def create_conversations(self, groups, per_group):
+        """
+        Returns (id, group index) pairs
+        """
+        conversations = [
+            (seeded_uuid(self.rng), group_index)
+            for group_index in range(len(groups)) for _ in range(per_group)
+        ]
+        for start in range(0, len(conversations), self.batch_size):
+            Conversation.objects.bulk_create([
+                Conversation(id=pk, group_id=groups[group_index][0], book_title=f"{self.prefix} book {n}")
+                for n, (pk, group_index) in enumerate(conversations[start:start + self.batch_size], start=start)
+            ])
+        return conversations
+
+    def create_messages(self, users, groups, conversations, count, days, index):
+        """
+        Messages in batches of batch_size, keeping only each conversation's
+        count and latest message in memory, which become its summary
+        """
+        if not conversations:
+            return 0
+        rng = self.rng
+        messages = RowInserter(Message, ['id', 'sender', 'sender_username', 'conversation', 'text', 'created_at'])
+        weights = list(itertools.accumulate(rng.paretovariate(1.2) for _ in conversations))
+        texts = [' '.join(rng.choices(WORDS, k=rng.randint(3, 20))) for _ in range(TEXT_POOL_SIZE)]
+        now = time.time()
+        span = days * 86400
+        summaries = {}
+
+        written = 0
+        while written < count:
+            size = min(self.batch_size, count - written)
+            by_shard = {}
+            for conversation_index in rng.choices(range(len(conversations)), cum_weights=weights, k=size):
+                conversation_id, group_index = conversations[conversation_index]
+                group_id, members = groups[group_index]
+                sender_id, username = users[members[rng.randrange(len(members))]]
+                created_at = datetime.datetime.fromtimestamp(now - rng.random() * span, tz=datetime.timezone.utc)
+                text = texts[rng.randrange(TEXT_POOL_SIZE)]
+                row = (seeded_uuid(rng), sender_id, username, conversation_id, text, created_at)
+                by_shard.setdefault(shard_for(conversation_id), []).append((row, group_id))
+
+                summary = summaries.get(conversation_id)
+                if summary is None:
+                    summaries[conversation_id] = [1, row]
+                elif (created_at, row[0]) > (summary[1][5], summary[1][0]):
+                    summary[0] += 1
+                    summary[1] = row
+                else:
+                    summary[0] += 1
+
+            for alias, shard_rows in by_shard.items():
+                with transaction.atomic(using=alias):
+                    messages.insert([row for row, _ in shard_rows], alias)
+                    if index and fts5_available(alias):
+                        index_message_rows([
+                            (row[4], row[0].hex, row[3].hex, group_id.hex)
+                            for row, group_id in shard_rows
+                        ], alias)
+            written += size
+            if written % (self.batch_size * 100) == 0:
+                self.stdout.write(f"  {written} messages")
+
+        conversations_by_id = Conversation.objects.in_bulk(list(summaries))
+        for conversation_id, (message_count, latest) in summaries.items():
+            conversation = conversations_by_id[conversation_id]
+            conversation.message_count = message_count
+            conversation.last_message_at = latest[5]
+            conversation.last_message_preview = latest[4][:PREVIEW_LENGTH]
+            conversation.last_sender_username = latest[2]
+        Conversation.objects.bulk_update(
+            conversations_by_id.values(),
+            ['message_count', 'last_message_at', 'last_message_preview', 'last_sender_username'],
+            batch_size=self.batch_size
+        )
+        return written
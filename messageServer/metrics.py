@@ -0,0 +1,320 @@
+"""
+Per route request metrics in the Prometheus text format.
+
+MetricsMiddleware records each request's latency, database queries and
+their time, response size and status, labelled by URL name.  Every thread
+writes only to its own store, so recording takes no locks; a scrape adds
+the stores up.  With METRICS_DIR set each process also writes its totals
+to a file there every METRICS_FLUSH_SECONDS, off the event loop when
+served async, and a scrape of any worker adds up the files of all of
+them, the way prometheus_client's multiprocess mode does.  Clear the
+directory when the server restarts.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('django')
+
+DEFAULT_FLUSH_SECONDS = 5
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+REQUESTS = 'http_requests_total'
+DURATION = 'http_request_duration_seconds'
+QUERIES = 'http_request_db_queries'
+QUERY_DURATION = 'http_request_db_duration_seconds'
+RESPONSE_SIZE = 'http_response_size_bytes'
+
+# name: (type, help, buckets)
+FAMILIES = {
+    REQUESTS: ('counter', 'Requests served, by route, method and status', None),
+    DURATION: ('histogram', 'Time from the request reaching Django to the response leaving it', LATENCY_BUCKETS),
+    QUERIES: ('histogram', 'Database queries run per request', QUERY_COUNT_BUCKETS),
+    QUERY_DURATION: ('histogram', 'Time spent in database queries per request', LATENCY_BUCKETS),
+    RESPONSE_SIZE: ('histogram', 'Response body size, after compression, of non streaming responses', SIZE_BUCKETS),
+}
+
+
+class Store:
+    """
+    One thread's counters and histograms.  Histograms are
+    [count per bucket..., count over the last bucket, sum].
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+
+_local = threading.local()
+_stores = []
+_process_key = f"{os.getpid()}-{int(time.time() * 1000)}"
+_last_flush = 0.0
+
+
+def _store():
+    store = getattr(_local, 'store', None)
+    if store is None:
+        store = _local.store = Store()
+        # list.append is atomic, and the store stays after its thread ends
+        # so totals never go backwards
+        _stores.append(store)
+    return store
+
+
+def increment(name, labels, amount=1):
+    counters = _store().counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + amount
+
+
+def observe(name, labels, value):
+    histograms = _store().histograms
+    key = (name, labels)
+    buckets = FAMILIES[name][2]
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = [0] * (len(buckets) + 2)
+    histogram[bisect.bisect_left(buckets, value)] += 1
+    histogram[-1] += value
+
+
+def reset():
+    """
+    Forget everything this process recorded
+    """
+    for store in list(_stores):
+        store.counters.clear()
+        store.histograms.clear()
+
+
+def snapshot():
+    """
+    This process's totals, as {(name, labels): value or histogram}
+    """
+    totals = {}
+    for store in list(_stores):
+        # dict.copy and list() run without letting another thread in, so
+        # a store can be read while its thread writes to it
+        for key, value in store.counters.copy().items():
+            totals[key] = totals.get(key, 0) + value
+        for key, histogram in store.histograms.copy().items():
+            _add_histogram(totals, key, list(histogram))
+    return totals
+
+
+def _add_histogram(totals, key, histogram):
+    current = totals.get(key)
+    if current is None:
+        totals[key] = histogram
+    else:
+        for i, value in enumerate(histogram):
+            current[i] += value
+
+
+def metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None)
+
+
+def flush():
+    """
+    Write this process's totals where the other workers can read them
+    """
+    global _last_flush
+    directory = metrics_dir()
+    _last_flush = time.monotonic()
+    if not directory:
+        return
+    entries = [[name, list(labels), value] for (name, labels), value in snapshot().items()]
+    path = os.path.join(directory, f"{_process_key}.json")
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{path}.tmp", 'w') as output:
+            json.dump(entries, output)
+        os.replace(f"{path}.tmp", path)
+    except OSError:
+        logger.exception(f"Writing metrics to {path} failed")
+
+
+def flush_due():
+    """
+    Whether this process's totals are due to be written.  Claims the write,
+    so requests finishing together don't all make it.
+    """
+    global _last_flush
+    if not metrics_dir() or time.monotonic() - _last_flush < getattr(settings, 'METRICS_FLUSH_SECONDS', DEFAULT_FLUSH_SECONDS):
+        return False
+    _last_flush = time.monotonic()
+    return True
+
+
+def flush_if_due():
+    if flush_due():
+        flush()
+
+
+def collect():
+    """
+    Totals of every process writing to METRICS_DIR, or of this one alone
+    """
+    directory = metrics_dir()
+    if not directory:
+        return snapshot()
+    flush()
+    totals = {}
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as source:
+                entries = json.load(source)
+        except (OSError, ValueError):
+            continue
+        for metric, labels, value in entries:
+            key = (metric, tuple(tuple(label) for label in labels))
+            if isinstance(value, list):
+                _add_histogram(totals, key, value)
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(totals):
+    lines = []
+    for name, (kind, help_text, buckets) in FAMILIES.items():
+        series = sorted((labels, value) for (metric, labels), value in totals.items() if metric == name)
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            if kind == 'counter':
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip([*buckets, '+Inf'], value[:-1]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+class QueryTimer:
+    """
+    Counts and times the current request's queries
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# Set by the middleware for the length of a request.  Context variables
+# follow a sync view into the thread sync_to_async runs it on, so queries
+# are counted whichever way the request is served.
+_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+def time_query(execute, sql, params, many, context):
+    queries = _queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries.seconds += time.perf_counter() - start
+        queries.count += 1
+
+
+@receiver(connection_created)
+def install_query_timer(sender, connection, **kwargs):
+    # Every connection, shards and replicas included, for as long as it
+    # lives.  connection.execute_wrapper would only cover one alias and,
+    # being thread local, not the thread a sync view runs on under ASGI.
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match is not None else 'unmatched'
+
+
+def record(request, response, seconds, queries):
+    labels = (('route', route_name(request)), ('method', request.method))
+    increment(REQUESTS, labels + (('status', str(response.status_code)),))
+    observe(DURATION, labels, seconds)
+    observe(QUERIES, labels, queries.count)
+    observe(QUERY_DURATION, labels, queries.seconds)
+    if not response.streaming:
+        observe(RESPONSE_SIZE, labels, len(response.content))
+
+
+class MetricsMiddleware:
+    """
+    Goes first in MIDDLEWARE, so it times everything else and sees the
+    compressed size.  A streaming response is timed until it starts.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries = QueryTimer()
+        token = _queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _queries.reset(token)
+        record(request, response, time.perf_counter() - start, queries)
+        flush_if_due()
+        return response
+
+    async def __acall__(self, request):
+        queries = QueryTimer()
+        token = _queries.set(queries)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _queries.reset(token)
+        record(request, response, time.perf_counter() - start, queries)
+        if flush_due():
+            # The file write would hold up every stream on the loop
+            await sync_to_async(flush, thread_sensitive=False)()
+        return response
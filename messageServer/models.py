@@ -1,15 +1,46 @@
 from django.db import models
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager, PermissionsMixin
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.db.models.functions import Lower
+from django.db.models.signals import post_delete, post_save, m2m_changed
+from django.dispatch import receiver, Signal
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
+from .shards import MessageQuerySet, is_sharded
 import uuid
 
 
-class Group(models.Model):
+class VersionedModel(models.Model):
+    """
+    Carries counters that versions.py bumps with F() updates whenever
+    something clients poll for changes, to back their ETags.  Ordinary saves
+    leave the counters out so a stale instance can never move one back.
+    """
+    version_fields = ('version',)
+
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.version_fields
+            ]
+        super().save(*args, **kwargs)
+
+
+class Group(VersionedModel):
+    version_fields = ('version', 'conversations_version')
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=255)
     picture = models.ImageField(upload_to='group_pictures', null=True, blank=True)
+    picture_variants = models.JSONField(default=dict, blank=True)
+    # Bumped when any of the group's conversations changes, version covers
+    # the group itself and its members
+    conversations_version = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -41,7 +72,9 @@ class UserManager(BaseUserManager):
         return self._create_user(email, password, **extra_fields)
 
 
-class User(AbstractBaseUser, PermissionsMixin):
+class User(VersionedModel, AbstractBaseUser, PermissionsMixin):
+    version_fields = ('version', 'read_version', 'token_version')
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     fcm_registration_token = models.CharField(max_length=255, blank=True, null=True)
     email = models.EmailField(unique=True)
@@ -51,11 +84,23 @@ class User(AbstractBaseUser, PermissionsMixin):
     groups = models.ManyToManyField(Group, related_name='members', blank=True)
     friends = models.ManyToManyField('self', blank=True)
     picture = models.ImageField(upload_to='user_profiles', null=True, blank=True)
+    picture_variants = models.JSONField(default=dict, blank=True)
+    # Bumped to revoke every signed token issued so far
+    token_version = models.PositiveIntegerField(default=0, editable=False)
+    # Bumped whenever the user's read markers move, version covers the
+    # profile and friends
+    read_version = models.PositiveIntegerField(default=0, editable=False)
 
     USERNAME_FIELD = 'username'
 
     objects = UserManager()
 
+    class Meta:
+        indexes = [
+            # Case insensitive prefix search, see search.ranked_users_fallback
+            models.Index(Lower('username'), name='user_username_lower'),
+        ]
+
     def __str__(self):
         return self.username
 
@@ -66,23 +111,217 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
         Token.objects.create(user=instance)
 
 
-class Conversation(models.Model):
+PREVIEW_LENGTH = 140
+
+
+class Conversation(VersionedModel):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     book_title = models.CharField(max_length=255)
     group = models.ForeignKey(Group, on_delete=models.CASCADE, related_name='conversations')
     picture = models.ImageField(upload_to='conversation_pictures', null=True, blank=True)
+    picture_variants = models.JSONField(default=dict, blank=True)
+    # Summary of the latest message, kept up to date by summaries.py so
+    # conversation lists don't have to read any messages
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default='')
+    last_sender_username = models.CharField(max_length=255, blank=True, default='')
+    message_count = models.PositiveIntegerField(default=0)
+    # How many of message_count have been moved out to the archive, see
+    # archive.py
+    archived_message_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', '-last_message_at'], name='conversation_activity'),
+        ]
 
     def __str__(self):
         return self.book_title
 
 
 class Message(models.Model):
+    # Messages may live in a shard apart from users and conversations, see
+    # shards.py, so the database can't enforce the foreign keys
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
-    sender = models.ForeignKey(User, on_delete=models.CASCADE)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     sender_username = models.TextField()
-    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE)
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, db_constraint=False)
     text = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation', 'created_at', 'id'], name='message_conversation_keyset'),
+        ]
+
     def __str__(self):
         return f"{self.sender.username}: {self.text}"
+
+
+class ReadMarker(models.Model):
+    """
+    How far a user has read a conversation, as the conversation's
+    message_count at that point.  Unread count is the difference.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='read_markers')
+    read_count = models.PositiveIntegerField(default=0)
+    read_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'conversation'], name='readmarker_user_conversation'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.read_count} of {self.conversation_id}"
+
+
+class ChangeEvent(models.Model):
+    """
+    Append only log of changes clients need to hear about.  The autoincrement
+    id doubles as the sync cursor, see sync.settled_events for what that
+    assumes.  Pruned after SYNC_EVENT_RETENTION_DAYS by prune_change_events,
+    and only then: events outlive the groups and users they name, as
+    sync.check_cursor takes every missing id for a pruned one.
+    """
+    MESSAGE = 'message'
+    CONVERSATION = 'conversation'
+    MEMBER_ADDED = 'member_added'
+    MEMBER_REMOVED = 'member_removed'
+    PROFILE = 'profile'
+    KIND_CHOICES = [
+        (MESSAGE, 'Message'),
+        (CONVERSATION, 'Conversation'),
+        (MEMBER_ADDED, 'Member added'),
+        (MEMBER_REMOVED, 'Member removed'),
+        (PROFILE, 'Profile'),
+    ]
+
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    group = models.ForeignKey(
+        Group, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True, related_name='+'
+    )
+    user = models.ForeignKey(
+        User, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True, related_name='+'
+    )
+    object_id = models.UUIDField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['group', 'id'], name='changeevent_group_id'),
+            models.Index(fields=['user', 'id'], name='changeevent_user_id'),
+        ]
+
+    def __str__(self):
+        return f"{self.id}: {self.kind}"
+
+
+class PushOutbox(models.Model):
+    """
+    Push notifications waiting to be sent.  Rows are written in the same
+    transaction as the change that caused them and drained by the dispatcher
+    in notifications.py, so a slow FCM never holds up a request.
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, null=True, blank=True, related_name='+')
+    title = models.CharField(max_length=255)
+    body = models.CharField(max_length=255)
+    tokens = models.JSONField(null=True, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='pushoutbox_due'),
+        ]
+
+    def __str__(self):
+        return f"{self.id}: {self.title} ({self.status})"
+
+
+# Saving any of these changes what a user's profile looks like, the
+# variants built after an upload included
+PROFILE_FIELDS = {'username', 'email', 'picture', 'picture_variants'}
+
+# Sent with the saved ChangeEvent rows whenever record_events writes some
+events_recorded = Signal()
+
+
+def record_events(events):
+    events = ChangeEvent.objects.bulk_create(events)
+    events_recorded.send(sender=ChangeEvent, events=events)
+    return events
+
+
+@receiver(post_save, sender=Message)
+def record_message_event(sender, instance=None, created=False, **kwargs):
+    if created:
+        record_events([ChangeEvent(
+            kind=ChangeEvent.MESSAGE,
+            group_id=instance.conversation.group_id,
+            user_id=instance.sender_id,
+            object_id=instance.id
+        )])
+
+
+@receiver(post_save, sender=Conversation)
+def record_conversation_event(sender, instance=None, created=False, **kwargs):
+    if created:
+        record_events([ChangeEvent(kind=ChangeEvent.CONVERSATION, group_id=instance.group_id, object_id=instance.id)])
+
+
+@receiver(post_save, sender=User)
+def record_profile_event(sender, instance=None, created=False, update_fields=None, **kwargs):
+    if created:
+        return
+    if update_fields is not None and not PROFILE_FIELDS.intersection(update_fields):
+        return
+    if update_fields is not None and set(update_fields) == {'picture'}:
+        # An upload, whose event is recorded once its variants are saved,
+        # see pictures.replace_picture
+        return
+    record_events([ChangeEvent(kind=ChangeEvent.PROFILE, user=instance)])
+
+
+@receiver(post_delete, sender=Conversation)
+def delete_sharded_conversation_messages(sender, instance=None, **kwargs):
+    # Cascades only reach the database being deleted from
+    if is_sharded():
+        Message.objects.filter(conversation=instance.pk).delete()
+
+
+@receiver(post_delete, sender=User)
+def delete_sharded_user_messages(sender, instance=None, **kwargs):
+    if is_sharded():
+        for messages in Message.objects.filter(sender=instance.pk).per_shard():
+            messages.delete()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def record_membership_events(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+    kind = ChangeEvent.MEMBER_ADDED if action == 'post_add' else ChangeEvent.MEMBER_REMOVED
+    if reverse:
+        pairs = [(instance.pk, user_id) for user_id in pk_set]
+    else:
+        pairs = [(group_id, instance.pk) for group_id in pk_set]
+    record_events([
+        ChangeEvent(kind=kind, group_id=group_id, user_id=user_id) for group_id, user_id in pairs
+    ])
@@ -0,0 +1,212 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from .models import PushOutbox
+import logging
+
+User = get_user_model()
+
+logger = logging.getLogger('django')
+
+MULTICAST_LIMIT = 500
+CLAIM_BATCH_SIZE = 100
+CLAIM_LEASE_SECONDS = 60
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 600
+MAX_ATTEMPTS = 8
+PRUNE_BATCH_SIZE = 5000
+
+# FCM error codes that will fail the same way every time, so retrying the
+# token is pointless
+PERMANENT_ERROR_CODES = {'NOT_FOUND', 'INVALID_ARGUMENT', 'PERMISSION_DENIED', 'UNREGISTERED'}
+
+NEW_MESSAGE_TITLE = "New Message(s)"
+NEW_MESSAGE_BODY = "You have new messages!"
+
+_executor = None
+
+
+def enqueue_message_notification(conversation):
+    """
+    Queue the new message push for a conversation.  Call inside the
+    transaction that saves the message.
+    """
+    PushOutbox.objects.create(conversation=conversation, title=NEW_MESSAGE_TITLE, body=NEW_MESSAGE_BODY)
+    if getattr(settings, 'PUSH_DISPATCH_IN_PROCESS', False):
+        transaction.on_commit(dispatch_in_background)
+
+
+def enqueue_batch_notification(conversations):
+    """
+    Queue a single push covering several conversations, so every member of
+    any of their groups is notified once however many messages arrived
+    """
+    tokens = member_tokens({conversation.group_id for conversation in conversations})
+    if not tokens:
+        return
+    PushOutbox.objects.create(title=NEW_MESSAGE_TITLE, body=NEW_MESSAGE_BODY, tokens=tokens)
+    if getattr(settings, 'PUSH_DISPATCH_IN_PROCESS', False):
+        transaction.on_commit(dispatch_in_background)
+
+
+def dispatch_in_background():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='push-dispatch')
+    _executor.submit(_dispatch_and_close)
+
+
+def _dispatch_and_close():
+    try:
+        dispatch_pending()
+    except Exception:
+        logger.exception("Push dispatch failed")
+    finally:
+        close_old_connections()
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS))
+
+
+def claim_due(limit=CLAIM_BATCH_SIZE):
+    """
+    Take a lease on due rows so that concurrent dispatchers (several gunicorn
+    workers, or a worker and the management command) never send a row twice.
+    """
+    now = timezone.now()
+    due = PushOutbox.objects.filter(
+        status=PushOutbox.PENDING,
+        next_attempt_at__lte=now
+    ).order_by('next_attempt_at').values_list('id', 'next_attempt_at')[:limit]
+
+    lease = now + timedelta(seconds=CLAIM_LEASE_SECONDS)
+    claimed = []
+    for row_id, next_attempt_at in due:
+        taken = PushOutbox.objects.filter(
+            id=row_id,
+            status=PushOutbox.PENDING,
+            next_attempt_at=next_attempt_at
+        ).update(next_attempt_at=lease)
+        if taken:
+            claimed.append(row_id)
+    return list(PushOutbox.objects.filter(id__in=claimed).select_related('conversation').order_by('id'))
+
+
+def member_tokens(group_ids):
+    return list(
+        User.objects.filter(groups__in=group_ids)
+        .exclude(fcm_registration_token__isnull=True)
+        .exclude(fcm_registration_token='')
+        .values_list('fcm_registration_token', flat=True)
+        .distinct()
+    )
+
+
+def resolve_tokens(row):
+    if row.tokens is not None:
+        return row.tokens
+    if row.conversation is None:
+        return []
+    return member_tokens([row.conversation.group_id])
+
+
+def send_multicast(messaging, title, body, tokens):
+    """
+    Send to tokens in chunks FCM accepts and return the tokens worth retrying
+    """
+    send = getattr(messaging, 'send_each_for_multicast', None) or messaging.send_multicast
+    retry = []
+    for start in range(0, len(tokens), MULTICAST_LIMIT):
+        chunk = tokens[start:start + MULTICAST_LIMIT]
+        message = messaging.MulticastMessage(
+            notification=messaging.Notification(
+                title=title,
+                body=body
+            ),
+            tokens=chunk
+        )
+        try:
+            batch = send(message)
+        except Exception as e:
+            logger.warning(f"Push multicast of {len(chunk)} tokens failed: {e}")
+            retry.extend(chunk)
+            continue
+
+        for token, response in zip(chunk, batch.responses):
+            if response.success:
+                continue
+            code = getattr(response.exception, 'code', None)
+            if code not in PERMANENT_ERROR_CODES:
+                retry.append(token)
+    return retry
+
+
+def dispatch_pending(messaging=None, limit=CLAIM_BATCH_SIZE):
+    """
+    Send one batch of due outbox rows and return how many rows were handled.
+
+    Rows for the same conversation with the same title and body are
+    coalesced so each device gets one push per conversation per batch
+    however many messages arrived.  Tokens that fail with a
+    transient error are kept on the first row of the group and retried with
+    exponential backoff.
+    """
+    if messaging is None:
+        from firebase_admin import messaging
+
+    rows = claim_due(limit)
+    if not rows:
+        return 0
+
+    grouped = {}
+    for row in rows:
+        grouped.setdefault((row.conversation_id, row.title, row.body), []).append(row)
+
+    now = timezone.now()
+    for (_, title, body), group_rows in grouped.items():
+        tokens = list(dict.fromkeys(token for row in group_rows for token in resolve_tokens(row)))
+        retry = send_multicast(messaging, title, body, tokens) if tokens else []
+
+        head, rest = group_rows[0], group_rows[1:]
+        PushOutbox.objects.filter(id__in=[row.id for row in rest]).update(status=PushOutbox.SENT, sent_at=now)
+
+        if not retry:
+            head.status = PushOutbox.SENT
+            head.sent_at = now
+            head.save(update_fields=['status', 'sent_at'])
+            continue
+
+        head.tokens = retry
+        head.attempts += 1
+        head.last_error = f"{len(retry)} of {len(tokens)} tokens failed"
+        if head.attempts >= MAX_ATTEMPTS:
+            head.status = PushOutbox.FAILED
+            logger.error(f"Giving up on push {head.id} after {head.attempts} attempts")
+        else:
+            head.next_attempt_at = now + retry_delay(head.attempts)
+        head.save(update_fields=['tokens', 'attempts', 'last_error', 'status', 'next_attempt_at'])
+
+    return len(rows)
+
+
+def prune_outbox(older_than_days=None, batch_size=PRUNE_BATCH_SIZE):
+    """
+    Delete sent and failed rows last tried more than older_than_days ago,
+    PUSH_OUTBOX_RETENTION_DAYS by default, in batches.  Pending rows are
+    never deleted.  Returns how many were deleted.
+    """
+    if older_than_days is None:
+        older_than_days = settings.PUSH_OUTBOX_RETENTION_DAYS
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    # By the status index, next_attempt_at being when the row was last claimed
+    done = PushOutbox.objects.filter(status__in=[PushOutbox.SENT, PushOutbox.FAILED], next_attempt_at__lt=cutoff)
+    deleted = 0
+    while True:
+        ids = list(done.values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += PushOutbox.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,91 @@
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from .shards import MessageQuerySet
+import base64
+import json
+import uuid
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(created_at, pk):
+    """
+    Opaque cursor for a row's position in (created_at, id) order
+    """
+    payload = json.dumps([created_at.isoformat(), str(pk)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, pk = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        parsed = parse_datetime(created_at)
+        if parsed is None:
+            raise InvalidCursor(cursor)
+        return parsed, uuid.UUID(pk)
+    except (ValueError, TypeError, UnicodeError):
+        raise InvalidCursor(cursor)
+
+
+def parse_limit(value, default=DEFAULT_PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    if value in (None, ''):
+        return default
+    limit = int(value)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return min(limit, maximum)
+
+
+def keyset_page(queryset, limit, before=None, after=None):
+    """
+    Return one page of queryset in newest first order and whether more rows
+    exist past it in the direction of travel.
+
+    before walks back into older rows, after walks forward to newer ones.  Both
+    filter on (created_at, id) so the index on those columns turns every page
+    into a bounded range scan no matter how deep into the history it is.
+    Messages from several shards are paged on each and merged.
+    """
+    if after is not None:
+        created_at, pk = decode_cursor(after)
+        queryset = queryset.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk)
+        ).order_by('created_at', 'id')
+    else:
+        if before is not None:
+            created_at, pk = decode_cursor(before)
+            queryset = queryset.filter(
+                Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+            )
+        queryset = queryset.order_by('-created_at', '-id')
+
+    querysets = queryset.per_shard() if isinstance(queryset, MessageQuerySet) else [queryset]
+    rows = [row for part in querysets for row in part[:limit + 1]]
+    if len(querysets) > 1:
+        rows.sort(key=lambda row: (row.created_at, row.id), reverse=after is None)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after is not None:
+        rows.reverse()
+    return rows, has_more
+
+
+def page_cursors(rows, has_more, after=None):
+    """
+    Cursors a client sends back to continue from a newest first page
+    """
+    if not rows:
+        return {'before_cursor': None, 'after_cursor': after}
+
+    newest, oldest = rows[0], rows[-1]
+    older_exists = has_more if after is None else True
+    return {
+        'before_cursor': encode_cursor(oldest.created_at, oldest.id) if older_exists else None,
+        'after_cursor': encode_cursor(newest.created_at, newest.id),
+    }
@@ -0,0 +1,30 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+import msgpack
+import uuid
+
+# Raw picture bytes keep their type even when they happen to be 16 long
+BINARY_KEYS = {'picture'}
+
+
+def from_wire(value, key=None):
+    """
+    Turn the 16 byte binary UUIDs MessagePack clients send back into UUIDs
+    """
+    if isinstance(value, dict):
+        return {item_key: from_wire(item, item_key) for item_key, item in value.items()}
+    if isinstance(value, list):
+        return [from_wire(item, key) for item in value]
+    if isinstance(value, bytes) and len(value) == 16 and key not in BINARY_KEYS:
+        return uuid.UUID(bytes=value)
+    return value
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return from_wire(msgpack.unpackb(stream.read(), raw=False))
+        except ValueError as exc:
+            raise ParseError(f'MessagePack parse error - {exc}')
@@ -0,0 +1,138 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from .images import PICTURE_FORMATS, render_variants
+import logging
+import multiprocessing
+import os
+
+logger = logging.getLogger('django')
+
+_executor = None
+_process_pool = None
+
+
+def process_workers():
+    return getattr(settings, 'PICTURE_PROCESS_WORKERS', 2)
+
+
+def variant_name(name, suffix, extension):
+    """
+    Variants sit next to the original, user_profiles/user_<id>.jpg gets
+    user_profiles/user_<id>_128.webp and so on
+    """
+    root = os.path.splitext(name)[0]
+    return f"{root}_{suffix}.{extension}"
+
+
+def schedule_picture_variants(instance):
+    """
+    Re-encode instance.picture and build its resized variants once the
+    current transaction commits.  The request never waits on Pillow.
+    """
+    model, pk, name = type(instance), instance.pk, instance.picture.name
+    transaction.on_commit(lambda: submit_picture_variants(model, pk, name))
+
+
+def replace_picture(instance, filename, content):
+    """
+    Save content as instance.picture and schedule its variants.  The file
+    it replaces is deleted once the transaction commits, its variants when
+    the new ones are built.  A user's profile event is only recorded by
+    that later save, so sync clients see the picture once, with variants.
+    """
+    previous = instance.picture.name
+    instance.picture.save(filename, content, save=False)
+    instance.save(update_fields=['picture'])
+    schedule_picture_variants(instance)
+    if previous and previous != instance.picture.name:
+        storage = instance.picture.storage
+        transaction.on_commit(lambda: storage.delete(previous))
+
+
+def submit_picture_variants(model, pk, name):
+    if process_workers() == 0:
+        build_picture_variants(model, pk, name)
+        return
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=process_workers(), thread_name_prefix='picture-variants')
+    _executor.submit(_build_and_close, model, pk, name)
+
+
+def _build_and_close(model, pk, name):
+    try:
+        build_picture_variants(model, pk, name, render=render_in_pool)
+    except Exception:
+        logger.exception(f"Building variants of {name} failed")
+    finally:
+        close_old_connections()
+
+
+def render_in_pool(data):
+    # Resizing is CPU bound, so it runs in separate processes rather than
+    # holding the GIL in a server worker.  Spawned, not forked, so the
+    # children don't inherit the server's threads and connections.
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=process_workers(),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return _process_pool.submit(render_variants, data).result()
+
+
+def build_picture_variants(model, pk, name, render=render_variants):
+    """
+    Overwrite the uploaded picture with a metadata free JPEG under the same
+    name, so the URL handed out on upload keeps working, and store its
+    square variants in every format.  A picture that can't be decoded is
+    left as uploaded, without variants.  Does nothing if the picture was
+    replaced again in the meantime.
+    """
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None or instance.picture.name != name:
+        return
+    storage = instance.picture.storage
+
+    with storage.open(name, 'rb') as picture_file:
+        data = picture_file.read()
+    try:
+        full, variants = render(data)
+    except Exception as e:
+        # The previous picture's variants still go, and the save still
+        # tells clients the picture changed
+        logger.warning(f"Could not re-encode {name}: {e}")
+        full, variants = None, {}
+
+    saved = {}
+    for image_format, sizes in variants.items():
+        extension = PICTURE_FORMATS[image_format]
+        saved[image_format] = {
+            size: storage.save(variant_name(name, size, extension), ContentFile(content))
+            for size, content in sizes.items()
+        }
+    new_names = [variant for sizes in saved.values() for variant in sizes.values()]
+
+    with transaction.atomic():
+        current = model.objects.select_for_update().filter(pk=pk).first()
+        if current is None or current.picture.name != name:
+            for new_name in new_names:
+                storage.delete(new_name)
+            return
+        old_variants = current.picture_variants
+        update_fields = ['picture_variants']
+        if full is not None:
+            storage.delete(name)
+            # Only another upload racing for the freed name can move it
+            full_name = storage.save(name, ContentFile(full))
+            if full_name != name:
+                current.picture.name = full_name
+                update_fields.append('picture')
+        current.picture_variants = saved
+        current.save(update_fields=update_fields)
+
+    for sizes in old_variants.values():
+        for old_name in sizes.values():
+            storage.delete(old_name)
@@ -0,0 +1,222 @@
+"""
+Profiles of single requests, for finding where a slow endpoint spends its
+time.  A staff user asks for one with an X-Profile header, and
+PROFILE_SAMPLE_RATE profiles that fraction of all requests.  Each profile
+is written to PROFILE_DIR as
+
+    <name>.prof      cProfile stats, for pstats or snakeviz, or
+    <name>.folded    sampled stacks in the collapsed format flamegraph.pl
+                     and speedscope read
+    <name>.json      the request, its status and duration and every SQL
+                     query it ran
+
+and its name is returned in the X-Profile-Id header.  Without PROFILE_DIR
+the middleware removes itself when the server starts.
+"""
+from asgiref.sync import iscoroutinefunction
+from contextlib import ExitStack
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+from django.utils.deprecation import MiddlewareMixin
+from .authentication import user_for_token
+import cProfile
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+logger = logging.getLogger('django')
+
+PSTATS = 'pstats'
+COLLAPSED = 'collapsed'
+FORMATS = (PSTATS, COLLAPSED)
+
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+def profile_dir():
+    return getattr(settings, 'PROFILE_DIR', None)
+
+
+def sample_rate():
+    return getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+
+
+def default_format():
+    return getattr(settings, 'PROFILE_FORMAT', PSTATS)
+
+
+def sample_interval():
+    return getattr(settings, 'PROFILE_SAMPLE_INTERVAL', DEFAULT_SAMPLE_INTERVAL)
+
+
+def parameter_count(params, many):
+    if params is None:
+        return 0
+    if many:
+        params = next(iter(params), ())
+    return len(params)
+
+
+class QueryLog:
+    """
+    connection.execute_wrapper keeping each query's SQL and time.  Only the
+    number of parameters is kept, never their values, which hold tokens,
+    password hashes and message text.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'database': context['connection'].alias,
+                'sql': sql,
+                'param_count': parameter_count(params, many),
+                'many': many,
+                'seconds': time.perf_counter() - start,
+            })
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', code.co_filename)}:{code.co_name}"
+
+
+class StackSampler:
+    """
+    Records a thread's stack every interval from a second thread.  Only
+    sees the thread when it gives up the GIL, so intervals much below
+    sys.getswitchinterval() don't add samples.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                names.append(frame_name(frame))
+                frame = frame.f_back
+            if names:
+                stack = ';'.join(reversed(names))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+def requested_format(request):
+    """
+    The format a staff user asked for with X-Profile, or None
+    """
+    value = request.headers.get('X-Profile')
+    if not value:
+        return None
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        # Token clients only authenticate inside the DRF view
+        keyword, _, key = request.headers.get('Authorization', '').partition(' ')
+        user = user_for_token(key.strip()) if keyword == 'Token' and key else None
+    if user is None or not user.is_staff:
+        return None
+    value = value.strip().lower()
+    return value if value in FORMATS else default_format()
+
+
+def profile_view(request, view_func, view_args, view_kwargs, output_format):
+    name = f"{timezone.now():%Y%m%dT%H%M%S}-{request.resolver_match.view_name}-{uuid.uuid4().hex[:8]}"
+    log = QueryLog()
+
+    def call_view():
+        response = view_func(request, *view_args, **view_kwargs)
+        # DRF serializes when the response is rendered, after the view
+        # returns, so render here to have that in the profile too
+        if hasattr(response, 'render') and callable(response.render):
+            response.render()
+        return response
+
+    start = time.perf_counter()
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(log))
+        if output_format == COLLAPSED:
+            sampler = stack.enter_context(StackSampler(threading.get_ident(), sample_interval()))
+            response = call_view()
+        else:
+            profiler = cProfile.Profile()
+            response = profiler.runcall(call_view)
+    seconds = time.perf_counter() - start
+
+    directory = profile_dir()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        if output_format == COLLAPSED:
+            with open(os.path.join(directory, f"{name}.folded"), 'w') as output:
+                output.write(sampler.collapsed())
+        else:
+            profiler.dump_stats(os.path.join(directory, f"{name}.prof"))
+        with open(os.path.join(directory, f"{name}.json"), 'w') as output:
+            json.dump({
+                'route': request.resolver_match.view_name,
+                'method': request.method,
+                'path': request.path,
+                'status': response.status_code,
+                'seconds': seconds,
+                'format': output_format,
+                'queries': log.queries,
+            }, output, indent=2)
+    except OSError:
+        logger.exception(f"Writing profile {name} failed")
+        return response
+    response['X-Profile-Id'] = name
+    return response
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """
+    Runs the view under the profiler from process_view, so the profile is
+    taken on the thread the view runs on.  Async views aren't profiled.
+    Goes last in MIDDLEWARE, as the process_view of any middleware after
+    it is skipped for profiled requests.
+    """
+
+    def __init__(self, get_response):
+        if not profile_dir():
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if iscoroutinefunction(view_func):
+            return None
+        output_format = requested_format(request)
+        if output_format is None:
+            rate = sample_rate()
+            if not rate or random.random() >= rate:
+                return None
+            output_format = default_format()
+        return profile_view(request, view_func, view_args, view_kwargs, output_format)
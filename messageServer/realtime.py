@@ -0,0 +1,212 @@
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.dispatch import receiver
+from rest_framework.utils.encoders import JSONEncoder
+from .models import ChangeEvent, Conversation, Message, events_recorded
+from .serializers import ConversationSerializer, MessageSerializer
+from .sync import visible_events
+import asyncio
+import collections
+import json
+import logging
+import uuid
+
+logger = logging.getLogger('django')
+
+HEARTBEAT_SECONDS = 15
+STREAM_MAX_SECONDS = 30 * 60
+RECONNECT_MILLISECONDS = 3000
+REPLAY_BATCH_SIZE = 500
+# Ids each client remembers to drop repeats by.  Events reach it from
+# separate transactions and processes, so not in id order.
+RECENT_EVENT_IDS = 1024
+
+# Profile edits are left to sync, everything else is pushed live
+LIVE_KINDS = {
+    ChangeEvent.MESSAGE,
+    ChangeEvent.CONVERSATION,
+    ChangeEvent.MEMBER_ADDED,
+    ChangeEvent.MEMBER_REMOVED,
+}
+MEMBERSHIP_KINDS = {ChangeEvent.MEMBER_ADDED, ChangeEvent.MEMBER_REMOVED}
+
+
+def group_channel(group_id):
+    return f"group.{group_id.hex}"
+
+
+def user_channel(user_id):
+    return f"user.{user_id.hex}"
+
+
+def event_channels(event):
+    channels = [group_channel(event.group_id)]
+    if event.kind in MEMBERSHIP_KINDS:
+        channels.append(user_channel(event.user_id))
+    return channels
+
+
+def _plain(data):
+    # Channel layers that cross processes can't carry UUIDs or datetimes, so
+    # encode exactly as the JSON renderer would
+    return json.loads(json.dumps(data, cls=JSONEncoder))
+
+
+def event_payloads(events):
+    """
+    Client facing form of each event, loading the messages and conversations
+    they point at in one query per kind
+    """
+    message_ids = [e.object_id for e in events if e.kind == ChangeEvent.MESSAGE]
+    conversation_ids = [e.object_id for e in events if e.kind == ChangeEvent.CONVERSATION]
+    messages = {m.id: m for m in Message.objects.filter(id__in=message_ids).gather()} if message_ids else {}
+    conversations = {c.id: c for c in Conversation.objects.filter(id__in=conversation_ids)} if conversation_ids else {}
+
+    payloads = []
+    for event in events:
+        payload = {'id': event.id, 'type': event.kind}
+        if event.kind == ChangeEvent.MESSAGE:
+            if event.object_id not in messages:
+                continue
+            payload['messages'] = [MessageSerializer(messages[event.object_id]).data]
+        elif event.kind == ChangeEvent.CONVERSATION:
+            if event.object_id not in conversations:
+                continue
+            payload['conversations'] = [ConversationSerializer(conversations[event.object_id]).data]
+        else:
+            payload['group'] = event.group_id
+            payload['user'] = event.user_id
+        payloads.append((event, _plain(payload)))
+    return payloads
+
+
+def publish_events(events):
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    send = async_to_sync(layer.group_send)
+    for event, payload in event_payloads(events):
+        for channel in event_channels(event):
+            try:
+                send(channel, {'type': 'change.event', 'event': payload})
+            except Exception:
+                logger.exception(f"Could not publish event {event.id} to {channel}")
+
+
+@receiver(events_recorded)
+def publish_on_commit(sender, events=None, **kwargs):
+    live = [event for event in events if event.kind in LIVE_KINDS]
+    if live:
+        transaction.on_commit(lambda: publish_events(live))
+
+
+@database_sync_to_async
+def member_group_ids(user):
+    return list(user.groups.values_list('id', flat=True))
+
+
+class EventSubscription:
+    """
+    Channel layer subscriptions for one connected client.  Follows the user
+    in and out of groups as their membership events arrive.
+    """
+
+    def __init__(self, layer, channel_name, user):
+        self.layer = layer
+        self.channel_name = channel_name
+        self.user = user
+        self.subscriptions = set()
+        self.recent = collections.deque(maxlen=RECENT_EVENT_IDS)
+        self.seen = set()
+
+    async def start(self):
+        await self.subscribe(user_channel(self.user.id))
+        for group_id in await member_group_ids(self.user):
+            await self.subscribe(group_channel(group_id))
+
+    async def close(self):
+        for channel in list(self.subscriptions):
+            await self.unsubscribe(channel)
+
+    async def subscribe(self, channel):
+        if channel not in self.subscriptions:
+            self.subscriptions.add(channel)
+            await self.layer.group_add(channel, self.channel_name)
+
+    async def unsubscribe(self, channel):
+        if channel in self.subscriptions:
+            self.subscriptions.discard(channel)
+            await self.layer.group_discard(channel, self.channel_name)
+
+    async def accept(self, event):
+        """
+        Return whether event should go to the client
+        """
+        # Membership changes for this user arrive on both the group and the
+        # user channel, and a replay can overlap live events
+        if event['id'] in self.seen:
+            return False
+        if len(self.recent) == self.recent.maxlen:
+            self.seen.discard(self.recent[0])
+        self.recent.append(event['id'])
+        self.seen.add(event['id'])
+
+        if event['type'] in MEMBERSHIP_KINDS and event['user'] == str(self.user.id):
+            channel = group_channel(uuid.UUID(event['group']))
+            if event['type'] == ChangeEvent.MEMBER_ADDED:
+                await self.subscribe(channel)
+            else:
+                await self.unsubscribe(channel)
+        return True
+
+
+@database_sync_to_async
+def replay_batch(user, since, limit=REPLAY_BATCH_SIZE):
+    events = list(visible_events(user, since).filter(kind__in=LIVE_KINDS)[:limit])
+    last_id = events[-1].id if events else since
+    return [payload for _, payload in event_payloads(events)], last_id, len(events) == limit
+
+
+def sse_frame(event):
+    data = json.dumps(event, separators=(',', ':'))
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+
+
+async def sse_stream(user, last_event_id=0):
+    """
+    Server-sent event frames for user: a replay of anything missed since
+    last_event_id, then live events with a comment line as a heartbeat while
+    idle.  Ends after STREAM_MAX_SECONDS and lets the client reconnect, so
+    streams from vanished clients don't pile up.
+    """
+    layer = get_channel_layer()
+    channel_name = await layer.new_channel()
+    subscription = EventSubscription(layer, channel_name, user)
+    await subscription.start()
+    try:
+        yield f"retry: {RECONNECT_MILLISECONDS}\n\n"
+
+        # Subscribed before replaying so nothing committed in between is lost,
+        # accept() drops whatever shows up on both paths
+        more = bool(last_event_id)
+        while more:
+            payloads, last_event_id, more = await replay_batch(user, last_event_id)
+            for event in payloads:
+                if await subscription.accept(event):
+                    yield sse_frame(event)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STREAM_MAX_SECONDS
+        while loop.time() < deadline:
+            try:
+                message = await asyncio.wait_for(layer.receive(channel_name), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            event = message.get('event')
+            if event and await subscription.accept(event):
+                yield sse_frame(event)
+    finally:
+        await subscription.close()
@@ -0,0 +1,105 @@
+from datetime import datetime, timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_datetime
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+import msgpack
+import uuid
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Keys whose string values are UUIDs or times in serializer output, sent
+# in their compact binary form over MessagePack
+UUID_KEYS = {'id', 'sender', 'conversation', 'group', 'user', 'object_id'}
+TIME_KEY_SUFFIX = '_at'
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def vary_on_accept(renderer_context):
+    # The same URL renders as JSON or MessagePack, so caches have to key on
+    # Accept as well
+    response = (renderer_context or {}).get('response')
+    if response is not None:
+        patch_vary_headers(response, ('Accept',))
+
+
+def epoch_milliseconds(value):
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - EPOCH) // (datetime.resolution * 1000)
+
+
+def to_wire(value, key=None):
+    """
+    value with UUIDs as 16 raw bytes and times as integer milliseconds since
+    the epoch.  Strings are only converted under the keys serializers use
+    for them, so message text that looks like a UUID stays text.
+    """
+    if isinstance(value, dict):
+        return {item_key: to_wire(item, item_key) for item_key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_wire(item, key) for item in value]
+    if isinstance(value, uuid.UUID):
+        return value.bytes
+    if isinstance(value, datetime):
+        return epoch_milliseconds(value)
+    if isinstance(value, str) and key is not None:
+        if key in UUID_KEYS:
+            try:
+                return uuid.UUID(value).bytes
+            except ValueError:
+                return value
+        if key.endswith(TIME_KEY_SUFFIX):
+            parsed = parse_datetime(value)
+            if parsed is not None:
+                return epoch_milliseconds(parsed)
+    return value
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that produces the same bytes through orjson when it is
+    installed.  Anything orjson can't take on its own (dates, Decimals, lazy
+    strings) goes through DRF's encoder, and anything it rejects outright,
+    or an indented render for the browsable API, falls back to the stock
+    renderer.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        vary_on_accept(renderer_context)
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(
+                data,
+                default=self.encoder_class().default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME
+            )
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # Escaped by JSONRenderer so the output is also valid JavaScript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    MessagePack for clients that send Accept: application/msgpack, with the
+    same structure as the JSON but UUIDs and times in binary form
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        vary_on_accept(renderer_context)
+        if data is None:
+            return b''
+        return msgpack.packb(to_wire(data), use_bin_type=True, default=str)
@@ -0,0 +1,124 @@
+"""
+Read replicas for the heavy GET views.  Views wrapped in read_from_replica
+read from one of DATABASE_REPLICAS, everything else, and every write, goes
+to the default database.  A user who has just written something reads from
+the primary for REPLICA_STICKY_SECONDS afterwards, so they always see their
+own writes however far behind the replicas are.
+"""
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.deprecation import MiddlewareMixin
+from rest_framework.permissions import SAFE_METHODS
+import contextvars
+import functools
+import random
+
+DEFAULT_STICKY_SECONDS = 5
+
+# Alias reads go to while a replica view runs, None everywhere else
+_read_alias = contextvars.ContextVar('read_alias', default=None)
+
+
+def replica_aliases():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+
+
+def _sticky_key(user_id):
+    return f"replicas.sticky.{user_id}"
+
+
+def stick_to_primary(user_id):
+    cache.set(_sticky_key(user_id), True, sticky_seconds())
+
+
+def is_stuck_to_primary(user_id):
+    return cache.get(_sticky_key(user_id), False)
+
+
+def choose_replica(user):
+    """
+    Replica alias to read from for user, or None to read from the primary
+    """
+    aliases = replica_aliases()
+    if not aliases:
+        return None
+    if user is not None and user.is_authenticated and is_stuck_to_primary(user.pk):
+        return None
+    return random.choice(aliases)
+
+
+def read_from_replica(view):
+    """
+    Send the view's reads to a replica.  Goes below @permission_classes so
+    the user is already authenticated, against the primary, when it runs.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        alias = choose_replica(getattr(request, 'user', None))
+        if alias is None:
+            return view(request, *args, **kwargs)
+        token = _read_alias.set(alias)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _read_alias.reset(token)
+    return wrapper
+
+
+class ReplicaRouter:
+    """
+    Reads go to the replica chosen by read_from_replica, if any.  Writes
+    always go to the primary, even for instances loaded from a replica.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def cache_is_shared():
+    """
+    Whether the default cache is seen by every server process, as the
+    sticky marks have to be
+    """
+    return not isinstance(caches['default'], (LocMemCache, DummyCache))
+
+
+class ReplicaStickinessMiddleware(MiddlewareMixin):
+    """
+    Sticks users to the primary after any successful unsafe request they
+    make.  The marks live in the default cache, so with replicas set up a
+    worker refuses to start unless that cache is shared between processes.
+    """
+
+    def __init__(self, get_response):
+        if replica_aliases() and not cache_is_shared():
+            raise ImproperlyConfigured(
+                'DATABASE_REPLICAS needs a CACHES default shared between processes, such as '
+                'Redis or files, for users to read their own writes'
+            )
+        super().__init__(get_response)
+
+    def process_response(self, request, response):
+        if not replica_aliases() or request.method in SAFE_METHODS or response.status_code >= 400:
+            return response
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            stick_to_primary(user.pk)
+        return response
@@ -0,0 +1,420 @@
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, connections, router
+from django.db.models import Case, Exists, IntegerField, OuterRef, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Concat, Lower
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from .models import Conversation, Message
+import html
+import itertools
+import logging
+
+User = get_user_model()
+
+logger = logging.getLogger('django')
+
+USER_INDEX_TABLE = 'messageserver_user_search'
+MESSAGE_INDEX_TABLE = 'messageserver_message_search'
+USER_INDEX_COLUMNS = ['username', 'user_id']
+MESSAGE_INDEX_COLUMNS = ['text', 'message_id', 'conversation_id', 'group_id']
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 50
+
+# The trigram tokenizer can only match queries of at least three characters
+TRIGRAM_LENGTH = 3
+# Sorts after every other character, closing prefix ranges
+LAST_CHARACTER = '\U0010ffff'
+
+_fts5_available = {}
+
+
+def fts5_available(using='default'):
+    """
+    Whether the database can hold FTS5 trigram tables.  Needs SQLite 3.34 or
+    later built with FTS5, anything else falls back to plain queries.
+    """
+    if using not in _fts5_available:
+        connection = connections[using]
+        available = False
+        if connection.vendor == 'sqlite':
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x, tokenize='trigram')")
+                    cursor.execute("DROP TABLE temp.fts5_probe")
+                available = True
+            except DatabaseError:
+                pass
+        _fts5_available[using] = available
+    return _fts5_available[using]
+
+
+def index_table_exists(using, table):
+    with connections[using].cursor() as cursor:
+        return table in connections[using].introspection.table_names(cursor)
+
+
+def rowid_table(table):
+    return f"{table}_rowid"
+
+
+def write_index_rows(cursor, table, columns, rows):
+    """
+    Insert or replace rows of an FTS5 table, each holding the id of the
+    object it indexes in its second column.  FTS5 keys rows by integer, so
+    every object id is given one in the table's rowid map first.
+    """
+    map_table = rowid_table(table)
+    cursor.executemany(f"INSERT OR IGNORE INTO {map_table}(object_id) VALUES (%s)", [(row[1],) for row in rows])
+    cursor.executemany(
+        f"INSERT OR REPLACE INTO {table}(rowid, {', '.join(columns)}) "
+        f"VALUES ((SELECT id FROM {map_table} WHERE object_id = %s), {', '.join(['%s'] * len(columns))})",
+        [(row[1], *row) for row in rows]
+    )
+
+
+def delete_index_row(cursor, table, object_id):
+    map_table = rowid_table(table)
+    cursor.execute(f"DELETE FROM {table} WHERE rowid = (SELECT id FROM {map_table} WHERE object_id = %s)", [object_id])
+    cursor.execute(f"DELETE FROM {map_table} WHERE object_id = %s", [object_id])
+
+
+def clear_index(cursor, table):
+    cursor.execute(f"DELETE FROM {table}")
+    cursor.execute(f"DELETE FROM {rowid_table(table)}")
+
+
+def fts_phrase(query):
+    return '"' + query.replace('"', '""') + '"'
+
+
+def index_user(user, using='default'):
+    if not fts5_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        write_index_rows(cursor, USER_INDEX_TABLE, USER_INDEX_COLUMNS, [(user.username, user.id.hex)])
+
+
+def unindex_user(user, using='default'):
+    if not fts5_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        delete_index_row(cursor, USER_INDEX_TABLE, user.id.hex)
+
+
+def rebuild_user_index(using='default', batch_size=1000):
+    with connections[using].cursor() as cursor:
+        clear_index(cursor, USER_INDEX_TABLE)
+        batch = []
+        for user_id, username in User.objects.using(using).values_list('id', 'username').iterator(chunk_size=batch_size):
+            batch.append((username, user_id.hex))
+            if len(batch) >= batch_size:
+                write_index_rows(cursor, USER_INDEX_TABLE, USER_INDEX_COLUMNS, batch)
+                batch = []
+        if batch:
+            write_index_rows(cursor, USER_INDEX_TABLE, USER_INDEX_COLUMNS, batch)
+
+
+def message_row(message, group_id):
+    return (message.text, message.id.hex, message.conversation_id.hex, group_id.hex)
+
+
+def message_group_ids(messages):
+    """
+    Group of each message's conversation, loading the conversations that
+    aren't cached in one query.  A sharded message can't join to them.
+    """
+    missing = {message.conversation_id for message in messages if not Message.conversation.is_cached(message)}
+    loaded = dict(Conversation.objects.filter(id__in=missing).values_list('id', 'group_id')) if missing else {}
+    return [
+        message.conversation.group_id if Message.conversation.is_cached(message) else loaded[message.conversation_id]
+        for message in messages
+    ]
+
+
+def index_messages(messages, using=None):
+    """
+    Add messages to the text index of using, or of the database each was
+    saved to.  post_save covers single saves, callers that bulk_create have
+    to call this themselves.
+    """
+    if using is None:
+        by_database = {}
+        for message in messages:
+            by_database.setdefault(message._state.db or 'default', []).append(message)
+        for using, database_messages in by_database.items():
+            index_messages(database_messages, using)
+        return
+    if not fts5_available(using) or not messages:
+        return
+    index_message_rows(
+        [message_row(message, group_id) for message, group_id in zip(messages, message_group_ids(messages))], using
+    )
+
+
+def index_message_rows(rows, using='default'):
+    """
+    Add message_row tuples to the text index of using
+    """
+    with connections[using].cursor() as cursor:
+        write_index_rows(cursor, MESSAGE_INDEX_TABLE, MESSAGE_INDEX_COLUMNS, rows)
+
+
+def unindex_message(message, using='default'):
+    if not fts5_available(using):
+        return
+    with connections[using].cursor() as cursor:
+        delete_index_row(cursor, MESSAGE_INDEX_TABLE, message.id.hex)
+
+
+def rebuild_message_index(using='default', batch_size=1000):
+    """
+    Refill the message index from the Message table and return how many
+    messages it holds.  Messages whose conversation is gone, which the
+    database doesn't prevent once they're sharded, are left out.
+    """
+    count = 0
+    orphans = 0
+    with connections[using].cursor() as cursor:
+        clear_index(cursor, MESSAGE_INDEX_TABLE)
+        messages = Message.objects.using(using).only('id', 'text', 'conversation_id').iterator(chunk_size=batch_size)
+        while batch := list(itertools.islice(messages, batch_size)):
+            group_ids = dict(
+                Conversation.objects.filter(id__in={message.conversation_id for message in batch})
+                .values_list('id', 'group_id')
+            )
+            rows = [
+                message_row(message, group_ids[message.conversation_id])
+                for message in batch if message.conversation_id in group_ids
+            ]
+            orphans += len(batch) - len(rows)
+            if rows:
+                write_index_rows(cursor, MESSAGE_INDEX_TABLE, MESSAGE_INDEX_COLUMNS, rows)
+            count += len(rows)
+    if orphans:
+        logger.warning(f"Left {orphans} message(s) without a conversation out of the {using} search index")
+    return count
+
+
+def create_search_indexes(using='default'):
+    """
+    Create whichever index tables and rowid maps are missing, and fill the
+    indexes that were
+    """
+    indexes = [
+        (USER_INDEX_TABLE, "fts5(username, user_id UNINDEXED, tokenize='trigram')", rebuild_user_index),
+        (MESSAGE_INDEX_TABLE, (
+            "fts5(text, message_id UNINDEXED, conversation_id UNINDEXED, group_id UNINDEXED, "
+            "tokenize='unicode61 remove_diacritics 2')"
+        ), rebuild_message_index),
+    ]
+    for table, definition, rebuild in indexes:
+        missing = False
+        with connections[using].cursor() as cursor:
+            if not index_table_exists(using, table):
+                cursor.execute(f"CREATE VIRTUAL TABLE {table} USING {definition}")
+                missing = True
+            if not index_table_exists(using, rowid_table(table)):
+                cursor.execute(
+                    f"CREATE TABLE {rowid_table(table)} (id INTEGER PRIMARY KEY, object_id TEXT NOT NULL UNIQUE)"
+                )
+                missing = True
+        if missing:
+            rebuild(using)
+
+
+@receiver(post_migrate)
+def create_search_indexes_after_migrate(sender, using='default', **kwargs):
+    if sender.name == 'messageServer' and fts5_available(using):
+        create_search_indexes(using)
+
+
+@receiver(post_save, sender=User)
+def update_user_index(sender, instance=None, created=False, update_fields=None, using='default', **kwargs):
+    if created or update_fields is None or 'username' in update_fields:
+        index_user(instance, using)
+
+
+@receiver(post_delete, sender=User)
+def remove_user_index(sender, instance=None, using='default', **kwargs):
+    unindex_user(instance, using)
+
+
+@receiver(post_save, sender=Message)
+def update_message_index(sender, instance=None, created=False, update_fields=None, using='default', **kwargs):
+    if created or update_fields is None or 'text' in update_fields:
+        index_messages([instance], using)
+
+
+@receiver(post_delete, sender=Message)
+def remove_message_index(sender, instance=None, using='default', **kwargs):
+    unindex_message(instance, using)
+
+
+def parse_search_page(limit, offset):
+    limit = DEFAULT_SEARCH_LIMIT if limit in (None, '') else int(limit)
+    offset = 0 if offset in (None, '') else int(offset)
+    if limit < 1 or offset < 0:
+        raise ValueError('limit must be positive and offset not negative')
+    return min(limit, MAX_SEARCH_LIMIT), offset
+
+
+def ranked_user_ids_fts(query, searcher, limit, offset):
+    """
+    Matches from the trigram index ordered exact, then prefix, then
+    substring, with the searcher's friends first within each tier.  Only
+    rows that contain the query are touched, however many users there are.
+    """
+    friends_table = User.friends.through._meta.db_table
+    lowered = query.lower()
+    sql = f"""
+        SELECT s.user_id,
+               CASE WHEN lower(s.username) = %s THEN 0
+                    WHEN substr(lower(s.username), 1, %s) = %s THEN 1
+                    ELSE 2 END AS match_rank,
+               EXISTS (SELECT 1 FROM {friends_table} f
+                       WHERE f.from_user_id = %s AND f.to_user_id = s.user_id) AS is_friend
+        FROM {USER_INDEX_TABLE} s
+        WHERE s.username MATCH %s AND s.user_id != %s
+        ORDER BY match_rank, is_friend DESC, s.username
+        LIMIT %s OFFSET %s
+    """
+    params = [lowered, len(lowered), lowered, searcher.id.hex, fts_phrase(query), searcher.id.hex, limit, offset]
+    # Raw SQL skips the router, so ask it which database reads go to
+    with connections[router.db_for_read(User)].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def username_prefix(query):
+    """
+    Usernames starting with query, any case, as a range on the lowercased
+    username index rather than a LIKE that reads every user
+    """
+    prefix = Lower(Value(query))
+    return User.objects.alias(username_lower=Lower('username')).filter(
+        username_lower__gte=prefix, username_lower__lt=Concat(prefix, Value(LAST_CHARACTER))
+    )
+
+
+def ranked_users_fallback(query, searcher):
+    """
+    Same ranking as the index without it.  Queries shorter than a trigram
+    only match on prefix so a one letter typeahead doesn't match everyone.
+    """
+    if len(query) >= TRIGRAM_LENGTH:
+        users = User.objects.filter(username__icontains=query)
+    else:
+        users = username_prefix(query)
+    friends = User.friends.through.objects.filter(from_user=searcher, to_user=OuterRef('pk'))
+    return users.exclude(id=searcher.id).annotate(
+        match_rank=Case(
+            When(username__iexact=query, then=Value(0)),
+            When(username__istartswith=query, then=Value(1)),
+            default=Value(2),
+            output_field=IntegerField()
+        ),
+        is_friend=Exists(friends)
+    ).order_by('match_rank', '-is_friend', 'username')
+
+
+def find_users(query, searcher, limit=DEFAULT_SEARCH_LIMIT, offset=0):
+    """
+    One page of users matching query and whether another page follows
+    """
+    if len(query) >= TRIGRAM_LENGTH and fts5_available():
+        ids = ranked_user_ids_fts(query, searcher, limit + 1, offset)
+        has_more = len(ids) > limit
+        ids = ids[:limit]
+        by_id = {user.id.hex: user for user in User.objects.filter(id__in=ids)}
+        return [by_id[user_id] for user_id in ids if user_id in by_id], has_more
+
+    users = list(ranked_users_fallback(query, searcher)[offset:offset + limit + 1])
+    return users[:limit], len(users) > limit
+
+
+def match_expression(query):
+    """
+    Every word of query as a quoted phrase, so user input is never read as
+    FTS5 syntax and all words have to appear
+    """
+    return ' '.join(fts_phrase(term) for term in query.split())
+
+
+def matching_messages(query, group_ids, conversation_id=None):
+    """
+    Messages in the given groups containing every word of query, as a
+    queryset ready for keyset paging
+    """
+    if not group_ids:
+        return Message.objects.none()
+
+    if not fts5_available():
+        # Ids rather than a join, which sharded messages couldn't make
+        if conversation_id is not None:
+            messages = Message.objects.filter(conversation=conversation_id)
+        else:
+            conversation_ids = list(Conversation.objects.filter(group__in=group_ids).values_list('id', flat=True))
+            messages = Message.objects.filter(conversation__in=conversation_ids)
+        for term in query.split():
+            messages = messages.filter(text__icontains=term)
+        return messages
+
+    placeholders = ', '.join(['%s'] * len(group_ids))
+    sql = f"SELECT message_id FROM {MESSAGE_INDEX_TABLE} WHERE text MATCH %s AND group_id IN ({placeholders})"
+    params = [match_expression(query)] + [group_id.hex for group_id in group_ids]
+    if conversation_id is not None:
+        sql += " AND conversation_id = %s"
+        params.append(conversation_id.hex)
+        # Repeated outside the raw SQL so it only runs on the one shard
+        return Message.objects.filter(id__in=RawSQL(sql, params), conversation=conversation_id)
+    return Message.objects.filter(id__in=RawSQL(sql, params))
+
+
+# Put around matches by FTS5 and swapped for <mark> tags once the rest of
+# the snippet is escaped.  Private use characters, so no message text
+# should hold them, and one that does only gains a stray <mark>.
+MATCH_START = '\ue000'
+MATCH_END = '\ue001'
+
+
+def highlight(snippet):
+    """
+    snippet as HTML, escaped apart from the <mark> tags around matches, so
+    it is safe to render however the message was written
+    """
+    return html.escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def message_snippets(query, messages):
+    """
+    Excerpt around the matches of each message as escaped HTML with the
+    matches in <mark> tags, keyed by id
+    """
+    if not messages:
+        return {}
+    if not fts5_available():
+        return {message.id: html.escape(message.text) for message in messages}
+
+    # Each message's snippet comes from the index beside it, which may be
+    # in a shard or a replica
+    by_database = {}
+    for message in messages:
+        by_database.setdefault(message._state.db, []).append(message)
+    snippets = {}
+    for using, database_messages in by_database.items():
+        placeholders = ', '.join(['%s'] * len(database_messages))
+        sql = (
+            f"SELECT message_id, snippet({MESSAGE_INDEX_TABLE}, 0, %s, %s, '…', 16) "
+            f"FROM {MESSAGE_INDEX_TABLE} WHERE text MATCH %s AND rowid IN "
+            f"(SELECT id FROM {rowid_table(MESSAGE_INDEX_TABLE)} WHERE object_id IN ({placeholders}))"
+        )
+        params = [MATCH_START, MATCH_END, match_expression(query)] + [message.id.hex for message in database_messages]
+        with connections[using].cursor() as cursor:
+            cursor.execute(sql, params)
+            snippets.update(cursor.fetchall())
+    return {
+        message.id: highlight(snippets[message.id.hex]) if message.id.hex in snippets else html.escape(message.text)
+        for message in messages
+    }
@@ -3,13 +3,30 @@ from rest_framework.authtoken.models import Token
 from .models import Message, Group, Conversation
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.utils import timezone
 import logging
+import uuid
 
 logger = logging.getLogger('django')
 
 User = get_user_model()
 
 
+def variant_urls(storage, variants):
+    return {
+        image_format: {size: "http://" + settings.SITE_URL + storage.url(name) for size, name in sizes.items()}
+        for image_format, sizes in variants.items()
+    }
+
+
+def picture_urls(instance):
+    """
+    URLs of the resized variants by format then size, empty until they
+    have been built
+    """
+    return variant_urls(instance.picture.storage, instance.picture_variants)
+
+
 class LoginSerializer(serializers.Serializer):
     username = serializers.CharField()
     password = serializers.CharField()
@@ -24,31 +41,69 @@ class TokenSerializer(serializers.ModelSerializer):
 
 class GroupSerializer(serializers.ModelSerializer):
     picture_url = serializers.SerializerMethodField()
+    picture_urls = serializers.SerializerMethodField()
 
     def get_picture_url(self, group):
         if group.picture:
             return "http://" + settings.SITE_URL + group.picture.url
         return None
 
+    def get_picture_urls(self, group):
+        return picture_urls(group)
+
     class Meta:
         model = Group
-        fields = ['id', 'name', 'picture_url']
+        fields = ['id', 'name', 'picture_url', 'picture_urls']
 
 
 class UserSerializer(serializers.ModelSerializer):
     picture_url = serializers.SerializerMethodField()
+    picture_urls = serializers.SerializerMethodField()
 
     def get_picture_url(self, user):
         if user.picture:
             return "http://" + settings.SITE_URL + user.picture.url
         return None
 
+    def get_picture_urls(self, user):
+        return picture_urls(user)
+
     class Meta:
         model = User
-        fields = ['id', 'email', 'username', 'picture_url']
+        fields = ['id', 'email', 'username', 'picture_url', 'picture_urls']
+
+
+def uuids_in(values):
+    """
+    The values that are UUIDs or UUID strings, as UUIDs
+    """
+    found = set()
+    for value in values:
+        try:
+            found.add(value if isinstance(value, uuid.UUID) else uuid.UUID(str(value)))
+        except ValueError:
+            continue
+    return found
+
+
+class PrefetchedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Takes the instance from context['prefetched'][model] when it's there,
+    so a list serializer checking many rows that point at the same few
+    objects doesn't look each one up again
+    """
+
+    def to_internal_value(self, data):
+        prefetched = self.context.get('prefetched', {}).get(self.get_queryset().model)
+        if prefetched:
+            for pk in uuids_in([data]):
+                if pk in prefetched:
+                    return prefetched[pk]
+        return super().to_internal_value(data)
 
 
 class MessageSerializer(serializers.ModelSerializer):
+    serializer_related_field = PrefetchedPrimaryKeyRelatedField
 
     class Meta:
         model = Message
@@ -73,15 +128,28 @@ class MessageSerializer(serializers.ModelSerializer):
 
 class ConversationSerializer(serializers.ModelSerializer):
     picture_url = serializers.SerializerMethodField()
+    picture_urls = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
 
     def get_picture_url(self, conversation):
         if conversation.picture:
             return "http://" + settings.SITE_URL + conversation.picture.url
         return None
 
+    def get_picture_urls(self, conversation):
+        return picture_urls(conversation)
+
+    def get_unread_count(self, conversation):
+        # Only lists annotated by summaries.conversations_by_activity know it
+        return getattr(conversation, 'unread_count', None)
+
     class Meta:
         model = Conversation
-        fields = ['id', 'book_title', 'group', 'picture_url']
+        fields = [
+            'id', 'book_title', 'group', 'picture_url', 'picture_urls',
+            'last_message_at', 'last_message_preview', 'last_sender_username', 'message_count', 'unread_count'
+        ]
+        read_only_fields = ['last_message_at', 'last_message_preview', 'last_sender_username', 'message_count']
 
 
     def create(self, validated_data):
@@ -95,3 +163,71 @@ class ConversationSerializer(serializers.ModelSerializer):
         )
 
         return conversation
+
+
+class GroupDetailSerializer(GroupSerializer):
+    """
+    A group with its conversations and members, for the bootstrap response.
+    Expects both to be prefetched.
+    """
+    conversations = ConversationSerializer(many=True, read_only=True)
+    members = UserSerializer(many=True, read_only=True)
+
+    class Meta(GroupSerializer.Meta):
+        fields = GroupSerializer.Meta.fields + ['conversations', 'members']
+
+
+"""
+Read only fast path for long lists.  Rows come straight from
+values_list(named=True) and are turned into the same dicts the serializers
+above produce, skipping the per field machinery of ModelSerializer.  Keep
+the fields in step with MessageSerializer and UserSerializer.
+"""
+
+MESSAGE_ROW_FIELDS = ('id', 'sender', 'sender_username', 'conversation', 'text', 'created_at')
+USER_ROW_FIELDS = ('id', 'email', 'username', 'picture', 'picture_variants')
+
+
+def format_datetime(value, tz):
+    # Same output as serializers.DateTimeField
+    value = value.astimezone(tz).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def message_values(queryset):
+    return queryset.values_list(*MESSAGE_ROW_FIELDS, named=True)
+
+
+def message_rows(rows):
+    tz = timezone.get_current_timezone()
+    return [
+        {
+            'id': str(row.id),
+            'sender': row.sender,
+            'sender_username': row.sender_username,
+            'conversation': row.conversation,
+            'text': row.text,
+            'created_at': format_datetime(row.created_at, tz),
+        }
+        for row in rows
+    ]
+
+
+def user_values(queryset):
+    return queryset.values_list(*USER_ROW_FIELDS, named=True)
+
+
+def user_rows(rows):
+    storage = User._meta.get_field('picture').storage
+    return [
+        {
+            'id': str(row.id),
+            'email': row.email,
+            'username': row.username,
+            'picture_url': "http://" + settings.SITE_URL + storage.url(row.picture) if row.picture else None,
+            'picture_urls': variant_urls(storage, row.picture_variants),
+        }
+        for row in rows
+    ]
@@ -0,0 +1,171 @@
+"""
+Message rows spread over the databases in MESSAGE_SHARDS by a hash of their
+conversation, so writers to different conversations don't queue on one
+lock and each shard's indexes stay small.  Everything else, conversations
+included, stays in the default database.  Without MESSAGE_SHARDS messages
+live there too and none of this changes anything.
+
+Filtering messages on a conversation, or saving one, goes to its shard on
+its own.  Lookups that can't be narrowed to a conversation, like by id,
+have to run on every shard through MessageQuerySet.per_shard or gather.
+"""
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, models, router, transaction
+import uuid
+import zlib
+
+MESSAGE_MODEL = 'messageServer.Message'
+CONVERSATION_MODEL = 'messageServer.Conversation'
+
+CONVERSATION_LOOKUPS = ('conversation', 'conversation_id', 'conversation__id', 'conversation__pk')
+
+
+def shard_aliases():
+    return getattr(settings, 'MESSAGE_SHARDS', [])
+
+
+def is_sharded():
+    return bool(shard_aliases())
+
+
+def shard_for(conversation_id):
+    """
+    Database holding the conversation's messages.  crc32 rather than hash()
+    so every process agrees.
+    """
+    aliases = shard_aliases()
+    if not aliases:
+        return DEFAULT_DB_ALIAS
+    return aliases[zlib.crc32(conversation_id.bytes) % len(aliases)]
+
+
+def _as_conversation_id(value):
+    # Expressions like OuterRef can't be resolved to a shard
+    if isinstance(value, models.Model):
+        return value.pk
+    if isinstance(value, uuid.UUID):
+        return value
+    if isinstance(value, str):
+        try:
+            return uuid.UUID(value)
+        except ValueError:
+            return None
+    return None
+
+
+def shard_for_lookup(kwargs):
+    """
+    The one shard a filter on conversation can match, or None if the
+    filter doesn't pin it down
+    """
+    for key in CONVERSATION_LOOKUPS:
+        if key in kwargs:
+            values = [kwargs[key]]
+        elif f'{key}__in' in kwargs and isinstance(kwargs[f'{key}__in'], (list, tuple, set, frozenset)):
+            values = kwargs[f'{key}__in']
+        else:
+            continue
+        conversation_ids = [_as_conversation_id(value) for value in values]
+        if not conversation_ids or None in conversation_ids:
+            return None
+        aliases = {shard_for(conversation_id) for conversation_id in conversation_ids}
+        return aliases.pop() if len(aliases) == 1 else None
+    return None
+
+
+class MessageQuerySet(models.QuerySet):
+
+    def filter(self, *args, **kwargs):
+        queryset = super().filter(*args, **kwargs)
+        if queryset._db is None and is_sharded():
+            alias = shard_for_lookup(kwargs)
+            if alias is not None:
+                queryset = queryset.using(alias)
+        return queryset
+
+    def create(self, **kwargs):
+        # create saves to the queryset's database, which the router can't
+        # place without the instance
+        if self._db is None and is_sharded():
+            alias = shard_for_lookup(kwargs)
+            if alias is not None:
+                return self.using(alias).create(**kwargs)
+        return super().create(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if self._db is not None or not is_sharded():
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        by_shard = {}
+        for obj in objs:
+            by_shard.setdefault(shard_for(obj.conversation_id), []).append(obj)
+        for alias, shard_objs in by_shard.items():
+            self.using(alias).bulk_create(shard_objs, *args, **kwargs)
+        return objs
+
+    def per_shard(self):
+        """
+        This queryset once for each shard, or just itself if it's already
+        bound to one database
+        """
+        if self._db is not None or not is_sharded():
+            return [self]
+        return [self.using(alias) for alias in shard_aliases()]
+
+    def gather(self):
+        """
+        Rows from every shard in one list, in no particular order across
+        shards
+        """
+        return [row for queryset in self.per_shard() for row in queryset]
+
+
+@contextmanager
+def atomic_for(conversation_ids):
+    """
+    transaction.atomic on the default database and on every shard holding
+    messages of the given conversations
+    """
+    with ExitStack() as stack:
+        stack.enter_context(transaction.atomic())
+        for alias in sorted({shard_for(conversation_id) for conversation_id in conversation_ids} - {DEFAULT_DB_ALIAS}):
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+class ShardRouter:
+    """
+    Messages go to their conversation's shard whenever Django passes the
+    message or conversation along, and whatever a message points at is
+    looked up outside the shards.  Goes first in DATABASE_ROUTERS.
+    """
+
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints, router.db_for_read)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints, router.db_for_write)
+
+    def _route(self, model, hints, route):
+        if not is_sharded():
+            return None
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if model._meta.label == MESSAGE_MODEL:
+            if instance._meta.label == MESSAGE_MODEL:
+                return shard_for(instance.conversation_id)
+            if instance._meta.label == CONVERSATION_MODEL:
+                return shard_for(instance.pk)
+            return None
+        if instance._meta.label == MESSAGE_MODEL:
+            # Without the instance hint the rest of the routers decide, as
+            # they would have if the shard weren't in the way
+            return route(model)
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded() and MESSAGE_MODEL in (obj1._meta.label, obj2._meta.label):
+            return True
+        return None
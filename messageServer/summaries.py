@@ -0,0 +1,150 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, ExpressionWrapper, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest, Substr
+from django.utils import timezone
+from .models import PREVIEW_LENGTH, Conversation, Group, Message, ReadMarker, User
+from .shards import is_sharded, shard_aliases
+from .versions import bump
+
+
+def record_conversation_activity(messages):
+    """
+    Fold newly saved messages into their conversations' summaries with one
+    UPDATE per conversation.  Call inside the transaction that saves them.
+    """
+    latest = {}
+    counts = {}
+    for message in messages:
+        conversation_id = message.conversation_id
+        counts[conversation_id] = counts.get(conversation_id, 0) + 1
+        if conversation_id not in latest or message.created_at >= latest[conversation_id].created_at:
+            latest[conversation_id] = message
+
+    for conversation_id, message in latest.items():
+        Conversation.objects.filter(pk=conversation_id).update(
+            last_message_at=message.created_at,
+            last_message_preview=message.text[:PREVIEW_LENGTH],
+            last_sender_username=message.sender_username,
+            message_count=F('message_count') + counts[conversation_id],
+            version=F('version') + 1
+        )
+    bump(Group.objects.filter(conversations__in=list(latest)), 'conversations_version')
+
+
+def read_count_through(message):
+    """
+    Position of message in its conversation, counting from one.  Archived
+    messages are all older than the ones left in the database.
+    """
+    archived = Conversation.objects.filter(pk=message.conversation_id).values_list('archived_message_count', flat=True)
+    return (archived.first() or 0) + Message.objects.filter(conversation=message.conversation_id).filter(
+        Q(created_at__lt=message.created_at) | Q(created_at=message.created_at, id__lte=message.id)
+    ).count()
+
+
+def mark_read(user_id, conversation_id, message=None):
+    """
+    Move the user's read marker up to message, or to the end of the
+    conversation.  Markers never move backwards.
+    """
+    if message is None:
+        read_count = Subquery(Conversation.objects.filter(pk=conversation_id).values('message_count')[:1])
+    else:
+        read_count = read_count_through(message)
+
+    now = timezone.now()
+    bump(User.objects.filter(pk=user_id), 'read_version')
+    markers = ReadMarker.objects.filter(user=user_id, conversation=conversation_id)
+    if markers.update(read_count=Greatest(F('read_count'), read_count), read_at=now):
+        return
+    try:
+        with transaction.atomic():
+            ReadMarker.objects.create(user_id=user_id, conversation_id=conversation_id, read_count=read_count, read_at=now)
+    except IntegrityError:
+        # Created by a concurrent request in the meantime
+        markers.update(read_count=Greatest(F('read_count'), read_count), read_at=now)
+
+
+def conversations_with_unread(user):
+    """
+    Conversations most recently active first, each annotated with how many
+    messages user hasn't read
+    """
+    read_count = ReadMarker.objects.filter(user=user, conversation=OuterRef('pk')).values('read_count')[:1]
+    return Conversation.objects.annotate(
+        unread_count=ExpressionWrapper(
+            F('message_count') - Coalesce(Subquery(read_count), Value(0)),
+            output_field=IntegerField()
+        )
+    ).order_by(F('last_message_at').desc(nulls_last=True), 'book_title')
+
+
+def conversations_by_activity(group_id, user):
+    return conversations_with_unread(user).filter(group=group_id)
+
+
+def rebuild_conversation_summaries():
+    """
+    Recompute every conversation's summary from its messages and return how
+    many conversations were updated.  Archived messages still count, and
+    the latest message is kept if all of them have been archived.
+    """
+    if is_sharded():
+        return rebuild_sharded_conversation_summaries()
+    messages = Message.objects.filter(conversation=OuterRef('pk'))
+    latest = messages.order_by('-created_at', '-id')
+    count = messages.order_by().values('conversation').annotate(count=Count('id')).values('count')
+    bump(Group.objects.all(), 'conversations_version')
+    archived = Q(archived_message_count__gt=0)
+    return Conversation.objects.update(
+        version=F('version') + 1,
+        message_count=Coalesce(Subquery(count), Value(0)) + F('archived_message_count'),
+        last_message_at=Case(
+            When(archived, then=Coalesce(Subquery(latest.values('created_at')[:1]), F('last_message_at'))),
+            default=Subquery(latest.values('created_at')[:1])
+        ),
+        last_message_preview=Coalesce(
+            Subquery(latest.annotate(preview=Substr('text', 1, PREVIEW_LENGTH)).values('preview')[:1]),
+            Case(When(archived, then=F('last_message_preview')), default=Value(''))
+        ),
+        last_sender_username=Coalesce(
+            Subquery(latest.values('sender_username')[:1]),
+            Case(When(archived, then=F('last_sender_username')), default=Value(''))
+        )
+    )
+
+
+def rebuild_sharded_conversation_summaries():
+    """
+    Same as rebuild_conversation_summaries when messages are in shards,
+    which the conversations can't join to.  Aggregates each shard and
+    writes the summaries back one conversation at a time.
+    """
+    summaries = {}
+    for alias in shard_aliases():
+        latest = Message.objects.using(alias).filter(conversation=OuterRef('conversation')).order_by('-created_at', '-id')
+        rows = Message.objects.using(alias).order_by().values('conversation').annotate(
+            count=Count('id'),
+            latest_id=Subquery(latest.values('id')[:1])
+        )
+        counts = {row['conversation']: (row['count'], row['latest_id']) for row in rows}
+        latest_messages = Message.objects.using(alias).in_bulk([latest_id for _, latest_id in counts.values()])
+        for conversation_id, (count, latest_id) in counts.items():
+            summaries[conversation_id] = (count, latest_messages[latest_id])
+
+    with transaction.atomic():
+        bump(Group.objects.all(), 'conversations_version')
+        updated = Conversation.objects.update(version=F('version') + 1, message_count=F('archived_message_count'))
+        Conversation.objects.filter(archived_message_count=0).update(
+            last_message_at=None,
+            last_message_preview='',
+            last_sender_username=''
+        )
+        for conversation_id, (count, message) in summaries.items():
+            Conversation.objects.filter(pk=conversation_id).update(
+                message_count=F('archived_message_count') + count,
+                last_message_at=message.created_at,
+                last_message_preview=message.text[:PREVIEW_LENGTH],
+                last_sender_username=message.sender_username
+            )
+    return updated
@@ -0,0 +1,165 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.checks import Warning, register
+from django.db import connections, router
+from django.db.models import Max, Min, Q
+from django.utils import timezone
+from .models import ChangeEvent, Conversation, Group, Message
+from .serializers import ConversationSerializer, GroupSerializer, MessageSerializer, UserSerializer
+import datetime
+
+User = get_user_model()
+
+MAX_SYNC_EVENTS = 500
+PRUNE_BATCH_SIZE = 5000
+
+GROUP_KINDS = [
+    ChangeEvent.MESSAGE,
+    ChangeEvent.CONVERSATION,
+    ChangeEvent.MEMBER_ADDED,
+    ChangeEvent.MEMBER_REMOVED,
+]
+MEMBERSHIP_KINDS = [ChangeEvent.MEMBER_ADDED, ChangeEvent.MEMBER_REMOVED]
+
+
+def parse_sync_cursor(value):
+    cursor = int(value)
+    if cursor < 0:
+        raise ValueError('cursor must not be negative')
+    return cursor
+
+
+class CursorExpired(Exception):
+    """
+    The events after a sync cursor have been pruned, so the client has to
+    bootstrap again
+    """
+
+
+def settle_seconds():
+    return getattr(settings, 'SYNC_SETTLE_SECONDS', 0)
+
+
+def settled_events():
+    """
+    Events safe to hand out as the sync cursor moves past them.  Ids are
+    given out on insert but become visible on commit, so a cursor may only
+    pass an id once every lower one has committed.  SQLite takes one writer
+    at a time, which commits them in id order.  Elsewhere events younger
+    than SYNC_SETTLE_SECONDS, longer than any write transaction, are held
+    back.
+    """
+    events = ChangeEvent.objects.all()
+    if settle_seconds():
+        events = events.filter(created_at__lte=timezone.now() - datetime.timedelta(seconds=settle_seconds()))
+    return events
+
+
+def head_cursor():
+    return settled_events().aggregate(head=Max('id'))['head'] or 0
+
+
+def check_cursor(since):
+    """
+    Raise CursorExpired if events after since were pruned.  prune_events
+    always keeps the newest event and nothing else deletes any, so every id
+    below the oldest left is one that was pruned.
+    """
+    oldest = ChangeEvent.objects.aggregate(oldest=Min('id'))['oldest']
+    if oldest is not None and since < oldest - 1:
+        raise CursorExpired(since)
+
+
+def prune_events(older_than_days=None, batch_size=PRUNE_BATCH_SIZE):
+    """
+    Delete events older than older_than_days, SYNC_EVENT_RETENTION_DAYS by
+    default, in batches.  Returns how many were deleted.
+    """
+    if older_than_days is None:
+        older_than_days = settings.SYNC_EVENT_RETENTION_DAYS
+    newest = ChangeEvent.objects.aggregate(newest=Max('id'))['newest']
+    if newest is None:
+        return 0
+    cutoff = timezone.now() - datetime.timedelta(days=older_than_days)
+    deleted = 0
+    while True:
+        ids = list(
+            ChangeEvent.objects.filter(id__lt=newest, created_at__lt=cutoff).order_by('id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        if not ids:
+            return deleted
+        deleted += ChangeEvent.objects.filter(id__in=ids).delete()[0]
+
+
+@register()
+def check_commit_order(app_configs, **kwargs):
+    using = router.db_for_write(ChangeEvent)
+    if connections[using].vendor != 'sqlite' and not settle_seconds():
+        return [Warning(
+            'Sync cursors assume change events commit in id order, which only SQLite guarantees.',
+            hint='Set SYNC_SETTLE_SECONDS to longer than any write transaction.',
+            id='messageServer.W001',
+        )]
+    return []
+
+
+def visible_events(user, since):
+    """
+    Events after since that user is allowed to see: anything in their groups,
+    their own membership changes (so removals reach them), and profile
+    changes of friends and fellow group members.
+    """
+    group_ids = list(user.groups.values_list('id', flat=True))
+    # Straight from the membership and friendship tables, each by its
+    # index, rather than an OR across a join to users that reads all of them
+    fellow_members = User.groups.through.objects.filter(group__in=group_ids).values('user')
+    friends = User.friends.through.objects.filter(from_user=user).values('to_user')
+
+    return settled_events().filter(id__gt=since).filter(
+        Q(group__in=group_ids, kind__in=GROUP_KINDS) |
+        Q(user=user, kind__in=MEMBERSHIP_KINDS) |
+        Q(kind=ChangeEvent.PROFILE, user__in=fellow_members) |
+        Q(kind=ChangeEvent.PROFILE, user__in=friends)
+    ).order_by('id')
+
+
+def changes_since(user, since, limit=MAX_SYNC_EVENTS):
+    check_cursor(since)
+    events = list(visible_events(user, since)[:limit + 1])
+    has_more = len(events) > limit
+    events = events[:limit]
+
+    message_ids = []
+    conversation_ids = []
+    joined_group_ids = []
+    profile_ids = []
+    memberships = []
+    for event in events:
+        if event.kind == ChangeEvent.MESSAGE:
+            message_ids.append(event.object_id)
+        elif event.kind == ChangeEvent.CONVERSATION:
+            conversation_ids.append(event.object_id)
+        elif event.kind == ChangeEvent.PROFILE:
+            profile_ids.append(event.user_id)
+        else:
+            added = event.kind == ChangeEvent.MEMBER_ADDED
+            memberships.append({'group': event.group_id, 'user': event.user_id, 'added': added})
+            if added and event.user_id == user.id:
+                joined_group_ids.append(event.group_id)
+
+    messages = Message.objects.filter(id__in=message_ids).gather() if message_ids else []
+    messages.sort(key=lambda message: (message.created_at, message.id))
+    conversations = Conversation.objects.filter(id__in=conversation_ids) if conversation_ids else []
+    groups = Group.objects.filter(id__in=joined_group_ids) if joined_group_ids else []
+    users = User.objects.filter(id__in=profile_ids) if profile_ids else []
+
+    return {
+        'messages': MessageSerializer(messages, many=True).data,
+        'conversations': ConversationSerializer(conversations, many=True).data,
+        'groups': GroupSerializer(groups, many=True).data,
+        'memberships': memberships,
+        'users': UserSerializer(users, many=True).data,
+        'cursor': str(events[-1].id if events else since),
+        'has_more': has_more,
+    }
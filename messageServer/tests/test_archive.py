@@ -0,0 +1,136 @@
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+import datetime
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from messageServer.archive import ArchivedMessage, append_segment, conversation_dir
+from messageServer.models import Conversation, Group, Message
+from messageServer.serializers import MESSAGE_ROW_FIELDS
+from messageServer.summaries import rebuild_conversation_summaries
+
+User = get_user_model()
+
+
+class ArchiveTests(APITestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        settings_override = override_settings(MESSAGE_ARCHIVE_ROOT=self.root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=self.user)
+        self.group = Group.objects.create(name='test group')
+        self.group.members.add(self.user)
+        self.conversation = Conversation.objects.create(book_title='test conversation', group=self.group)
+
+        # Five old messages a day apart, then two recent ones
+        now = timezone.now()
+        for i in range(7):
+            message = Message.objects.create(
+                sender=self.user, sender_username='chondosha', conversation=self.conversation, text=f'message {i}'
+            )
+            age = datetime.timedelta(days=100 - i) if i < 5 else datetime.timedelta(minutes=10 - i)
+            Message.objects.filter(pk=message.pk).update(created_at=now - age)
+        Conversation.objects.filter(pk=self.conversation.pk).update(message_count=7)
+
+    def archive(self, **options):
+        out = io.StringIO()
+        call_command('archive_messages', older_than_days=30, batch_size=2, stdout=out, **options)
+        return out.getvalue()
+
+    def walk_back(self, limit):
+        url = reverse('get_messages', args=[self.conversation.id])
+        texts = []
+        response = self.client.get(url, {'limit': limit})
+        texts += [m['text'] for m in response.data['messages']]
+        while response.data['before_cursor']:
+            response = self.client.get(url, {'limit': limit, 'before': response.data['before_cursor']})
+            texts += [m['text'] for m in response.data['messages']]
+        return texts
+
+    def test_archives_old_messages_into_segments(self):
+        output = self.archive()
+
+        self.assertIn('Archived 5 message(s) from 1 conversation(s)', output)
+        self.assertEqual(Message.objects.count(), 2)
+        with open(os.path.join(conversation_dir(self.conversation.id), 'index.json')) as index_file:
+            index = json.load(index_file)
+        self.assertEqual(index['message_count'], 5)
+        self.assertEqual([segment['count'] for segment in index['segments']], [2, 2, 1])
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.archived_message_count, 5)
+
+    def test_get_messages_pages_into_archive(self):
+        before = self.walk_back(limit=3)
+        self.archive()
+
+        self.assertEqual(self.walk_back(limit=3), before)
+        self.assertEqual(before, [f'message {i}' for i in reversed(range(7))])
+
+    def test_archived_rows_match_database_rows(self):
+        url = reverse('get_messages', args=[self.conversation.id])
+        before = self.client.get(url, {'limit': 10}).data['messages']
+        self.archive()
+
+        self.assertEqual(self.client.get(url, {'limit': 10}).data['messages'], before)
+
+    def test_after_cursor_walks_forward_out_of_archive(self):
+        url = reverse('get_messages', args=[self.conversation.id])
+        oldest = self.client.get(url, {'limit': 7}).data['messages'][-1]
+        self.archive()
+
+        response = self.client.get(url, {'limit': 1, 'before': self.client.get(url, {'limit': 6}).data['before_cursor']})
+        self.assertEqual(response.data['messages'][0]['text'], oldest['text'])
+        response = self.client.get(url, {'limit': 3, 'after': response.data['after_cursor']})
+
+        self.assertEqual([m['text'] for m in response.data['messages']], ['message 3', 'message 2', 'message 1'])
+        response = self.client.get(url, {'limit': 3, 'after': response.data['after_cursor']})
+        self.assertEqual([m['text'] for m in response.data['messages']], ['message 6', 'message 5', 'message 4'])
+
+    def test_repeated_run_does_not_duplicate(self):
+        # A run that stopped after writing its first segment but before
+        # deleting the messages in it
+        oldest = Message.objects.filter(conversation=self.conversation).order_by('created_at', 'id')
+        rows = [ArchivedMessage(*row) for row in oldest.values_list(*MESSAGE_ROW_FIELDS)[:2]]
+        append_segment(self.conversation.id, rows)
+
+        self.archive()
+
+        self.assertEqual(self.walk_back(limit=10), [f'message {i}' for i in reversed(range(7))])
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.archived_message_count, 5)
+
+    def test_unread_and_summaries_count_archived_messages(self):
+        self.archive()
+        newest = Message.objects.order_by('created_at').first()
+
+        response = self.client.post(
+            reverse('mark_conversation_read', args=[self.conversation.id]), {'messageId': str(newest.id)}, format='json'
+        )
+        self.assertEqual(response.data['conversations'][0]['unread_count'], 1)
+
+        Conversation.objects.filter(pk=self.conversation.pk).update(message_count=0)
+        rebuild_conversation_summaries()
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 7)
+        self.assertEqual(self.conversation.last_message_preview, 'message 6')
+
+    def test_deleting_conversation_deletes_archive(self):
+        self.archive()
+        directory = conversation_dir(self.conversation.id)
+        self.assertTrue(os.path.isdir(directory))
+
+        self.conversation.delete()
+
+        self.assertFalse(os.path.exists(directory))
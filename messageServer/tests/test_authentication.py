@@ -1,8 +1,16 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 from django.http import HttpRequest
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+from unittest.mock import patch
+import time
 
-from messageServer.authentication import CustomAuthenticationBackend
+from messageServer.authentication import (
+    CustomAuthenticationBackend, SignedTokenAuthentication, issue_signed_token, user_cache
+)
 
 User = get_user_model()
 
@@ -44,3 +52,82 @@ class GetUserTest(TestCase):
 
     def test_returns_None_if_no_user_with_email(self):
         self.assertIsNone(CustomAuthenticationBackend().get_user('chondosha'))
+
+
+class SignedTokenTest(TestCase):
+
+    def setUp(self):
+        user_cache.clear()
+        self.user = User.objects.create(username="chondosha", email="user1234@example.org")
+        self.user.set_password('chondosha5563')
+        self.user.save()
+        self.client = APIClient()
+
+    def login(self, **extra):
+        data = {'username': 'chondosha', 'password': 'chondosha5563', **extra}
+        response = self.client.post(reverse('login'), data, format='json')
+        self.assertEqual(response.status_code, 200)
+        return response.data['token']['key']
+
+    def get_current_user(self, key):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+        return self.client.get(reverse('get_current_user'))
+
+    def test_login_issues_signed_token_on_request(self):
+        key = self.login(token_type='signed')
+
+        self.assertIn(':', key)
+        response = self.get_current_user(key)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['users'][0]['username'], 'chondosha')
+
+    def test_table_tokens_still_work(self):
+        key = self.login()
+
+        self.assertEqual(key, Token.objects.get(user=self.user).key)
+        self.assertEqual(self.get_current_user(key).status_code, 200)
+
+    def test_authenticates_from_cache_without_queries(self):
+        key, _ = issue_signed_token(self.user)
+        SignedTokenAuthentication().authenticate_credentials(key)
+
+        with self.assertNumQueries(0):
+            user, auth = SignedTokenAuthentication().authenticate_credentials(key)
+        self.assertEqual(user, self.user)
+        self.assertEqual(auth, key)
+
+    @override_settings(SIGNED_TOKEN_USER_CACHE_SIZE=0)
+    def test_works_without_cache(self):
+        key, _ = issue_signed_token(self.user)
+
+        with self.assertNumQueries(1):
+            user, _ = SignedTokenAuthentication().authenticate_credentials(key)
+        self.assertEqual(user, self.user)
+
+    def test_rejects_tampered_token(self):
+        key, _ = issue_signed_token(self.user)
+        other = User.objects.create(username="other_guy", email="other@example.org")
+
+        forged = key.replace(self.user.id.hex, other.id.hex)
+        with self.assertRaises(AuthenticationFailed):
+            SignedTokenAuthentication().authenticate_credentials(forged)
+
+    @override_settings(SIGNED_TOKEN_MAX_AGE_SECONDS=60)
+    def test_rejects_expired_token(self):
+        key, _ = issue_signed_token(self.user)
+
+        with patch('django.core.signing.time.time', return_value=time.time() + 120):
+            with self.assertRaisesMessage(AuthenticationFailed, 'expired'):
+                SignedTokenAuthentication().authenticate_credentials(key)
+
+    def test_logout_revokes_signed_tokens(self):
+        key = self.login(token_type='signed')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+
+        response = self.client.post(reverse('logout'))
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.get_current_user(key).status_code, 401)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.token_version, 1)
+        self.assertEqual(self.get_current_user(self.login(token_type='signed')).status_code, 200)
@@ -0,0 +1,174 @@
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+import gzip
+import json
+import zlib
+
+from messageServer.compression import CompressionMiddleware, GzipCodec, choose_codec, compression_exempt
+from messageServer.models import Group, Conversation, Message
+
+User = get_user_model()
+
+
+class NamedCodec:
+
+    def __init__(self, name):
+        self.name = name
+
+
+class NegotiationTest(SimpleTestCase):
+    codecs = [NamedCodec('zstd'), NamedCodec('br'), NamedCodec('gzip')]
+
+    def chosen(self, header):
+        codec = choose_codec(header, self.codecs)
+        return codec.name if codec else None
+
+    def test_prefers_server_order_on_ties(self):
+        self.assertEqual(self.chosen('gzip, deflate, br, zstd'), 'zstd')
+        self.assertEqual(self.chosen('gzip, br'), 'br')
+
+    def test_respects_quality(self):
+        self.assertEqual(self.chosen('zstd;q=0.5, gzip'), 'gzip')
+        self.assertEqual(self.chosen('*;q=0.1, br;q=0'), 'zstd')
+        self.assertIsNone(self.chosen('gzip;q=0'))
+        self.assertIsNone(self.chosen('identity'))
+        self.assertIsNone(self.chosen(''))
+
+
+@override_settings(COMPRESSION_MIN_BYTES=100)
+class CompressionMiddlewareTest(SimpleTestCase):
+
+    def process(self, response, accept='gzip'):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_compresses_large_json(self):
+        body = json.dumps({'messages': ['hello'] * 100}).encode()
+        response = self.process(HttpResponse(body, content_type='application/json'))
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.content), body)
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+
+    def test_leaves_small_and_unaccepted_responses_alone(self):
+        small = self.process(HttpResponse(b'{}', content_type='application/json'))
+        self.assertFalse(small.has_header('Content-Encoding'))
+
+        body = json.dumps({'messages': ['hello'] * 100}).encode()
+        response = self.process(HttpResponse(body, content_type='application/json'), accept='identity')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, body)
+
+        image = self.process(HttpResponse(b'\xff' * 500, content_type='image/jpeg'))
+        self.assertFalse(image.has_header('Content-Encoding'))
+
+    def test_leaves_exempt_responses_alone(self):
+        body = json.dumps({'messages': ['hello'] * 100}).encode()
+        view = compression_exempt(lambda request: HttpResponse(body, content_type='application/json'))
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+
+        response = CompressionMiddleware(view)(request)
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, body)
+
+    def test_weakens_etag(self):
+        response = HttpResponse(b'x' * 500, content_type='application/json')
+        response['ETag'] = '"g3"'
+        self.assertEqual(self.process(response)['ETag'], 'W/"g3"')
+
+    def test_streams_each_chunk_as_it_comes(self):
+        chunks = [b'data: first\n\n', b'data: second\n\n']
+        response = self.process(StreamingHttpResponse(iter(chunks), content_type='text/event-stream'))
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        decompressor = zlib.decompressobj(31)
+        compressed = iter(response.streaming_content)
+        self.assertEqual(decompressor.decompress(next(compressed)), chunks[0])
+        self.assertEqual(decompressor.decompress(next(compressed)), chunks[1])
+        self.assertEqual(decompressor.decompress(b''.join(compressed)), b'')
+        self.assertTrue(decompressor.eof)
+
+
+class CompressedRequestTest(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=self.user)
+        group = Group.objects.create(name='test group')
+        self.conversation = Conversation.objects.create(book_title='test conversation', group=group)
+
+    def post_batch(self, body, encoding='gzip'):
+        return self.client.generic(
+            'POST', reverse('send_message_batch'), body,
+            content_type='application/json', HTTP_CONTENT_ENCODING=encoding
+        )
+
+    def test_accepts_gzipped_batch(self):
+        messages = [
+            {'sender': str(self.user.id), 'sender_username': 'chondosha',
+             'conversation': str(self.conversation.id), 'text': f'message {i}'}
+            for i in range(20)
+        ]
+        body = GzipCodec(6).compress(json.dumps({'messages': messages}).encode())
+
+        response = self.post_batch(body)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Message.objects.count(), 20)
+
+    def test_rejects_unknown_encoding(self):
+        response = self.post_batch(b'anything', encoding='compress')
+        self.assertEqual(response.status_code, 415)
+        self.assertIn('gzip', response['Accept-Encoding'])
+
+    def test_rejects_corrupt_body(self):
+        response = self.post_batch(b'not gzip at all')
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(COMPRESSION_MAX_REQUEST_BYTES=1024 * 1024)
+    def test_rejects_body_that_inflates_too_far(self):
+        response = self.post_batch(gzip.compress(b' ' * (8 * 1024 * 1024)))
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(Message.objects.count(), 0)
+
+
+@override_settings(COMPRESSION_MIN_BYTES=0)
+class TokenResponseTest(APITestCase):
+
+    def test_login_is_never_compressed(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        user.set_password('password')
+        user.save()
+
+        for token_type in ('stored', 'signed'):
+            response = self.client.post(
+                reverse('login'), {'username': 'chondosha', 'password': 'password', 'token_type': token_type},
+                format='json', HTTP_ACCEPT_ENCODING='gzip'
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertIn('key', json.loads(response.content)['token'])
+
+
+class CompressedEventStreamTest(TestCase):
+
+    async def test_event_stream_is_compressed_and_flushed(self):
+        user = await User.objects.acreate(email="chondosha@example.com", username="chondosha")
+        token = await Token.objects.aget(user=user)
+
+        response = await self.async_client.get(
+            reverse('events'),
+            headers={'Authorization': f'Token {token.key}', 'Accept-Encoding': 'gzip'}
+        )
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        stream = aiter(response.streaming_content)
+        first = zlib.decompressobj(31).decompress(await anext(stream))
+        self.assertTrue(first.startswith(b'retry:'))
+        await stream.aclose()
@@ -0,0 +1,46 @@
+from PIL import Image
+from django.test import SimpleTestCase
+import io
+
+from messageServer.images import PICTURE_SIZES, render_variants
+
+
+class RenderVariantsTest(SimpleTestCase):
+
+    def picture_with_exif(self, size=(300, 200), mode='RGB', image_format='JPEG'):
+        image = Image.new(mode, size, (255, 0, 0, 128) if mode == 'RGBA' else 'red')
+        exif = Image.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise
+        exif[0x010F] = 'Camera maker'
+        output = io.BytesIO()
+        image.save(output, image_format, exif=exif)
+        return output.getvalue()
+
+    def test_builds_every_size_and_format(self):
+        full, variants = render_variants(self.picture_with_exif())
+
+        self.assertEqual(set(variants), {'jpeg', 'webp'})
+        for image_format, pillow_format in [('jpeg', 'JPEG'), ('webp', 'WEBP')]:
+            self.assertEqual(set(variants[image_format]), {str(size) for size in PICTURE_SIZES})
+            for size, content in variants[image_format].items():
+                with Image.open(io.BytesIO(content)) as image:
+                    self.assertEqual(image.format, pillow_format)
+                    self.assertEqual(image.size, (int(size), int(size)))
+
+    def test_strips_metadata_after_applying_orientation(self):
+        full, variants = render_variants(self.picture_with_exif())
+
+        with Image.open(io.BytesIO(full)) as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.size, (200, 300))
+            self.assertEqual(len(image.getexif()), 0)
+        with Image.open(io.BytesIO(variants['webp']['128'])) as image:
+            self.assertEqual(len(image.getexif()), 0)
+
+    def test_flattens_transparency_for_jpeg(self):
+        full, variants = render_variants(self.picture_with_exif(mode='RGBA', image_format='PNG'))
+
+        with Image.open(io.BytesIO(full)) as image:
+            self.assertEqual(image.mode, 'RGB')
+        with Image.open(io.BytesIO(variants['webp']['48'])) as image:
+            self.assertEqual(image.mode, 'RGBA')
@@ -0,0 +1,119 @@
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from unittest import mock
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from messageServer import metrics
+from messageServer.models import Conversation, Group, Message
+
+User = get_user_model()
+
+
+@override_settings(METRICS_TOKEN='scrape-secret', METRICS_DIR=None)
+class MetricsTests(APITestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=self.user)
+        self.group = Group.objects.create(name='test group')
+        self.group.members.add(self.user)
+        self.conversation = Conversation.objects.create(book_title='test conversation', group=self.group)
+        Message.objects.create(sender=self.user, conversation=self.conversation, text='hello')
+
+    def scrape(self):
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_records_requests_by_route(self):
+        url = reverse('get_messages', args=[self.conversation.id])
+        self.client.get(url)
+        self.client.get(url)
+        self.client.get(reverse('get_conversation', args=[self.user.id]))
+
+        text = self.scrape()
+
+        labels = 'route="get_messages",method="GET"'
+        self.assertIn(f'http_requests_total{{{labels},status="200"}} 2', text)
+        self.assertIn('http_requests_total{route="get_conversation",method="GET",status="404"} 1', text)
+        self.assertIn(f'http_request_duration_seconds_count{{{labels}}} 2', text)
+        self.assertIn(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2', text)
+        self.assertIn(f'http_response_size_bytes_count{{{labels}}} 2', text)
+        # Every get_messages request runs at least one query
+        self.assertIn(f'http_request_db_queries_bucket{{{labels},le="0"}} 0', text)
+        self.assertIn(f'http_request_db_queries_count{{{labels}}} 2', text)
+
+    def test_counts_each_query(self):
+        metrics.reset()
+        self.client.get(reverse('get_messages', args=[self.conversation.id]))
+
+        totals = metrics.snapshot()
+        labels = (('route', 'get_messages'), ('method', 'GET'))
+        queries = totals[(metrics.QUERIES, labels)]
+        self.assertGreater(queries[-1], 0)
+        self.assertEqual(sum(queries[:-1]), 1)
+        self.assertGreater(totals[(metrics.QUERY_DURATION, labels)][-1], 0)
+
+    def test_merges_other_workers(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        labels = [['route', 'get_messages'], ['method', 'GET'], ['status', '200']]
+        with open(os.path.join(directory, '1-1.json'), 'w') as other:
+            json.dump([[metrics.REQUESTS, labels, 5]], other)
+
+        with self.settings(METRICS_DIR=directory):
+            self.client.get(reverse('get_messages', args=[self.conversation.id]))
+            text = self.scrape()
+
+        self.assertIn('http_requests_total{route="get_messages",method="GET",status="200"} 6', text)
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+    def test_async_requests_flush_off_the_event_loop(self):
+        async def view(request):
+            return HttpResponse('ok')
+
+        async def serve():
+            flushed_on = []
+            loop_thread = threading.get_ident()
+            middleware = metrics.MetricsMiddleware(view)
+            with mock.patch.object(metrics, 'flush', lambda: flushed_on.append(threading.get_ident())):
+                await asyncio.gather(*[middleware(RequestFactory().get('/')) for _ in range(3)])
+            return loop_thread, flushed_on
+
+        with self.settings(METRICS_DIR='unused', METRICS_FLUSH_SECONDS=60), \
+                mock.patch.object(metrics, '_last_flush', time.monotonic() - 120):
+            loop_thread, flushed_on = async_to_sync(serve)()
+
+        self.assertEqual(len(flushed_on), 1)
+        self.assertNotEqual(flushed_on[0], loop_thread)
+
+    def test_requires_token(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        with self.settings(METRICS_TOKEN=None, DEBUG=False):
+            response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_escapes_label_values(self):
+        text = metrics.render({(metrics.REQUESTS, (('route', 'a"b\\c\nd'),)): 1})
+
+        self.assertIn('http_requests_total{route="a\\"b\\\\c\\nd"} 1', text)
+        self.assertIn('# TYPE http_requests_total counter', text)
@@ -0,0 +1,85 @@
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from django.test import override_settings
+import msgpack
+import shutil
+
+from messageServer.models import Group, Conversation, Message
+
+User = get_user_model()
+
+MSGPACK = 'application/msgpack'
+
+
+class MessagePackTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=self.user)
+        self.group = Group.objects.create(name='test group')
+        self.group.members.add(self.user)
+        self.conversation = Conversation.objects.create(book_title='test conversation', group=self.group)
+
+    def post_msgpack(self, url, data):
+        body = msgpack.packb(data, use_bin_type=True)
+        return self.client.post(url, body, content_type=MSGPACK, HTTP_ACCEPT=MSGPACK)
+
+    def test_messages_use_binary_uuids_and_epoch_times(self):
+        message = Message.objects.create(
+            sender=self.user, sender_username='chondosha', conversation=self.conversation,
+            text=str(self.conversation.id)
+        )
+
+        url = reverse('get_messages', args=[self.conversation.id])
+        response = self.client.get(url, HTTP_ACCEPT=MSGPACK)
+
+        self.assertEqual(response['Content-Type'], MSGPACK)
+        self.assertIn('Accept', response['Vary'])
+        row = msgpack.unpackb(response.content)['messages'][0]
+        self.assertEqual(row['id'], message.id.bytes)
+        self.assertEqual(row['sender'], self.user.id.bytes)
+        self.assertEqual(row['conversation'], self.conversation.id.bytes)
+        self.assertEqual(row['created_at'], int(message.created_at.timestamp() * 1000))
+        # Text is never converted, even when it looks like a UUID
+        self.assertEqual(row['text'], str(self.conversation.id))
+
+    def test_msgpack_is_smaller_than_json(self):
+        for i in range(20):
+            Message.objects.create(sender=self.user, sender_username='chondosha', conversation=self.conversation, text='hi')
+
+        url = reverse('get_messages', args=[self.conversation.id])
+        as_json = self.client.get(url, HTTP_ACCEPT='application/json')
+        as_msgpack = self.client.get(url, HTTP_ACCEPT=MSGPACK)
+
+        self.assertEqual(as_json['Content-Type'], 'application/json')
+        self.assertLess(len(as_msgpack.content), len(as_json.content) * 0.75)
+
+    def test_send_message_accepts_msgpack_body(self):
+        data = {
+            'sender': self.user.id.bytes,
+            'sender_username': 'chondosha',
+            'conversation': self.conversation.id.bytes,
+            'text': 'sent as msgpack'
+        }
+        response = self.post_msgpack(reverse('send_message'), data)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        message = Message.objects.get()
+        self.assertEqual(message.text, 'sent as msgpack')
+        self.assertEqual(msgpack.unpackb(response.content)['messages'][0]['id'], message.id.bytes)
+
+    def test_rejects_malformed_msgpack(self):
+        response = self.client.post(reverse('send_message'), b'\xc1', content_type=MSGPACK)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(MEDIA_ROOT='media_test')
+    def test_set_profile_picture_from_raw_bytes(self):
+        with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            response = self.post_msgpack(reverse('set_profile_picture'), {'picture': image_file.read()})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(msgpack.unpackb(response.content)['users'][0]['picture_url'])
+
+        shutil.rmtree('media_test/user_profiles', ignore_errors=True)
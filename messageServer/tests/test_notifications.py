@@ -0,0 +1,182 @@
+from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.utils import timezone
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+import io
+
+from messageServer.models import Group, Conversation, PushOutbox
+from messageServer import notifications
+
+User = get_user_model()
+
+
+class StubMessaging:
+    """
+    Stands in for firebase_admin.messaging and records what would be sent
+    """
+
+    def __init__(self, failing_tokens=(), error_code='UNAVAILABLE', raise_error=False):
+        self.sent = []
+        self.failing_tokens = set(failing_tokens)
+        self.error_code = error_code
+        self.raise_error = raise_error
+
+    def Notification(self, title, body):
+        return SimpleNamespace(title=title, body=body)
+
+    def MulticastMessage(self, notification, tokens):
+        return SimpleNamespace(notification=notification, tokens=tokens)
+
+    def send_each_for_multicast(self, message):
+        if self.raise_error:
+            raise ConnectionError('fcm unreachable')
+        self.sent.append(message.tokens)
+        responses = []
+        for token in message.tokens:
+            if token in self.failing_tokens:
+                responses.append(SimpleNamespace(success=False, exception=SimpleNamespace(code=self.error_code)))
+            else:
+                responses.append(SimpleNamespace(success=True, exception=None))
+        return SimpleNamespace(responses=responses)
+
+
+class DispatchTest(TestCase):
+
+    def setUp(self):
+        self.group = Group.objects.create(name='test group')
+        self.conversation = Conversation.objects.create(book_title='test conversation', group=self.group)
+
+    def add_member(self, name, token):
+        user = User.objects.create(email=f"{name}@example.com", username=name, fcm_registration_token=token)
+        self.group.members.add(user)
+        return user
+
+    def test_sends_one_multicast_for_coalesced_rows(self):
+        self.add_member('chondosha', 'token1')
+        self.add_member('other_guy', 'token2')
+        self.add_member('no_token', None)
+        notifications.enqueue_message_notification(self.conversation)
+        notifications.enqueue_message_notification(self.conversation)
+
+        stub = StubMessaging()
+        handled = notifications.dispatch_pending(messaging=stub)
+
+        self.assertEqual(handled, 2)
+        self.assertEqual(len(stub.sent), 1)
+        self.assertCountEqual(stub.sent[0], ['token1', 'token2'])
+        self.assertEqual(PushOutbox.objects.filter(status=PushOutbox.SENT).count(), 2)
+
+    def test_does_not_coalesce_across_conversations(self):
+        self.add_member('chondosha', 'token1')
+        other_group = Group.objects.create(name='other group')
+        other_conversation = Conversation.objects.create(book_title='other conversation', group=other_group)
+        other = User.objects.create(email="other@example.com", username="other_guy", fcm_registration_token='token2')
+        other_group.members.add(other)
+        notifications.enqueue_message_notification(self.conversation)
+        notifications.enqueue_message_notification(other_conversation)
+
+        stub = StubMessaging()
+        notifications.dispatch_pending(messaging=stub)
+
+        self.assertCountEqual(stub.sent, [['token1'], ['token2']])
+        self.assertEqual(PushOutbox.objects.filter(status=PushOutbox.SENT).count(), 2)
+
+    def test_chunks_tokens_at_multicast_limit(self):
+        for i in range(notifications.MULTICAST_LIMIT + 1):
+            self.add_member(f'user{i}', f'token{i}')
+        notifications.enqueue_message_notification(self.conversation)
+
+        stub = StubMessaging()
+        notifications.dispatch_pending(messaging=stub)
+
+        self.assertEqual([len(tokens) for tokens in stub.sent], [notifications.MULTICAST_LIMIT, 1])
+
+    def test_transient_failures_are_retried_with_backoff(self):
+        self.add_member('chondosha', 'token1')
+        self.add_member('other_guy', 'token2')
+        notifications.enqueue_message_notification(self.conversation)
+
+        notifications.dispatch_pending(messaging=StubMessaging(failing_tokens=['token2']))
+
+        row = PushOutbox.objects.get()
+        self.assertEqual(row.status, PushOutbox.PENDING)
+        self.assertEqual(row.tokens, ['token2'])
+        self.assertEqual(row.attempts, 1)
+        self.assertGreater(row.next_attempt_at, timezone.now())
+
+        stub = StubMessaging()
+        self.assertEqual(notifications.dispatch_pending(messaging=stub), 0)
+
+        PushOutbox.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+        notifications.dispatch_pending(messaging=stub)
+
+        self.assertEqual(stub.sent, [['token2']])
+        self.assertEqual(PushOutbox.objects.get().status, PushOutbox.SENT)
+
+    def test_permanent_failures_are_not_retried(self):
+        self.add_member('chondosha', 'stale_token')
+        notifications.enqueue_message_notification(self.conversation)
+
+        notifications.dispatch_pending(messaging=StubMessaging(failing_tokens=['stale_token'], error_code='NOT_FOUND'))
+
+        self.assertEqual(PushOutbox.objects.get().status, PushOutbox.SENT)
+
+    def test_gives_up_after_max_attempts(self):
+        self.add_member('chondosha', 'token1')
+        notifications.enqueue_message_notification(self.conversation)
+        PushOutbox.objects.update(attempts=notifications.MAX_ATTEMPTS - 1)
+
+        notifications.dispatch_pending(messaging=StubMessaging(raise_error=True))
+
+        self.assertEqual(PushOutbox.objects.get().status, PushOutbox.FAILED)
+
+    def test_claimed_rows_are_not_claimed_again(self):
+        self.add_member('chondosha', 'token1')
+        notifications.enqueue_message_notification(self.conversation)
+
+        self.assertEqual(len(notifications.claim_due()), 1)
+        self.assertEqual(notifications.claim_due(), [])
+
+
+class DispatchCommandTest(TestCase):
+
+    def test_once_drains_due_rows_and_exits(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha", fcm_registration_token='token1')
+        group.members.add(user)
+        conversations = [Conversation.objects.create(book_title=f'conversation {i}', group=group) for i in range(2)]
+        for conversation in conversations:
+            notifications.enqueue_message_notification(conversation)
+        PushOutbox.objects.create(
+            title='later', body='later', tokens=['token1'], next_attempt_at=timezone.now() + timedelta(hours=1)
+        )
+
+        stub = StubMessaging()
+        out = io.StringIO()
+        with mock.patch('firebase_admin.messaging', stub, create=True):
+            call_command('dispatch_notifications', once=True, stdout=out)
+
+        self.assertIn('Dispatched 2 notification(s)', out.getvalue())
+        self.assertEqual(stub.sent, [['token1'], ['token1']])
+        self.assertEqual(PushOutbox.objects.filter(status=PushOutbox.SENT).count(), 2)
+        self.assertEqual(PushOutbox.objects.get(title='later').status, PushOutbox.PENDING)
+
+
+class PruneOutboxTest(TestCase):
+
+    def test_deletes_only_old_finished_rows(self):
+        old = timezone.now() - timedelta(days=30)
+        for status in (PushOutbox.SENT, PushOutbox.FAILED, PushOutbox.PENDING):
+            PushOutbox.objects.create(title=f'old {status}', body='body', status=status, next_attempt_at=old)
+        PushOutbox.objects.create(title='recent sent', body='body', status=PushOutbox.SENT)
+
+        out = io.StringIO()
+        call_command('prune_push_outbox', stdout=out)
+
+        self.assertIn('Deleted 2 push notification(s)', out.getvalue())
+        self.assertCountEqual(
+            PushOutbox.objects.values_list('title', flat=True), [f'old {PushOutbox.PENDING}', 'recent sent']
+        )
@@ -0,0 +1,92 @@
+from django.contrib.auth import get_user_model
+from django.core.exceptions import MiddlewareNotUsed
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APITestCase
+import json
+import os
+import pstats
+import shutil
+import tempfile
+
+from messageServer.models import Group
+from messageServer.profiling import ProfilingMiddleware
+
+User = get_user_model()
+
+
+class ProfilingTests(APITestCase):
+
+    def setUp(self):
+        # Before the first request, which is when the test client sets up
+        # its middleware
+        self.root = tempfile.mkdtemp()
+        settings_override = override_settings(PROFILE_DIR=self.root, PROFILE_SAMPLE_RATE=0, PROFILE_SAMPLE_INTERVAL=0.0001)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+        self.staff = User.objects.create(email="staff@example.com", username="staff", is_staff=True)
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.group = Group.objects.create(name='test group')
+        self.group.members.add(self.staff, self.user)
+        self.url = reverse('get_member_list', args=[self.group.id])
+
+    def profile_files(self, response):
+        name = response['X-Profile-Id']
+        with open(os.path.join(self.root, f'{name}.json')) as details:
+            return name, json.load(details)
+
+    @override_settings(AUTHENTICATION_BACKENDS=['django.contrib.auth.backends.ModelBackend'])
+    def test_staff_gets_pstats_with_queries(self):
+        self.client.force_login(self.staff)
+
+        response = self.client.get(self.url, HTTP_X_PROFILE='pstats')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['users']), 2)
+        name, details = self.profile_files(response)
+        self.assertEqual(details['route'], 'get_member_list')
+        self.assertEqual(details['status'], 200)
+        self.assertTrue(any('SELECT' in query['sql'] for query in details['queries']))
+        stats = pstats.Stats(os.path.join(self.root, f'{name}.prof'))
+        self.assertTrue(any(function[2] == 'get_member_list' for function in stats.stats))
+
+    def test_token_staff_gets_collapsed_stacks(self):
+        token, _ = Token.objects.get_or_create(user=self.staff)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+
+        response = client.get(self.url, HTTP_X_PROFILE='collapsed')
+
+        name, details = self.profile_files(response)
+        self.assertEqual(details['format'], 'collapsed')
+        self.assertTrue(any(query['param_count'] for query in details['queries']))
+        self.assertNotIn(token.key, json.dumps(details))
+        with open(os.path.join(self.root, f'{name}.folded')) as folded:
+            for line in folded:
+                stack, count = line.rsplit(' ', 1)
+                self.assertGreater(int(count), 0)
+
+    def test_ignores_header_from_non_staff(self):
+        self.client.force_authenticate(user=self.user)
+
+        response = self.client.get(self.url, HTTP_X_PROFILE='pstats')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('X-Profile-Id', response)
+
+    def test_sample_rate_profiles_any_request(self):
+        self.client.force_authenticate(user=self.user)
+
+        with self.settings(PROFILE_SAMPLE_RATE=1):
+            response = self.client.get(self.url)
+
+        self.assertEqual(self.profile_files(response)[1]['route'], 'get_member_list')
+
+    def test_removed_without_profile_dir(self):
+        with self.settings(PROFILE_DIR=None):
+            with self.assertRaises(MiddlewareNotUsed):
+                ProfilingMiddleware(lambda request: None)
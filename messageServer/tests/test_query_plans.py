@@ -0,0 +1,155 @@
+from collections import namedtuple
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+import io
+import re
+
+from messageServer.models import ChangeEvent, Conversation, Group, Message, PushOutbox, ReadMarker
+from messageServer.search import fts5_available
+
+User = get_user_model()
+
+# One row per hot endpoint: the most queries it may run against the seeded
+# data, and how to call it given the Fixture.  A route may have rows for
+# requests that take different paths through it.  Raise a budget only
+# along with the change that needs it.
+Budget = namedtuple('Budget', ['url_name', 'method', 'queries', 'args', 'data'])
+
+BUDGETS = [
+    Budget('get_messages', 'GET', 1, lambda f: [f.conversation.id], lambda f: {'limit': 50}),
+    Budget('send_message', 'POST', 16, lambda f: [], lambda f: {
+        'sender': f.user.id, 'sender_username': f.user.username, 'conversation': f.conversation.id, 'text': 'chapter two'
+    }),
+    Budget('send_message_batch', 'POST', 13, lambda f: [], lambda f: {'messages': [
+        {'sender': f.user.id, 'sender_username': f.user.username, 'conversation': f.conversation.id, 'text': f'line {i}'}
+        for i in range(10)
+    ]}),
+    Budget('search_messages', 'GET', 3, lambda f: [], lambda f: {'q': 'chapter'}),
+    Budget('sync', 'GET', 4, lambda f: [], lambda f: {'since': 0}),
+    Budget('bootstrap', 'GET', 5, lambda f: [], lambda f: {}),
+    Budget('get_group', 'GET', 2, lambda f: [f.group.id], lambda f: {}),
+    Budget('get_group_list', 'GET', 1, lambda f: [], lambda f: {}),
+    Budget('get_member_list', 'GET', 3, lambda f: [f.group.id], lambda f: {}),
+    Budget('add_member', 'POST', 7, lambda f: [f.group.id, f.outsider.id], lambda f: {}),
+    Budget('remove_member', 'POST', 6, lambda f: [f.group.id, f.member.id], lambda f: {}),
+    Budget('get_conversation_list', 'GET', 2, lambda f: [f.group.id], lambda f: {}),
+    Budget('get_conversation', 'GET', 2, lambda f: [f.conversation.id], lambda f: {}),
+    Budget('mark_conversation_read', 'POST', 4, lambda f: [f.conversation.id], lambda f: {}),
+    Budget('get_friends_list', 'GET', 2, lambda f: [], lambda f: {}),
+    Budget('add_friend', 'POST', 6, lambda f: [f.outsider.id], lambda f: {}),
+    Budget('remove_friend', 'POST', 5, lambda f: [f.friend.id], lambda f: {}),
+    Budget('search_users', 'GET', 2, lambda f: ['scale_1'], lambda f: {}),
+    Budget('search_users', 'GET', 2, lambda f: ['Sc'], lambda f: {}),
+    Budget('get_current_user', 'GET', 1, lambda f: [], lambda f: {}),
+]
+
+# Tables that grow with use, which no statement may read from end to end
+LARGE_TABLES = {
+    model._meta.db_table for model in [
+        Message, User, Group, Conversation, ChangeEvent, ReadMarker, PushOutbox,
+        User.groups.through, User.friends.through,
+    ]
+}
+
+EXPLAINED = re.compile(r'^\s*(SELECT|UPDATE|DELETE|WITH)\b', re.IGNORECASE)
+TABLE_ALIAS = re.compile(r'(?:FROM|JOIN|UPDATE)\s+"(\w+)"(?:\s+(?:AS\s+)?"?([A-Z]\d+)\b)?', re.IGNORECASE)
+SCAN = re.compile(r'^SCAN (\w+)')
+
+Fixture = namedtuple('Fixture', ['user', 'group', 'conversation', 'member', 'outsider', 'friend'])
+
+
+def full_scans(sql):
+    """
+    Large tables the statement's query plan reads in full
+    """
+    tables = {}
+    for table, alias in TABLE_ALIAS.findall(sql):
+        tables[table] = table
+        if alias:
+            tables[alias] = table
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+        plan = [row[3] for row in cursor.fetchall()]
+    scans = []
+    for detail in plan:
+        match = SCAN.match(detail)
+        if match and tables.get(match.group(1)) in LARGE_TABLES:
+            scans.append(detail)
+    return scans
+
+
+class QueryPlanTest(TestCase):
+    """
+    Runs each view in BUDGETS against a seeded database, holding it to its
+    query budget and failing on any full scan of a large table.  Requests
+    are force authenticated, so token lookups aren't counted.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command(
+            'seed_scale', users=300, groups=30, members_per_group=15, friends_per_user=20,
+            conversations_per_group=3, messages=3000, batch_size=500, stdout=io.StringIO()
+        )
+        # The biggest group and busiest conversation, where work per member
+        # or per message shows most
+        group = Group.objects.annotate(size=Count('members')).order_by('-size', 'id').first()
+        members = list(group.members.order_by('id'))
+        user = members[0]
+        conversation = group.conversations.order_by('-message_count', 'id').first()
+        friend = user.friends.order_by('id').first()
+        outsider = User.objects.exclude(groups=group).exclude(friends=user).exclude(pk=user.pk).order_by('id').first()
+        cls.fixture = Fixture(user, group, conversation, members[-1], outsider, friend)
+
+    def request(self, budget):
+        client = APIClient()
+        client.force_authenticate(user=self.fixture.user)
+        url = reverse(budget.url_name, args=budget.args(self.fixture))
+        if budget.method == 'GET':
+            return client.get(url, budget.data(self.fixture))
+        return client.post(url, budget.data(self.fixture), format='json')
+
+    def label(self, budget):
+        return ' '.join([budget.url_name, *map(str, budget.args(self.fixture))])
+
+    def test_budgets_cover_distinct_requests(self):
+        labels = [self.label(budget) for budget in BUDGETS]
+        self.assertEqual(len(labels), len(set(labels)))
+
+    def test_query_budgets_and_plans(self):
+        for budget in BUDGETS:
+            with self.subTest(self.label(budget)):
+                with CaptureQueriesContext(connection) as captured:
+                    response = self.request(budget)
+                self.assertLess(response.status_code, 400, response.content[:500])
+
+                statements = [query['sql'] for query in captured.captured_queries]
+                self.assertLessEqual(
+                    len(statements), budget.queries,
+                    f"{budget.url_name} ran {len(statements)} queries:\n" + '\n'.join(statements)
+                )
+                for sql in statements:
+                    if EXPLAINED.match(sql):
+                        self.assertEqual(full_scans(sql), [], f"{budget.url_name} scans a large table:\n{sql}")
+
+    def test_harness_catches_full_scan(self):
+        with CaptureQueriesContext(connection) as captured:
+            list(Message.objects.filter(text='chapter'))
+            list(Message.objects.filter(conversation=self.fixture.conversation).order_by('-created_at', '-id')[:5])
+
+        self.assertEqual(full_scans(captured.captured_queries[0]['sql']), ['SCAN messageServer_message'])
+        self.assertEqual(full_scans(captured.captured_queries[1]['sql']), [])
+
+    def test_search_uses_text_index(self):
+        if not fts5_available():
+            self.skipTest('No FTS5 in this SQLite')
+        with CaptureQueriesContext(connection) as captured:
+            self.request(next(budget for budget in BUDGETS if budget.url_name == 'search_messages'))
+
+        self.assertTrue(any('messageserver_message_search' in query['sql'] for query in captured.captured_queries))
@@ -0,0 +1,182 @@
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from django.urls import reverse
+from unittest.mock import patch
+
+from chonMessageServer.asgi import application
+from messageServer.models import Group, Conversation, ChangeEvent, Message
+from messageServer.realtime import EventSubscription
+
+User = get_user_model()
+
+
+class MessageConsumerTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.token = Token.objects.get(user=self.user)
+        self.group = Group.objects.create(name='test group')
+        self.group.members.add(self.user)
+        self.conversation = Conversation.objects.create(book_title='test conversation', group=self.group)
+
+    def send_message(self, text):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        data = {
+            'sender': self.user.id,
+            'sender_username': self.user.username,
+            'conversation': self.conversation.id,
+            'text': text
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(reverse('send_message'), data=data, format='json')
+        return response
+
+    async def connect(self, path):
+        communicator = WebsocketCommunicator(application, path)
+        connected, code = await communicator.connect()
+        return communicator, connected, code
+
+    async def test_rejects_missing_token(self):
+        communicator, connected, code = await self.connect('/ws/messages')
+        self.assertFalse(connected)
+        self.assertEqual(code, 4401)
+
+    async def test_rejects_unknown_token(self):
+        communicator, connected, code = await self.connect('/ws/messages?token=not-a-token')
+        self.assertFalse(connected)
+
+    async def test_pushes_new_message_after_commit(self):
+        communicator, connected, _ = await self.connect(f'/ws/messages?token={self.token.key}')
+        self.assertTrue(connected)
+
+        await sync_to_async(self.send_message)('hello')
+
+        event = await communicator.receive_json_from()
+        self.assertEqual(event['type'], 'message')
+        self.assertEqual(event['messages'][0]['text'], 'hello')
+        self.assertEqual(event['messages'][0]['conversation'], str(self.conversation.id))
+        await communicator.disconnect()
+
+    async def test_accepts_authorization_header(self):
+        communicator = WebsocketCommunicator(
+            application, '/ws/messages',
+            headers=[(b'authorization', f'Token {self.token.key}'.encode())]
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+
+    async def test_subscribes_to_group_joined_while_connected(self):
+        other_group = await sync_to_async(Group.objects.create)(name='other group')
+        other_conversation = await sync_to_async(Conversation.objects.create)(book_title='other', group=other_group)
+        communicator, connected, _ = await self.connect(f'/ws/messages?token={self.token.key}')
+
+        def join():
+            with self.captureOnCommitCallbacks(execute=True):
+                other_group.members.add(self.user)
+        await sync_to_async(join)()
+
+        event = await communicator.receive_json_from()
+        self.assertEqual(event['type'], 'member_added')
+        self.assertEqual(event['group'], str(other_group.id))
+
+        self.conversation = other_conversation
+        await sync_to_async(self.send_message)('in the new group')
+
+        event = await communicator.receive_json_from()
+        self.assertEqual(event['messages'][0]['text'], 'in the new group')
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class EventStreamTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.other = User.objects.create(email="other@example.com", username="other_guy")
+        self.token = Token.objects.get(user=self.user)
+        self.group = Group.objects.create(name='test group')
+        self.group.members.add(self.user)
+
+    async def open_stream(self, **headers):
+        response = await self.async_client.get(
+            reverse('events'),
+            headers={'Authorization': f'Token {self.token.key}', **headers}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertTrue((await anext(stream)).startswith(b'retry:'))
+        return stream
+
+    async def test_rejects_missing_token(self):
+        response = await self.async_client.get(reverse('events'))
+        self.assertEqual(response.status_code, 401)
+
+    async def test_streams_membership_and_conversation_events(self):
+        stream = await self.open_stream()
+
+        def change():
+            with self.captureOnCommitCallbacks(execute=True):
+                self.group.members.add(self.other)
+                Conversation.objects.create(book_title='test conversation', group=self.group)
+        await sync_to_async(change)()
+
+        frame = (await anext(stream)).decode()
+        self.assertIn('event: member_added', frame)
+        self.assertIn(str(self.other.id), frame)
+        frame = (await anext(stream)).decode()
+        self.assertIn('event: conversation', frame)
+        self.assertIn('test conversation', frame)
+        await stream.aclose()
+
+    async def test_resumes_from_last_event_id(self):
+        def change():
+            conversation = Conversation.objects.create(book_title='missed conversation', group=self.group)
+            last_seen = ChangeEvent.objects.latest('id').id
+            Message.objects.create(sender=self.other, sender_username='other_guy', conversation=conversation, text='missed message')
+            return last_seen
+        last_seen = await sync_to_async(change)()
+
+        stream = await self.open_stream(**{'Last-Event-ID': str(last_seen)})
+
+        frame = (await anext(stream)).decode()
+        self.assertIn('event: message', frame)
+        self.assertIn('missed message', frame)
+        self.assertNotIn('missed conversation', frame)
+        await stream.aclose()
+
+    async def test_sends_heartbeat_when_idle(self):
+        with patch('messageServer.realtime.HEARTBEAT_SECONDS', 0.01):
+            stream = await self.open_stream()
+            self.assertEqual(await anext(stream), b': heartbeat\n\n')
+            await stream.aclose()
+
+
+class EventSubscriptionTest(TestCase):
+
+    async def test_accepts_out_of_order_events_once(self):
+        user = await sync_to_async(User.objects.create)(email="chondosha@example.com", username="chondosha")
+        subscription = EventSubscription(None, 'channel', user)
+
+        accepted = [
+            await subscription.accept({'id': event_id, 'type': ChangeEvent.MESSAGE})
+            for event_id in [5, 3, 5, 4, 3]
+        ]
+
+        self.assertEqual(accepted, [True, True, False, True, False])
+
+    async def test_forgets_oldest_ids_past_limit(self):
+        user = await sync_to_async(User.objects.create)(email="chondosha@example.com", username="chondosha")
+        with patch('messageServer.realtime.RECENT_EVENT_IDS', 2):
+            subscription = EventSubscription(None, 'channel', user)
+        for event_id in [1, 2, 3]:
+            await subscription.accept({'id': event_id, 'type': ChangeEvent.MESSAGE})
+
+        self.assertTrue(await subscription.accept({'id': 1, 'type': ChangeEvent.MESSAGE}))
+        self.assertFalse(await subscription.accept({'id': 3, 'type': ChangeEvent.MESSAGE}))
@@ -0,0 +1,134 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connections
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+import os
+import tempfile
+
+from messageServer.models import Conversation, Group, Message
+from messageServer.replicas import ReplicaRouter, ReplicaStickinessMiddleware, choose_replica
+
+User = get_user_model()
+
+
+@override_settings(
+    DATABASE_REPLICAS=['replica'],
+    DATABASE_ROUTERS=['messageServer.replicas.ReplicaRouter'],
+    REPLICA_STICKY_SECONDS=60,
+    CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'messageserver-replica-test-cache'),
+    }}
+)
+class ReplicaRoutingTest(TestCase):
+    """
+    A second SQLite file stands in for a replica that hasn't caught up, so
+    whatever a view sees tells which database it read from.  It's added here
+    rather than in settings so the test runner doesn't mirror it.
+    """
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        handle, cls.replica_path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(handle)
+        connections.settings['replica'] = connections.configure_settings({
+            'default': {'ENGINE': 'django.db.backends.sqlite3'},
+            'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': cls.replica_path},
+        })['replica']
+        call_command('migrate', database='replica', run_syncdb=True, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        os.remove(cls.replica_path)
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.other = User.objects.create(email="other@example.com", username="other")
+        self.group = Group.objects.create(name='test group')
+        self.conversation = Conversation.objects.create(book_title='test conversation', group=self.group)
+        # Copied without signals, which would write their side effects to
+        # the primary a second time
+        User.objects.using('replica').bulk_create([self.user, self.other])
+        Group.objects.using('replica').bulk_create([self.group])
+        Conversation.objects.using('replica').bulk_create([self.conversation])
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def message_texts(self, client):
+        response = client.get(reverse('get_messages', args=[self.conversation.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [message['text'] for message in response.data['messages']]
+
+    def send(self, client, user, text):
+        data = {
+            'sender': user.id,
+            'sender_username': user.username,
+            'conversation': self.conversation.id,
+            'text': text
+        }
+        response = client.post(reverse('send_message'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_reads_go_to_replica(self):
+        Message.objects.create(sender=self.user, sender_username='chondosha', conversation=self.conversation, text='primary')
+        Message.objects.using('replica').bulk_create([
+            Message(sender=self.user, sender_username='chondosha', conversation=self.conversation, text='replica')
+        ])
+
+        self.assertEqual(self.message_texts(self.client), ['replica'])
+
+    def test_writer_reads_own_writes_from_primary(self):
+        self.send(self.client, self.user, 'hello')
+
+        self.assertFalse(Message.objects.using('replica').exists())
+        self.assertEqual(self.message_texts(self.client), ['hello'])
+
+    def test_other_users_keep_reading_from_replica(self):
+        self.send(self.client, self.user, 'hello')
+
+        other_client = APIClient()
+        other_client.force_authenticate(user=self.other)
+        self.assertEqual(self.message_texts(other_client), [])
+
+    def test_stickiness_expires(self):
+        self.send(self.client, self.user, 'hello')
+        cache.clear()
+
+        self.assertEqual(self.message_texts(self.client), [])
+
+    def test_failed_write_does_not_stick(self):
+        response = self.client.post(reverse('send_message'), {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.assertIsNotNone(choose_replica(self.user))
+
+    def test_instances_read_from_replica_save_to_primary(self):
+        conversation = Conversation.objects.using('replica').get(pk=self.conversation.pk)
+        conversation.book_title = 'renamed'
+        conversation.save()
+
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).book_title, 'renamed')
+        self.assertEqual(Conversation.objects.using('replica').get(pk=self.conversation.pk).book_title, 'test conversation')
+
+    def test_no_replicas_reads_from_primary(self):
+        with self.settings(DATABASE_REPLICAS=[]):
+            self.assertIsNone(choose_replica(self.user))
+        self.assertIsNone(ReplicaRouter().db_for_read(Message))
+
+    def test_refuses_cache_local_to_process(self):
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with self.assertRaises(ImproperlyConfigured):
+                ReplicaStickinessMiddleware(lambda request: None)
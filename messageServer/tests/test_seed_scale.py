@@ -0,0 +1,107 @@
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db.models import Count
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+import io
+
+from messageServer.models import Conversation, Group, Message
+
+User = get_user_model()
+
+SHAPE = {
+    'users': 40,
+    'groups': 5,
+    'members_per_group': 6,
+    'friends_per_user': 6,
+    'conversations_per_group': 2,
+    'messages': 300,
+    'batch_size': 50,
+}
+
+
+class SeedScaleTest(TestCase):
+
+    def seed(self, **options):
+        out = io.StringIO()
+        call_command('seed_scale', stdout=out, **{**SHAPE, **options})
+        return out.getvalue()
+
+    def test_creates_requested_shape(self):
+        output = self.seed()
+
+        self.assertIn('Created 300 messages', output)
+        self.assertEqual(User.objects.count(), 40)
+        self.assertEqual(Token.objects.count(), 40)
+        self.assertEqual(Group.objects.count(), 5)
+        self.assertEqual(Conversation.objects.count(), 10)
+        self.assertEqual(Message.objects.count(), 300)
+        for group in Group.objects.annotate(size=Count('members')):
+            self.assertGreaterEqual(group.size, 2)
+
+    def test_senders_are_members_and_summaries_match(self):
+        self.seed()
+
+        for conversation in Conversation.objects.all():
+            messages = Message.objects.filter(conversation=conversation)
+            members = set(conversation.group.members.values_list('id', flat=True))
+            self.assertLessEqual(set(messages.values_list('sender', flat=True)), members)
+            self.assertEqual(conversation.message_count, messages.count())
+            latest = messages.order_by('-created_at', '-id').first()
+            if latest is not None:
+                self.assertEqual(conversation.last_message_at, latest.created_at)
+                self.assertEqual(conversation.last_sender_username, latest.sender_username)
+
+    def test_friendships_are_symmetrical(self):
+        self.seed()
+
+        pairs = set(User.friends.through.objects.values_list('from_user', 'to_user'))
+        self.assertTrue(pairs)
+        self.assertEqual(pairs, {(to_user, from_user) for from_user, to_user in pairs})
+
+    def test_same_seed_gives_same_data(self):
+        self.seed(seed=3)
+        first = sorted(Message.objects.values_list('id', 'sender', 'text'))
+        Message.objects.all().delete()
+        Conversation.objects.all().delete()
+        Group.objects.all().delete()
+        User.objects.all().delete()
+
+        self.seed(seed=3)
+
+        self.assertEqual(sorted(Message.objects.values_list('id', 'sender', 'text')), first)
+
+    def test_seeded_data_is_usable_through_api(self):
+        self.seed()
+        conversation = Conversation.objects.order_by('-message_count').first()
+        user = conversation.group.members.first()
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.get(user=user).key}')
+
+        response = client.get(reverse('get_messages', args=[conversation.id]), {'limit': 5})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['messages']), min(5, conversation.message_count))
+        response = client.get(reverse('search_users', args=['scale_1']))
+        self.assertTrue(response.data['users'])
+
+    def test_refuses_existing_prefix(self):
+        self.seed(messages=0)
+
+        with self.assertRaises(CommandError):
+            self.seed(messages=0)
+
+    def test_refuses_shape_it_cannot_build(self):
+        for options in [
+            {'users': 0}, {'users': 1}, {'groups': 0}, {'conversations_per_group': 0},
+            {'messages': -1}, {'batch_size': 0},
+        ]:
+            with self.subTest(**options):
+                with self.assertRaises(CommandError):
+                    self.seed(**options)
+
+        self.assertFalse(User.objects.exists())
@@ -0,0 +1,59 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from rest_framework.renderers import JSONRenderer
+from unittest.mock import patch
+
+from messageServer.models import Group, Conversation, Message
+from messageServer.renderers import FastJSONRenderer
+from messageServer.serializers import (
+    MessageSerializer, UserSerializer, message_rows, message_values, user_rows, user_values
+)
+
+User = get_user_model()
+
+
+class FastPathTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.other = User.objects.create(
+            email="other@example.com",
+            username="other_guy",
+            picture='user_profiles/user_other_full.jpg',
+            picture_variants={'webp': {'48': 'user_profiles/user_other_48.webp'}}
+        )
+        group = Group.objects.create(name='test group')
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        for text in ['hello', 'ünïcödé and emoji 📚', 'line\u2028separator\u2029', '"quoted" <b>\\</b>']:
+            Message.objects.create(sender=self.user, sender_username='chondosha', conversation=conversation, text=text)
+
+    def assertSameBytes(self, slow, fast):
+        expected = JSONRenderer().render(slow)
+        self.assertEqual(JSONRenderer().render(fast), expected)
+        self.assertEqual(FastJSONRenderer().render(fast), expected)
+        self.assertEqual(FastJSONRenderer().render(slow), expected)
+
+    def test_message_rows_match_serializer(self):
+        messages = Message.objects.order_by('-created_at', '-id')
+        slow = {'messages': MessageSerializer(messages, many=True).data}
+        fast = {'messages': message_rows(message_values(messages))}
+        self.assertSameBytes(slow, fast)
+
+    def test_user_rows_match_serializer(self):
+        users = User.objects.order_by('username')
+        slow = {'users': UserSerializer(users, many=True).data}
+        fast = {'users': user_rows(user_values(users))}
+        self.assertSameBytes(slow, fast)
+
+    def test_renderer_falls_back_without_orjson(self):
+        data = {'messages': message_rows(message_values(Message.objects.all()))}
+        with patch('messageServer.renderers.orjson', None):
+            self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_renderer_indents_like_stock_renderer(self):
+        data = {'users': user_rows(user_values(User.objects.all()))}
+        context = {'indent': 4}
+        self.assertEqual(
+            FastJSONRenderer().render(data, 'application/json', context),
+            JSONRenderer().render(data, 'application/json', context)
+        )
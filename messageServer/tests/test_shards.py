@@ -0,0 +1,178 @@
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connections
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APIClient
+import io
+import os
+import tempfile
+
+from messageServer.models import ChangeEvent, Conversation, Group, Message
+from messageServer.shards import shard_for
+
+User = get_user_model()
+
+SHARDS = ['shard1', 'shard2']
+
+
+@override_settings(MESSAGE_SHARDS=SHARDS, DATABASE_ROUTERS=['messageServer.shards.ShardRouter'])
+class MessageShardTest(TestCase):
+    """
+    Two SQLite files as message shards, added here rather than in settings
+    so the rest of the suite runs unsharded
+    """
+    databases = '__all__'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.shard_paths = []
+        for alias in SHARDS:
+            handle, path = tempfile.mkstemp(suffix='.sqlite3')
+            os.close(handle)
+            cls.shard_paths.append(path)
+            connections.settings[alias] = connections.configure_settings({
+                'default': {'ENGINE': 'django.db.backends.sqlite3'},
+                alias: {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path},
+            })[alias]
+            call_command('migrate', database=alias, run_syncdb=True, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias, path in zip(SHARDS, cls.shard_paths):
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+            os.remove(path)
+
+    def setUp(self):
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.group = Group.objects.create(name='test group')
+        self.group.members.add(self.user)
+        self.conversations = {alias: self.conversation_on(alias) for alias in SHARDS}
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def conversation_on(self, alias):
+        while True:
+            conversation = Conversation.objects.create(book_title=f'conversation on {alias}', group=self.group)
+            if shard_for(conversation.id) == alias:
+                return conversation
+            conversation.delete()
+
+    def message_counts(self):
+        return {alias: Message.objects.using(alias).count() for alias in ['default', *SHARDS]}
+
+    def test_send_message_goes_to_conversation_shard(self):
+        conversation = self.conversations['shard2']
+        data = {
+            'sender': self.user.id,
+            'sender_username': 'chondosha',
+            'conversation': conversation.id,
+            'text': 'hello'
+        }
+        response = self.client.post(reverse('send_message'), data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.message_counts(), {'default': 0, 'shard1': 0, 'shard2': 1})
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.message_count, 1)
+
+        response = self.client.get(reverse('get_messages', args=[conversation.id]))
+        self.assertEqual([m['text'] for m in response.data['messages']], ['hello'])
+
+    def test_send_message_batch_splits_across_shards(self):
+        data = {'messages': [
+            {'sender': self.user.id, 'sender_username': 'chondosha', 'conversation': conversation.id, 'text': alias}
+            for alias, conversation in self.conversations.items()
+        ]}
+        response = self.client.post(reverse('send_message_batch'), data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.message_counts(), {'default': 0, 'shard1': 1, 'shard2': 1})
+        self.assertEqual(ChangeEvent.objects.filter(kind=ChangeEvent.MESSAGE).count(), 2)
+
+    def test_search_merges_shards_newest_first(self):
+        for text in ['chapter one', 'chapter two', 'chapter three']:
+            for conversation in self.conversations.values():
+                Message.objects.create(sender=self.user, conversation=conversation, text=f'{text} {conversation.book_title}')
+
+        url = reverse('search_messages')
+        seen = []
+        response = self.client.get(url, {'q': 'chapter', 'limit': 4})
+        seen += response.data['messages']
+        response = self.client.get(url, {'q': 'chapter', 'limit': 4, 'before': response.data['before_cursor']})
+        seen += response.data['messages']
+
+        self.assertEqual(len(seen), 6)
+        self.assertIsNone(response.data['before_cursor'])
+        created = [m['created_at'] for m in seen]
+        self.assertEqual(created, sorted(created, reverse=True))
+        self.assertIn('<mark>', seen[0]['snippet'])
+
+    def test_sync_gathers_messages_from_every_shard(self):
+        for conversation in self.conversations.values():
+            Message.objects.create(sender=self.user, conversation=conversation, text=conversation.book_title)
+
+        response = self.client.get(reverse('sync'), {'since': 0})
+
+        self.assertCountEqual(
+            [m['text'] for m in response.data['messages']],
+            [conversation.book_title for conversation in self.conversations.values()]
+        )
+
+    def test_deleting_conversation_deletes_its_messages(self):
+        conversation = self.conversations['shard1']
+        Message.objects.create(sender=self.user, conversation=conversation, text='bye')
+
+        conversation.delete()
+
+        self.assertEqual(self.message_counts()['shard1'], 0)
+
+    def test_rebalance_moves_messages_into_shards(self):
+        messages = Message.objects.using('default').bulk_create([
+            Message(sender=self.user, sender_username='chondosha', conversation=conversation, text=f'moved {alias}')
+            for alias, conversation in self.conversations.items()
+        ])
+        created_at = {message.id: message.created_at for message in messages}
+
+        out = io.StringIO()
+        call_command('rebalance_message_shards', batch_size=1, stdout=out)
+
+        self.assertIn('Moved 2 message(s) out of default', out.getvalue())
+        self.assertEqual(self.message_counts(), {'default': 0, 'shard1': 1, 'shard2': 1})
+        for message in Message.objects.all().gather():
+            self.assertEqual(message.created_at, created_at[message.id])
+        response = self.client.get(reverse('search_messages'), {'q': 'moved'})
+        self.assertEqual(len(response.data['messages']), 2)
+
+    def test_rebuild_summaries_reads_shards(self):
+        conversation = self.conversations['shard2']
+        Message.objects.create(sender=self.user, sender_username='chondosha', conversation=conversation, text='first')
+        Message.objects.create(sender=self.user, sender_username='chondosha', conversation=conversation, text='last')
+        Conversation.objects.filter(pk=conversation.pk).update(message_count=0, last_message_preview='')
+
+        call_command('rebuild_conversation_summaries', stdout=io.StringIO())
+
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.message_count, 2)
+        self.assertEqual(conversation.last_message_preview, 'last')
+        self.assertEqual(Conversation.objects.get(pk=self.conversations['shard1'].pk).message_count, 0)
+
+    @override_settings(AUTHENTICATION_BACKENDS=['django.contrib.auth.backends.ModelBackend'])
+    def test_admin_finds_messages_in_shards(self):
+        admin_user = User.objects.create_superuser(email="admin@example.com", username="admin")
+        message = Message.objects.create(sender=self.user, conversation=self.conversations['shard2'], text='in shard two')
+        self.client.force_login(admin_user)
+
+        response = self.client.get(reverse('admin:messageServer_message_change', args=[message.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        response = self.client.get(reverse('admin:messageServer_message_changelist'), {'shard': 'shard2'})
+        self.assertContains(response, 'in shard two')
+        response = self.client.get(reverse('admin:messageServer_message_changelist'))
+        self.assertNotContains(response, 'in shard two')
@@ -3,11 +3,21 @@ from django.contrib.auth import get_user_model
 from rest_framework import status
 from rest_framework.test import APITestCase
 from rest_framework.authtoken.models import Token
-from messageServer.models import Message, Group, Conversation
+from messageServer.models import Message, Group, Conversation, ChangeEvent, PushOutbox
 from messageServer.serializers import MessageSerializer, GroupSerializer, UserSerializer
+from messageServer.search import MESSAGE_INDEX_TABLE, clear_index, fts5_available, rebuild_message_index
+from messageServer import views
 from django.test import override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.utils import timezone
+from unittest import mock
 import base64
+import datetime
+import io
 import shutil
+import uuid
 
 User = get_user_model()
 
@@ -36,6 +46,74 @@ class MessageTests(APITestCase):
         self.assertEqual(Message.objects.get().text, 'test message')
         self.assertEqual(Message.objects.get().conversation, conversation)
 
+    def test_send_message_queues_push_notification(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        data = {
+            'sender': user.id,
+            'sender_username': 'chondosha',
+            'conversation': conversation.id,
+            'text': 'test message'
+        }
+
+        url = reverse('send_message')
+        response = self.client.post(url, data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(PushOutbox.objects.count(), 1)
+        self.assertEqual(PushOutbox.objects.get().conversation, conversation)
+        self.assertEqual(PushOutbox.objects.get().status, PushOutbox.PENDING)
+
+    def test_send_message_batch_across_conversations(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha", fcm_registration_token='token1')
+        other = User.objects.create(email="other@example.com", username="other_guy", fcm_registration_token='token2')
+        group.members.add(user)
+        group.members.add(other)
+        self.client.force_authenticate(user=user)
+
+        conversation1 = Conversation.objects.create(book_title='test conversation1', group=group)
+        conversation2 = Conversation.objects.create(book_title='test conversation2', group=group)
+        data = {
+            'messages': [
+                {'sender': user.id, 'sender_username': 'chondosha', 'conversation': conversation1.id, 'text': 'offline 1'},
+                {'sender': user.id, 'sender_username': 'chondosha', 'conversation': conversation2.id, 'text': 'offline 2'},
+                {'sender': user.id, 'sender_username': 'chondosha', 'conversation': conversation1.id, 'text': 'offline 3'},
+            ]
+        }
+
+        url = reverse('send_message_batch')
+        response = self.client.post(url, data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([m['text'] for m in response.data['messages']], ['offline 1', 'offline 2', 'offline 3'])
+        self.assertEqual(Message.objects.filter(conversation=conversation1).count(), 2)
+        self.assertEqual(Message.objects.filter(conversation=conversation2).count(), 1)
+        self.assertEqual(ChangeEvent.objects.filter(kind=ChangeEvent.MESSAGE).count(), 3)
+        self.assertEqual(PushOutbox.objects.count(), 1)
+        self.assertCountEqual(PushOutbox.objects.get().tokens, ['token1', 'token2'])
+
+    def test_send_message_batch_rejects_invalid_item(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        data = {
+            'messages': [
+                {'sender': user.id, 'sender_username': 'chondosha', 'conversation': conversation.id, 'text': 'fine'},
+                {'sender': user.id, 'sender_username': 'chondosha', 'text': 'no conversation'},
+            ]
+        }
+
+        url = reverse('send_message_batch')
+        response = self.client.post(url, data=data, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Message.objects.count(), 0)
+
     def test_get_messages(self):
         group = Group.objects.create(name='test group')
         user = User.objects.create(email="chondosha@example.com", username="chondosha")
@@ -54,6 +132,549 @@ class MessageTests(APITestCase):
         self.assertEqual(response.data['messages'][0]['text'], message2.text)
         self.assertEqual(response.data['messages'][1]['text'], message1.text)
 
+    def test_get_messages_pages_back_with_before_cursor(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        for i in range(5):
+            Message.objects.create(sender=user, conversation=conversation, text=f'test message {i}')
+        expected = list(Message.objects.order_by('-created_at', '-id').values_list('text', flat=True))
+
+        url = reverse('get_messages', args=[conversation.id])
+        response = self.client.get(url, {'limit': 2}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['text'] for m in response.data['messages']], expected[:2])
+        self.assertIsNotNone(response.data['before_cursor'])
+
+        seen = [m['text'] for m in response.data['messages']]
+        while response.data['before_cursor']:
+            response = self.client.get(url, {'limit': 2, 'before': response.data['before_cursor']}, format='json')
+            seen += [m['text'] for m in response.data['messages']]
+
+        self.assertEqual(seen, expected)
+
+    def test_get_messages_after_cursor_returns_only_newer(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        Message.objects.create(sender=user, conversation=conversation, text='old message')
+
+        url = reverse('get_messages', args=[conversation.id])
+        response = self.client.get(url, format='json')
+        after_cursor = response.data['after_cursor']
+
+        Message.objects.create(sender=user, conversation=conversation, text='new message 1')
+        Message.objects.create(sender=user, conversation=conversation, text='new message 2')
+
+        response = self.client.get(url, {'after': after_cursor}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertCountEqual([m['text'] for m in response.data['messages']], ['new message 1', 'new message 2'])
+
+    def test_get_messages_rejects_invalid_cursor(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+
+        url = reverse('get_messages', args=[conversation.id])
+        response = self.client.get(url, {'before': 'not-a-cursor'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MessageSearchTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=self.user)
+        self.group = Group.objects.create(name='test group')
+        self.group.members.add(self.user)
+        self.conversation = Conversation.objects.create(book_title='test conversation', group=self.group)
+
+    def test_search_returns_matching_messages_with_snippet(self):
+        Message.objects.create(sender=self.user, conversation=self.conversation, text='that quote from chapter 3 was great')
+        Message.objects.create(sender=self.user, conversation=self.conversation, text='nothing to see here')
+
+        url = reverse('search_messages')
+        response = self.client.get(url, {'q': 'chapter quote'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['messages']), 1)
+        self.assertEqual(response.data['messages'][0]['text'], 'that quote from chapter 3 was great')
+        self.assertIn('chapter', response.data['messages'][0]['snippet'])
+
+    def test_snippet_escapes_message_html(self):
+        Message.objects.create(
+            sender=self.user, conversation=self.conversation, text='<script>alert(1)</script> chapter <b>3</b>'
+        )
+
+        url = reverse('search_messages')
+        response = self.client.get(url, {'q': 'chapter'}, format='json')
+
+        snippet = response.data['messages'][0]['snippet']
+        self.assertNotIn('<script>', snippet)
+        self.assertNotIn('<b>', snippet)
+        self.assertIn('&lt;script&gt;', snippet)
+        if fts5_available():
+            self.assertIn('<mark>chapter</mark>', snippet)
+
+    def test_rebuild_search_index_command(self):
+        if not fts5_available():
+            self.skipTest('No FTS5 in this SQLite')
+        Message.objects.create(sender=self.user, conversation=self.conversation, text='lost chapter')
+        with connection.cursor() as cursor:
+            clear_index(cursor, MESSAGE_INDEX_TABLE)
+        url = reverse('search_messages')
+        self.assertEqual(self.client.get(url, {'q': 'chapter'}, format='json').data['messages'], [])
+
+        out = io.StringIO()
+        call_command('rebuild_search_index', stdout=out)
+
+        self.assertIn('Rebuilt message index with 1 messages', out.getvalue())
+        response = self.client.get(url, {'q': 'chapter'}, format='json')
+        self.assertEqual([m['text'] for m in response.data['messages']], ['lost chapter'])
+
+    def test_rebuild_skips_messages_without_conversation(self):
+        if not fts5_available():
+            self.skipTest('No FTS5 in this SQLite')
+        Message.objects.create(sender=self.user, conversation=self.conversation, text='kept chapter')
+        gone = Conversation.objects.create(book_title='gone conversation', group=self.group)
+        Message.objects.create(sender=self.user, conversation=gone, text='orphaned chapter')
+        # As a shard would be left if the post_delete clean up never ran
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM "{Conversation._meta.db_table}" WHERE id = %s', [gone.id.hex])
+
+        self.assertEqual(rebuild_message_index(batch_size=1), 1)
+
+        response = self.client.get(reverse('search_messages'), {'q': 'chapter'}, format='json')
+        self.assertEqual([m['text'] for m in response.data['messages']], ['kept chapter'])
+
+    def test_search_only_covers_own_groups(self):
+        other_group = Group.objects.create(name='other group')
+        other_conversation = Conversation.objects.create(book_title='other conversation', group=other_group)
+        Message.objects.create(sender=self.user, conversation=other_conversation, text='secret chapter')
+
+        url = reverse('search_messages')
+        response = self.client.get(url, {'q': 'chapter'}, format='json')
+        self.assertEqual(response.data['messages'], [])
+
+        response = self.client.get(url, {'q': 'chapter', 'conversation': other_conversation.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_search_pages_with_cursor(self):
+        for i in range(3):
+            Message.objects.create(sender=self.user, conversation=self.conversation, text=f'chapter {i}')
+
+        url = reverse('search_messages')
+        response = self.client.get(url, {'q': 'chapter', 'limit': 2}, format='json')
+        seen = [m['text'] for m in response.data['messages']]
+        response = self.client.get(url, {'q': 'chapter', 'limit': 2, 'before': response.data['before_cursor']}, format='json')
+        seen += [m['text'] for m in response.data['messages']]
+
+        self.assertCountEqual(seen, ['chapter 0', 'chapter 1', 'chapter 2'])
+        self.assertIsNone(response.data['before_cursor'])
+
+    def test_ids_alike_in_their_high_bits_keep_separate_entries(self):
+        # The index once keyed rows by the top 63 bits of the id
+        high = uuid.uuid4().int >> 65 << 65
+        for low, text in [(1, 'first chapter'), (2, 'second chapter')]:
+            Message.objects.create(
+                id=uuid.UUID(int=high | low), sender=self.user, conversation=self.conversation, text=text
+            )
+
+        url = reverse('search_messages')
+        response = self.client.get(url, {'q': 'chapter'}, format='json')
+
+        self.assertCountEqual([m['text'] for m in response.data['messages']], ['first chapter', 'second chapter'])
+
+    def test_deleted_message_is_not_found(self):
+        message = Message.objects.create(sender=self.user, conversation=self.conversation, text='regrettable chapter')
+        message.delete()
+
+        url = reverse('search_messages')
+        response = self.client.get(url, {'q': 'regrettable'}, format='json')
+
+        self.assertEqual(response.data['messages'], [])
+
+class SyncTests(APITestCase):
+
+    def test_sync_without_cursor_returns_head(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        group = Group.objects.create(name='test group')
+        group.members.add(user)
+
+        url = reverse('sync')
+        response = self.client.get(url, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['cursor'], str(ChangeEvent.objects.latest('id').id))
+
+    def test_sync_returns_only_changes_after_cursor(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        other = User.objects.create(email="other@example.com", username="other_guy")
+        self.client.force_authenticate(user=user)
+        group = Group.objects.create(name='test group')
+        group.members.add(user)
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        Message.objects.create(sender=user, conversation=conversation, text='old message')
+
+        url = reverse('sync')
+        cursor = self.client.get(url, format='json').data['cursor']
+
+        Message.objects.create(sender=user, conversation=conversation, text='new message')
+        new_conversation = Conversation.objects.create(book_title='new conversation', group=group)
+        group.members.add(other)
+
+        response = self.client.get(url, {'since': cursor}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['text'] for m in response.data['messages']], ['new message'])
+        self.assertEqual([c['id'] for c in response.data['conversations']], [str(new_conversation.id)])
+        self.assertEqual(response.data['memberships'], [{'group': group.id, 'user': other.id, 'added': True}])
+        self.assertNotEqual(response.data['cursor'], cursor)
+
+        response = self.client.get(url, {'since': response.data['cursor']}, format='json')
+        self.assertEqual(response.data['messages'], [])
+
+    def test_sync_excludes_other_groups(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        other = User.objects.create(email="other@example.com", username="other_guy")
+        self.client.force_authenticate(user=user)
+        other_group = Group.objects.create(name='other group')
+        other_group.members.add(other)
+        conversation = Conversation.objects.create(book_title='test conversation', group=other_group)
+        Message.objects.create(sender=other, conversation=conversation, text='secret message')
+
+        url = reverse('sync')
+        response = self.client.get(url, {'since': 0}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['messages'], [])
+        self.assertEqual(response.data['conversations'], [])
+
+    def test_sync_reports_own_removal_and_profile_changes(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        friend = User.objects.create(email="friend@example.com", username="friend_guy")
+        user.friends.add(friend)
+        self.client.force_authenticate(user=user)
+        group = Group.objects.create(name='test group')
+        group.members.add(user)
+
+        url = reverse('sync')
+        cursor = self.client.get(url, format='json').data['cursor']
+
+        group.members.remove(user)
+        friend.username = 'renamed_guy'
+        friend.save()
+
+        response = self.client.get(url, {'since': cursor}, format='json')
+
+        self.assertEqual(response.data['memberships'], [{'group': group.id, 'user': user.id, 'added': False}])
+        self.assertEqual([u['username'] for u in response.data['users']], ['renamed_guy'])
+
+    def test_pruned_cursor_has_to_bootstrap_again(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        group = Group.objects.create(name='test group')
+        group.members.add(user)
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        url = reverse('sync')
+        cursor = self.client.get(url, format='json').data['cursor']
+        Message.objects.create(sender=user, conversation=conversation, text='old message')
+        Message.objects.create(sender=user, conversation=conversation, text='new message')
+        ChangeEvent.objects.update(created_at=timezone.now() - datetime.timedelta(days=60))
+
+        out = io.StringIO()
+        call_command('prune_change_events', stdout=out)
+
+        newest = ChangeEvent.objects.latest('id')
+        self.assertEqual(list(ChangeEvent.objects.all()), [newest])
+        self.assertIn('Deleted', out.getvalue())
+        response = self.client.get(url, {'since': cursor}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_410_GONE)
+        response = self.client.get(url, {'since': newest.id - 1}, format='json')
+        self.assertEqual([m['text'] for m in response.data['messages']], ['new message'])
+
+    def test_deleting_group_does_not_expire_cursors(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        old_group = Group.objects.create(name='old group')
+        old_group.members.add(user)
+        group = Group.objects.create(name='test group')
+        group.members.add(user)
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        Message.objects.create(sender=user, conversation=conversation, text='new message')
+
+        old_group.delete()
+
+        url = reverse('sync')
+        for cursor in (0, ChangeEvent.objects.earliest('id').id):
+            response = self.client.get(url, {'since': cursor}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual([m['text'] for m in response.data['messages']], ['new message'])
+
+    @override_settings(SYNC_SETTLE_SECONDS=60)
+    def test_sync_holds_back_unsettled_events(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        group = Group.objects.create(name='test group')
+        group.members.add(user)
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        ChangeEvent.objects.update(created_at=timezone.now() - datetime.timedelta(minutes=5))
+        url = reverse('sync')
+        cursor = self.client.get(url, format='json').data['cursor']
+        Message.objects.create(sender=user, conversation=conversation, text='new message')
+
+        response = self.client.get(url, {'since': cursor}, format='json')
+
+        self.assertEqual(response.data['messages'], [])
+        self.assertEqual(response.data['cursor'], cursor)
+
+    @override_settings(PICTURE_PROCESS_WORKERS=0, MEDIA_ROOT='media_test')
+    def test_picture_upload_records_one_profile_event(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        events = ChangeEvent.objects.filter(kind=ChangeEvent.PROFILE, user=user)
+        with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            with self.captureOnCommitCallbacks() as callbacks:
+                self.client.post(reverse('set_profile_picture'), {'picture': image_file}, format='multipart')
+        self.assertFalse(events.exists())
+        for callback in callbacks:
+            callback()
+
+        user.refresh_from_db()
+        self.assertTrue(user.picture_variants)
+        self.assertEqual(events.count(), 1)
+
+        shutil.rmtree('media_test/user_profiles', ignore_errors=True)
+
+    def test_sync_rejects_invalid_cursor(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        url = reverse('sync')
+        response = self.client.get(url, {'since': 'abc'}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class BootstrapTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.friend = User.objects.create(email="friend@example.com", username="friend")
+        self.user.friends.add(self.friend)
+        self.client.force_authenticate(user=self.user)
+
+    def add_group(self, name, members=2, conversations=2):
+        group = Group.objects.create(name=name)
+        group.members.add(self.user)
+        for i in range(members):
+            group.members.add(User.objects.create(email=f"{name}{i}@example.com", username=f"{name}_member{i}"))
+        for i in range(conversations):
+            conversation = Conversation.objects.create(book_title=f"{name} book {i}", group=group)
+            Message.objects.create(sender=self.friend, sender_username='friend', conversation=conversation, text='hi')
+        return group
+
+    def test_returns_home_screen_in_one_response(self):
+        group = self.add_group('book club')
+
+        response = self.client.get(reverse('bootstrap'), format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['users'][0]['username'], 'chondosha')
+        self.assertEqual([friend['username'] for friend in response.data['friends']], ['friend'])
+        self.assertEqual(response.data['cursor'], str(ChangeEvent.objects.latest('id').id))
+
+        groups = response.data['groups']
+        self.assertEqual(groups[0]['id'], str(group.id))
+        self.assertEqual(len(groups[0]['conversations']), 2)
+        self.assertIn('unread_count', groups[0]['conversations'][0])
+        self.assertCountEqual(
+            [member['username'] for member in groups[0]['members']],
+            ['chondosha', 'book club_member0', 'book club_member1']
+        )
+
+    def test_cursor_covers_changes_made_while_loading(self):
+        group = self.add_group('book club')
+        conversation = group.conversations.first()
+        serializer_class = views.GroupDetailSerializer
+
+        def serialize_after_a_message(*args, **kwargs):
+            Message.objects.create(sender=self.friend, conversation=conversation, text='sent meanwhile')
+            return serializer_class(*args, **kwargs)
+
+        with mock.patch('messageServer.views.GroupDetailSerializer', side_effect=serialize_after_a_message):
+            cursor = self.client.get(reverse('bootstrap'), format='json').data['cursor']
+        response = self.client.get(reverse('sync'), {'since': cursor}, format='json')
+
+        self.assertEqual([m['text'] for m in response.data['messages']], ['sent meanwhile'])
+
+    def test_query_count_does_not_grow_with_groups(self):
+        self.add_group('first')
+        with self.assertNumQueries(5):
+            self.client.get(reverse('bootstrap'), format='json')
+
+        for i in range(5):
+            self.add_group(f'group {i}', members=3, conversations=4)
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('bootstrap'), format='json')
+        self.assertEqual(len(response.data['groups']), 6)
+
+
+class ConditionalGetTests(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.other = User.objects.create(email="other@example.com", username="other_guy")
+        self.group = Group.objects.create(name='test group')
+        self.group.members.add(self.user)
+        self.conversation = Conversation.objects.create(book_title='test conversation', group=self.group)
+        self.client.force_authenticate(user=self.user)
+
+    def assertNotModified(self, url, etag):
+        # Only the version counter is read, no members and no serializer
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def assertModified(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_representations_have_their_own_etags(self):
+        url = reverse('get_member_list', args=[self.group.id])
+        json_etag = self.client.get(url, HTTP_ACCEPT='application/json')['ETag']
+        msgpack_etag = self.client.get(url, HTTP_ACCEPT='application/msgpack')['ETag']
+
+        self.assertNotEqual(json_etag, msgpack_etag)
+        response = self.client.get(url, HTTP_ACCEPT='application/msgpack', HTTP_IF_NONE_MATCH=json_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(url, HTTP_ACCEPT='application/msgpack', HTTP_IF_NONE_MATCH=msgpack_etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertIn('Accept', [header.strip() for header in response['Vary'].split(',')])
+
+    def test_member_list(self):
+        url = reverse('get_member_list', args=[self.group.id])
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+
+        self.group.members.add(self.other)
+        etag = self.assertModified(url, etag)
+
+        self.other.username = 'renamed_guy'
+        self.other.save()
+        etag = self.assertModified(url, etag)
+
+        self.other.fcm_registration_token = 'not shown'
+        self.other.save(update_fields=['fcm_registration_token'])
+        self.assertNotModified(url, etag)
+
+    def test_group(self):
+        url = reverse('get_group', args=[self.group.id])
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+
+        self.group.name = 'renamed group'
+        self.group.save()
+        self.assertModified(url, etag)
+
+    def test_conversation_list(self):
+        url = reverse('get_conversation_list', args=[self.group.id])
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+
+        self.client.force_authenticate(user=self.other)
+        data = {
+            'sender': self.other.id,
+            'sender_username': self.other.username,
+            'conversation': self.conversation.id,
+            'text': 'hello'
+        }
+        self.client.post(reverse('send_message'), data=data, format='json')
+        self.client.force_authenticate(user=self.user)
+        etag = self.assertModified(url, etag)
+
+        self.client.post(reverse('mark_conversation_read', args=[self.conversation.id]))
+        etag = self.assertModified(url, etag)
+
+        Conversation.objects.create(book_title='another conversation', group=self.group)
+        self.assertModified(url, etag)
+
+    def test_friends_list_and_current_user(self):
+        friends_url = reverse('get_friends_list')
+        user_url = reverse('get_current_user')
+        friends_etag = self.client.get(friends_url)['ETag']
+        user_etag = self.client.get(user_url)['ETag']
+        self.assertNotModified(friends_url, friends_etag)
+        self.assertNotModified(user_url, user_etag)
+
+        self.user.friends.add(self.other)
+        friends_etag = self.assertModified(friends_url, friends_etag)
+
+        self.other.username = 'renamed_guy'
+        self.other.save()
+        self.assertModified(friends_url, friends_etag)
+
+    @override_settings(MEDIA_ROOT='media_test', PICTURE_PROCESS_WORKERS=0)
+    def test_built_picture_variants_change_etags(self):
+        self.user.friends.add(self.other)
+        self.client.force_authenticate(user=self.other)
+        friends_url = reverse('get_friends_list')
+        friends_etag = self.client.get(friends_url)['ETag']
+        self.client.force_authenticate(user=self.user)
+        user_url = reverse('get_current_user')
+        member_url = reverse('get_member_list', args=[self.group.id])
+        group_url = reverse('get_group', args=[self.group.id])
+
+        with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            image_data = image_file.read()
+        with self.captureOnCommitCallbacks() as callbacks:
+            for url, data in [('set_profile_picture', {}), ('set_group_picture', {'groupId': self.group.id})]:
+                picture = SimpleUploadedFile('daffodil.jpg', image_data, content_type='image/jpeg')
+                response = self.client.post(reverse(url), {**data, 'picture': picture}, format='multipart')
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(user_url)
+        self.assertIsNotNone(response.data['users'][0]['picture_url'])
+        self.assertEqual(response.data['users'][0]['picture_urls'], {})
+        etags = {url: self.client.get(url)['ETag'] for url in (user_url, member_url, group_url)}
+
+        for callback in callbacks:
+            callback()
+
+        for url, etag in etags.items():
+            self.assertModified(url, etag)
+        # The forced user is this instance, from before the variants
+        self.user.refresh_from_db()
+        response = self.client.get(user_url, HTTP_IF_NONE_MATCH=etags[user_url])
+        self.assertIn('webp', response.data['users'][0]['picture_urls'])
+        self.assertIn('webp', self.client.get(group_url).data['groups'][0]['picture_urls'])
+        self.client.force_authenticate(user=self.other)
+        self.assertModified(friends_url, friends_etag)
+
+        shutil.rmtree('media_test/user_profiles', ignore_errors=True)
+        shutil.rmtree('media_test/group_pictures', ignore_errors=True)
+
+    def test_stale_instance_does_not_roll_back_version(self):
+        stale = Group.objects.get(id=self.group.id)
+        self.group.members.add(self.other)
+
+        stale.name = 'renamed group'
+        stale.save()
+
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.version, stale.version + 2)
+        self.assertEqual(self.group.name, 'renamed group')
+
 
 @override_settings(MEDIA_ROOT='media_test')
 class UserTests(APITestCase):
@@ -253,6 +874,72 @@ class UserTests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['users']), 2)
 
+    def test_search_ranks_exact_then_prefix_then_substring(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        User.objects.create(email="sub@example.com", username="the_other")
+        User.objects.create(email="prefix@example.com", username="other_guy")
+        User.objects.create(email="exact@example.com", username="other")
+
+        url = reverse('search_users', args=['other'])
+        response = self.client.get(url, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([u['username'] for u in response.data['users']], ['other', 'other_guy', 'the_other'])
+
+    def test_short_search_matches_prefix_in_any_case(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        User.objects.create(email="prefix@example.com", username="Other_guy")
+        User.objects.create(email="sub@example.com", username="the_other")
+
+        url = reverse('search_users', args=['oT'])
+        response = self.client.get(url, format='json')
+
+        self.assertEqual([u['username'] for u in response.data['users']], ['Other_guy'])
+
+    def test_search_boosts_friends(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        User.objects.create(email="a@example.com", username="other_a")
+        friend = User.objects.create(email="b@example.com", username="other_b")
+        user.friends.add(friend)
+
+        url = reverse('search_users', args=['other'])
+        response = self.client.get(url, format='json')
+
+        self.assertEqual([u['username'] for u in response.data['users']], ['other_b', 'other_a'])
+
+    def test_search_is_paginated(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        for i in range(5):
+            User.objects.create(email=f"other{i}@example.com", username=f"other{i}_guy")
+
+        url = reverse('search_users', args=['other'])
+        response = self.client.get(url, {'limit': 3}, format='json')
+
+        self.assertEqual(len(response.data['users']), 3)
+        self.assertEqual(response.data['next_offset'], 3)
+
+        response = self.client.get(url, {'limit': 3, 'offset': 3}, format='json')
+
+        self.assertEqual(len(response.data['users']), 2)
+        self.assertIsNone(response.data['next_offset'])
+
+    def test_search_finds_renamed_user(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        other = User.objects.create(email="other@example.com", username="other_guy")
+        other.username = 'renamed_guy'
+        other.save()
+
+        response = self.client.get(reverse('search_users', args=['other']), format='json')
+        self.assertEqual(response.data['users'], [])
+
+        response = self.client.get(reverse('search_users', args=['renamed']), format='json')
+        self.assertEqual(response.data['users'][0]['username'], 'renamed_guy')
+
     def test_set_profile_picture(self):
         user = User.objects.create(email="chondosha@example.com", username="chondosha")
         self.client.force_authenticate(user=user)
@@ -271,6 +958,121 @@ class UserTests(APITestCase):
 
         shutil.rmtree('media_test/user_pictures', ignore_errors=True)
 
+    def test_set_profile_picture_multipart(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        url = reverse('set_profile_picture')
+        with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            response = self.client.post(url, {'picture': image_file}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(response.data['users'][0]['picture_url'])
+
+        shutil.rmtree('media_test/user_profiles', ignore_errors=True)
+
+    @override_settings(PICTURE_PROCESS_WORKERS=0)
+    def test_set_profile_picture_builds_variants(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        url = reverse('set_profile_picture')
+        with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(url, {'picture': image_file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        uploaded_name = response.data['users'][0]['picture_url'].split('/media/')[-1]
+
+        user.refresh_from_db()
+        self.assertEqual(user.picture.name, uploaded_name)
+        with user.picture.storage.open(uploaded_name, 'rb') as picture_file, \
+                open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            self.assertNotEqual(picture_file.read(), image_file.read())
+        self.assertEqual(set(user.picture_variants), {'jpeg', 'webp'})
+        for sizes in user.picture_variants.values():
+            for name in sizes.values():
+                self.assertTrue(user.picture.storage.exists(name))
+
+        picture_urls = UserSerializer(user).data['picture_urls']
+        self.assertTrue(picture_urls['webp']['128'].endswith('_128.webp'))
+        self.assertTrue(picture_urls['jpeg']['48'].endswith('_48.jpg'))
+
+        shutil.rmtree('media_test/user_profiles', ignore_errors=True)
+
+    @override_settings(PICTURE_PROCESS_WORKERS=0)
+    def test_set_profile_picture_deletes_replaced_picture(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        url = reverse('set_profile_picture')
+        names = []
+        for _ in range(2):
+            with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.post(url, {'picture': image_file}, format='multipart')
+            user.refresh_from_db()
+            names.append((user.picture.name, [name for sizes in user.picture_variants.values() for name in sizes.values()]))
+
+        storage = user.picture.storage
+        (first, first_variants), (second, second_variants) = names
+        self.assertNotEqual(first, second)
+        self.assertFalse(storage.exists(first))
+        self.assertFalse(any(storage.exists(name) for name in first_variants))
+        self.assertTrue(storage.exists(second))
+        self.assertTrue(all(storage.exists(name) for name in second_variants))
+
+        shutil.rmtree('media_test/user_profiles', ignore_errors=True)
+
+    @override_settings(PICTURE_PROCESS_WORKERS=0)
+    def test_undecodable_picture_drops_previous_variants(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        url = reverse('set_profile_picture')
+        with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(url, {'picture': image_file}, format='multipart')
+        user.refresh_from_db()
+        previous = [name for sizes in user.picture_variants.values() for name in sizes.values()]
+
+        broken = SimpleUploadedFile('broken.jpg', b'\xff\xd8\xff' + b'not a jpeg', content_type='image/jpeg')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'picture': broken}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        user.refresh_from_db()
+        self.assertEqual(user.picture_variants, {})
+        self.assertFalse(any(user.picture.storage.exists(name) for name in previous))
+        self.assertEqual(ChangeEvent.objects.filter(kind=ChangeEvent.PROFILE, user=user).count(), 2)
+
+        shutil.rmtree('media_test/user_profiles', ignore_errors=True)
+
+    def test_set_profile_picture_rejects_non_image(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        url = reverse('set_profile_picture')
+        upload = SimpleUploadedFile('picture.jpg', b'not really a picture', content_type='image/jpeg')
+        response = self.client.post(url, {'picture': upload}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        user.refresh_from_db()
+        self.assertFalse(user.picture)
+
+    @override_settings(PICTURE_UPLOAD_MAX_BYTES=1024)
+    def test_set_profile_picture_rejects_large_picture(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+
+        url = reverse('set_profile_picture')
+        with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            response = self.client.post(url, {'picture': image_file}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            data = {'picture': base64.b64encode(image_file.read()).decode('utf-8')}
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
 
 class FriendsListTests(APITestCase):
 
@@ -472,6 +1274,22 @@ class GroupTests(APITestCase):
 
         shutil.rmtree('media_test/group_pictures', ignore_errors=True)
 
+    def test_set_group_picture_multipart(self):
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        self.client.force_authenticate(user=user)
+        group = Group.objects.create(name='test group')
+
+        url = reverse('set_group_picture')
+        with open('messageServer/tests/images/daffodil.jpg', 'rb') as image_file:
+            response = self.client.post(url, {'groupId': group.id, 'picture': image_file}, format='multipart')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['groups'][0]['name'], 'test group')
+        group.refresh_from_db()
+        self.assertTrue(group.picture)
+
+        shutil.rmtree('media_test/group_pictures', ignore_errors=True)
+
 
 @override_settings(MEDIA_ROOT='media_test')
 class ConversationTests(APITestCase):
@@ -524,6 +1342,105 @@ class ConversationTests(APITestCase):
         response_titles = [conversation['book_title'] for conversation in response.data['conversations']]
         self.assertCountEqual(response_titles, [conversation1.book_title, conversation2.book_title])
 
+    def send(self, user, conversation, text):
+        self.client.force_authenticate(user=user)
+        data = {
+            'sender': user.id,
+            'sender_username': user.username,
+            'conversation': conversation.id,
+            'text': text
+        }
+        response = self.client.post(reverse('send_message'), data=data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['messages'][0]
+
+    def test_conversation_list_has_summaries_and_unread_counts(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        other = User.objects.create(email="other@example.com", username="other_guy")
+        quiet = Conversation.objects.create(book_title='quiet conversation', group=group)
+        busy = Conversation.objects.create(book_title='busy conversation', group=group)
+        recent = Conversation.objects.create(book_title='recent conversation', group=group)
+
+        self.send(other, busy, 'first')
+        self.send(user, busy, 'my reply')
+        self.send(other, busy, 'x' * 200)
+        self.send(other, recent, 'newest')
+
+        self.client.force_authenticate(user=user)
+        url = reverse('get_conversation_list', args=[group.id])
+        # One for the ETag's version counters, one for the list
+        with self.assertNumQueries(2):
+            response = self.client.get(url, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        conversations = response.data['conversations']
+        self.assertEqual(
+            [conversation['id'] for conversation in conversations],
+            [str(recent.id), str(busy.id), str(quiet.id)]
+        )
+        self.assertEqual(conversations[1]['message_count'], 3)
+        self.assertEqual(conversations[1]['last_sender_username'], 'other_guy')
+        self.assertEqual(conversations[1]['last_message_preview'], 'x' * 140)
+        # Sending marks the sender's own conversation read
+        self.assertEqual(conversations[1]['unread_count'], 1)
+        self.assertEqual(conversations[0]['unread_count'], 1)
+        self.assertEqual(conversations[2]['unread_count'], 0)
+        self.assertIsNone(conversations[2]['last_message_at'])
+
+    def test_mark_conversation_read(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        other = User.objects.create(email="other@example.com", username="other_guy")
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        first = self.send(other, conversation, 'first')
+        self.send(other, conversation, 'second')
+        self.send(other, conversation, 'third')
+
+        self.client.force_authenticate(user=user)
+        url = reverse('mark_conversation_read', args=[conversation.id])
+        response = self.client.post(url, {'messageId': first['id']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['conversations'][0]['unread_count'], 2)
+
+        response = self.client.post(url, format='json')
+        self.assertEqual(response.data['conversations'][0]['unread_count'], 0)
+
+        # Marking an earlier message doesn't move the marker back
+        response = self.client.post(url, {'messageId': first['id']}, format='json')
+        self.assertEqual(response.data['conversations'][0]['unread_count'], 0)
+
+    def test_batch_send_updates_summaries(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        self.client.force_authenticate(user=user)
+
+        messages = [
+            {'sender': user.id, 'sender_username': user.username, 'conversation': conversation.id, 'text': text}
+            for text in ['one', 'two', 'three']
+        ]
+        response = self.client.post(reverse('send_message_batch'), {'messages': messages}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.message_count, 3)
+        self.assertEqual(conversation.last_message_preview, 'three')
+
+    def test_rebuild_conversation_summaries(self):
+        group = Group.objects.create(name='test group')
+        user = User.objects.create(email="chondosha@example.com", username="chondosha")
+        conversation = Conversation.objects.create(book_title='test conversation', group=group)
+        Message.objects.create(sender=user, sender_username='chondosha', conversation=conversation, text='older')
+        Message.objects.create(sender=user, sender_username='chondosha', conversation=conversation, text='latest')
+
+        call_command('rebuild_conversation_summaries', stdout=io.StringIO())
+
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.message_count, 2)
+        self.assertEqual(conversation.last_message_preview, 'latest')
+        self.assertEqual(conversation.last_sender_username, 'chondosha')
+
     def test_set_conversation_picture(self):
         user = User.objects.create(email="chondosha@example.com", username="chondosha")
         self.client.force_authenticate(user=user)
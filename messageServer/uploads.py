@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadhandler import FileUploadHandler
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError
+from rest_framework.parsers import MultiPartParser
+import base64
+import binascii
+
+# Leading bytes of each picture format we accept
+PICTURE_SIGNATURES = [
+    ('image/jpeg', b'\xff\xd8\xff'),
+    ('image/png', b'\x89PNG\r\n\x1a\n'),
+    ('image/gif', b'GIF8'),
+    ('image/webp', b'RIFF'),
+]
+
+# Room for the multipart boundaries and the other form fields
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+class PictureTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Picture is too large'
+    default_code = 'picture_too_large'
+
+
+class UnsupportedPicture(APIException):
+    status_code = status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+    default_detail = 'Picture must be a JPEG, PNG, GIF or WebP image'
+    default_code = 'unsupported_picture'
+
+
+def max_picture_bytes():
+    return getattr(settings, 'PICTURE_UPLOAD_MAX_BYTES', 10 * 1024 * 1024)
+
+
+def sniff_picture_type(head):
+    for content_type, signature in PICTURE_SIGNATURES:
+        if head.startswith(signature):
+            if content_type == 'image/webp' and head[8:12] != b'WEBP':
+                continue
+            return content_type
+    return None
+
+
+class PictureUploadHandler(FileUploadHandler):
+    """
+    Checks each uploaded file as it streams in, before the next handler
+    writes it out: the declared type, the real type from the first chunk,
+    and the running size.  Anything wrong stops the upload right there.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        if not self.content_type.startswith('image/'):
+            raise UnsupportedPicture()
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        if start == 0 and sniff_picture_type(raw_data) is None:
+            raise UnsupportedPicture()
+        self.received += len(raw_data)
+        if self.received > max_picture_bytes():
+            raise PictureTooLarge()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+class PictureMultiPartParser(MultiPartParser):
+    """
+    Multipart parser for picture uploads.  Rejects oversized bodies from
+    Content-Length before reading anything, then streams the file through
+    PictureUploadHandler to the usual upload handlers, which spool large
+    files to disk instead of memory.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = parser_context['request']
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise ParseError('Invalid Content-Length')
+        if content_length > max_picture_bytes() + MULTIPART_OVERHEAD_BYTES:
+            raise PictureTooLarge()
+
+        handlers = request.upload_handlers
+        if not any(isinstance(handler, PictureUploadHandler) for handler in handlers):
+            handlers.insert(0, PictureUploadHandler())
+        return super().parse(stream, media_type, parser_context)
+
+
+def picture_from_request(request):
+    """
+    The uploaded picture as a file, either a multipart part named picture,
+    raw bytes in a MessagePack body or the older base64 string in a JSON
+    body.  Returns None if there is none.
+    """
+    uploaded = request.FILES.get('picture')
+    if uploaded is not None:
+        return uploaded
+
+    base64_image = request.data.get('picture')
+    if not base64_image:
+        return None
+    if isinstance(base64_image, bytes):
+        # MessagePack bodies carry the picture as raw bytes
+        if len(base64_image) > max_picture_bytes():
+            raise PictureTooLarge()
+        if sniff_picture_type(base64_image[:16]) is None:
+            raise UnsupportedPicture()
+        return ContentFile(base64_image)
+
+    image_data = base64_image.split(';base64,')[-1]
+    # Decoded size is three quarters of the encoded length, so check it
+    # before allocating anything
+    if len(image_data) * 3 // 4 > max_picture_bytes():
+        raise PictureTooLarge()
+    try:
+        decoded = base64.b64decode(image_data)
+    except (binascii.Error, ValueError):
+        raise ParseError('Picture is not valid base64')
+    if sniff_picture_type(decoded[:16]) is None:
+        raise UnsupportedPicture()
+    return ContentFile(decoded)
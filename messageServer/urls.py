@@ -5,7 +5,13 @@ from messageServer.views import CreateUserView, LoginView, LogoutView
 
 urlpatterns = [
     path('messages/send', views.send_message, name='send_message'),
+    path('messages/send_batch', views.send_message_batch, name='send_message_batch'),
+    path('messages/search', views.search_messages, name='search_messages'),
     path('messages/<uuid:conversation_id>', views.get_messages, name='get_messages'),
+    path('sync', views.sync, name='sync'),
+    path('bootstrap', views.bootstrap, name='bootstrap'),
+    path('events', views.events, name='events'),
+    path('metrics', views.metrics, name='metrics'),
     path('groups/create', views.create_group, name='create_group'),
     path('groups/<uuid:group_id>/get_group', views.get_group, name='get_group'),
     path('groups/<uuid:group_id>/get_member_list', views.get_member_list, name='get_member_list'),
@@ -15,6 +21,7 @@ urlpatterns = [
     path('groups/create_conversation', views.create_conversation, name='create_conversation'),
     path('groups/<uuid:group_id>/conversations', views.get_conversation_list, name='get_conversation_list'),
     path('groups/conversation/<uuid:conversation_id>', views.get_conversation, name='get_conversation'),
+    path('groups/conversation/<uuid:conversation_id>/read', views.mark_conversation_read, name='mark_conversation_read'),
     path('groups/conversation/set_picture', views.set_conversation_picture, name='set_conversation_picture'),
     path('users/groups', views.get_group_list, name='get_group_list'),
     path('users/<uuid:user_id>/add_friend', views.add_friend, name='add_friend'),
@@ -0,0 +1,111 @@
+"""
+Version counters behind the ETags of the polled GET views.  Every counter
+only ever moves up through an F() update, so an ETag seen once never comes
+back for different content, and checking one costs a single indexed read.
+Each ETag also names the format the response is rendered in, as the JSON
+and MessagePack bodies of one version differ.
+"""
+from django.contrib.auth import get_user_model
+from django.db.models import F, Subquery
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
+from .models import PROFILE_FIELDS, Conversation, Group
+import functools
+
+User = get_user_model()
+
+
+def bump(queryset, field='version'):
+    queryset.update(**{field: F(field) + 1})
+
+
+@receiver(post_save, sender=Group)
+def bump_group_version(sender, instance=None, created=False, **kwargs):
+    if not created:
+        bump(Group.objects.filter(pk=instance.pk))
+
+
+@receiver(post_save, sender=Conversation)
+def bump_conversation_version(sender, instance=None, created=False, **kwargs):
+    if not created:
+        bump(Conversation.objects.filter(pk=instance.pk))
+    bump(Group.objects.filter(pk=instance.group_id), 'conversations_version')
+
+
+@receiver(post_save, sender=User)
+def bump_profile_versions(sender, instance=None, created=False, update_fields=None, **kwargs):
+    # A profile shows up in the user's own payloads, the member lists of
+    # their groups and their friends' friend lists
+    if created:
+        return
+    if update_fields is not None and not PROFILE_FIELDS.intersection(update_fields):
+        return
+    bump(User.objects.filter(pk=instance.pk))
+    bump(Group.objects.filter(members=instance))
+    bump(User.objects.filter(friends=instance))
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def bump_membership_versions(sender, instance=None, action=None, reverse=False, pk_set=None, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        bump(Group.objects.filter(pk=instance.pk))
+    elif action == 'pre_clear':
+        bump(Group.objects.filter(members=instance))
+    elif pk_set:
+        bump(Group.objects.filter(pk__in=pk_set))
+
+
+@receiver(m2m_changed, sender=User.friends.through)
+def bump_friend_versions(sender, instance=None, action=None, pk_set=None, **kwargs):
+    # Friendship is symmetrical, so both ends' lists change
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    bump(User.objects.filter(pk=instance.pk))
+    if action == 'pre_clear':
+        bump(User.objects.filter(friends=instance))
+    elif pk_set:
+        bump(User.objects.filter(pk__in=pk_set))
+
+
+def negotiated(etag_func):
+    """
+    etag_func with the negotiated format added to its tag
+    """
+    @functools.wraps(etag_func)
+    def wrapper(request, *args, **kwargs):
+        tag = etag_func(request, *args, **kwargs)
+        renderer = getattr(request, 'accepted_renderer', None)
+        if tag is None or renderer is None:
+            return tag
+        return f"{tag}.{renderer.format}"
+    return wrapper
+
+
+@negotiated
+def group_etag(request, group_id):
+    version = Group.objects.filter(pk=group_id).values_list('version', flat=True).first()
+    return None if version is None else f"g{version}"
+
+
+@negotiated
+def conversation_etag(request, conversation_id):
+    version = Conversation.objects.filter(pk=conversation_id).values_list('version', flat=True).first()
+    return None if version is None else f"c{version}"
+
+
+@negotiated
+def conversation_list_etag(request, group_id):
+    # Unread counts are per user, so the reader's markers are part of it
+    read_version = User.objects.filter(pk=request.user.pk).values('read_version')
+    versions = Group.objects.filter(pk=group_id).annotate(
+        read_version=Subquery(read_version)
+    ).values_list('conversations_version', 'read_version').first()
+    return None if versions is None else "l{}.{}".format(*versions)
+
+
+@negotiated
+def user_etag(request, *args, **kwargs):
+    version = User.objects.filter(pk=request.user.pk).values_list('version', flat=True).first()
+    return None if version is None else f"u{version}"
@@ -1,23 +1,48 @@
 from rest_framework import generics, status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, parser_classes, permission_classes
+from rest_framework.parsers import JSONParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.exceptions import ValidationError
 from rest_framework.authtoken.models import Token
-from .models import Message, Group, Conversation
-from .serializers import MessageSerializer, GroupSerializer, ConversationSerializer, UserSerializer, LoginSerializer, TokenSerializer
+from .models import Message, Group, Conversation, ChangeEvent, record_events
+from .serializers import MessageSerializer, GroupSerializer, GroupDetailSerializer, ConversationSerializer, UserSerializer, LoginSerializer, TokenSerializer
+from .serializers import message_rows, message_values, user_rows, user_values, uuids_in
+from .pagination import InvalidCursor, keyset_page, page_cursors, parse_limit
+from .sync import CursorExpired, changes_since, head_cursor, parse_sync_cursor
+from .notifications import enqueue_batch_notification, enqueue_message_notification
+from .pictures import replace_picture
+from .versions import conversation_etag, conversation_list_etag, group_etag, user_etag
+from .summaries import conversations_by_activity, conversations_with_unread, mark_read, record_conversation_activity
+from .parsers import MessagePackParser
+from .uploads import PictureMultiPartParser, picture_from_request
+from .search import find_users, index_messages, matching_messages, message_snippets, parse_search_page
+from .realtime import sse_stream
+from .replicas import read_from_replica
+from .archive import page_with_archive
+from .shards import atomic_for
+from .metrics import collect, render
+from .authentication import issue_signed_token, revoke_signed_tokens, user_for_token
+from .compression import compression_exempt
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
 from django.contrib.auth import authenticate, login, logout
-from django.core.files.base import ContentFile
-from firebase_admin import messaging
-import base64
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Prefetch
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import etag
+import hmac
 import logging
 
 User = get_user_model()
 
 logger = logging.getLogger('django')
 
+MAX_BATCH_MESSAGES = 100
+
 """
 API views related to messages
 """
@@ -38,24 +63,12 @@ def send_message(request):
 
     serializer = MessageSerializer(data=request.data)
     if serializer.is_valid():
-        serializer.save()
-
-        #Send FCM notifications to all members of group
-        conversation_id = request.data.get('conversation')
-        conversation = Conversation.objects.get(id=conversation_id)
-        members = conversation.group.members.all()
-        registration_tokens = [member.fcm_registration_token for member in members if member.fcm_registration_token]
-
-        title = "New Message(s)"
-        body = f"You have new messages!"
-        message = messaging.MulticastMessage(
-            notification=messaging.Notification(
-                title=title,
-                body=body
-            ),
-            tokens=registration_tokens
-        )
-        messaging.send_multicast(message)
+        #Queue FCM notifications to all members of group, sent by the dispatcher after commit
+        with atomic_for([serializer.validated_data['conversation'].id]):
+            message = serializer.save()
+            record_conversation_activity([message])
+            mark_read(message.sender_id, message.conversation_id)
+            enqueue_message_notification(message.conversation)
 
         response_data = {
             'messages': [serializer.data]
@@ -64,17 +77,230 @@ def send_message(request):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def send_message_batch(request):
+    """
+    Save a queue of messages, possibly for several conversations, with one
+    insert and one push per recipient.  Used by clients flushing messages
+    written while offline.
+    """
+    items = request.data.get('messages')
+    if not isinstance(items, list) or not items:
+        return Response({'error': 'Provide a list of messages'}, status=status.HTTP_400_BAD_REQUEST)
+    if len(items) > MAX_BATCH_MESSAGES:
+        return Response({'error': f'At most {MAX_BATCH_MESSAGES} messages per batch'}, status=status.HTTP_400_BAD_REQUEST)
+
+    # Senders and conversations repeat across the batch, load each once
+    # instead of once per message
+    prefetched = {
+        User: User.objects.in_bulk(uuids_in(item.get('sender') for item in items if isinstance(item, dict))),
+        Conversation: Conversation.objects.in_bulk(
+            uuids_in(item.get('conversation') for item in items if isinstance(item, dict))
+        ),
+    }
+    serializer = MessageSerializer(data=items, many=True, context={'prefetched': prefetched})
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    messages = [Message(**item) for item in serializer.validated_data]
+    conversations = {message.conversation.id: message.conversation for message in messages}
+    with atomic_for(conversations):
+        # bulk_create skips post_save, so record the change events and
+        # update the search index here
+        Message.objects.bulk_create(messages)
+        record_events([
+            ChangeEvent(
+                kind=ChangeEvent.MESSAGE,
+                group_id=message.conversation.group_id,
+                user_id=message.sender_id,
+                object_id=message.id
+            )
+            for message in messages
+        ])
+        index_messages(messages)
+        record_conversation_activity(messages)
+        for sender_id, conversation_id in {(message.sender_id, message.conversation_id) for message in messages}:
+            mark_read(sender_id, conversation_id)
+        enqueue_batch_notification(conversations.values())
+
+    response_data = {
+        'messages': MessageSerializer(messages, many=True).data
+    }
+    return Response(response_data, status=status.HTTP_201_CREATED)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_from_replica
 def get_messages(request, conversation_id):
-    messages = Message.objects.filter(conversation=conversation_id).order_by('-created_at')
-    serializer = MessageSerializer(messages, many=True)
+    before = request.query_params.get('before') or None
+    after = request.query_params.get('after') or None
+    if before and after:
+        return Response({'error': 'Use only one of before or after'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        limit = parse_limit(request.query_params.get('limit'))
+    except ValueError:
+        return Response({'error': 'Invalid limit'}, status=status.HTTP_400_BAD_REQUEST)
+
+    messages = message_values(Message.objects.filter(conversation=conversation_id))
+    try:
+        page, has_more = page_with_archive(conversation_id, messages, limit, before=before, after=after)
+    except InvalidCursor:
+        return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+    response_data = {
+        'messages': message_rows(page),
+        **page_cursors(page, has_more, after=after)
+    }
+    return Response(response_data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@read_from_replica
+def search_messages(request):
+    """
+    Messages containing every word of q in the user's groups, optionally
+    narrowed to one group or conversation, newest first with a highlighted
+    snippet and the same cursors as get_messages.  The snippet is escaped
+    HTML with matches in <mark> tags.
+    """
+    query = request.query_params.get('q', '').strip()
+    if not query:
+        return Response({'error': 'Please provide a valid search query'}, status=status.HTTP_400_BAD_REQUEST)
+
+    group_ids = list(request.user.groups.values_list('id', flat=True))
+    conversation_id = request.query_params.get('conversation') or None
+    group_id = request.query_params.get('group') or None
+    try:
+        if conversation_id is not None:
+            conversation = Conversation.objects.only('id', 'group_id').get(id=conversation_id)
+            if conversation.group_id not in group_ids:
+                raise Conversation.DoesNotExist
+            conversation_id = conversation.id
+        if group_id is not None:
+            group_ids = [g for g in group_ids if str(g) == group_id]
+            if not group_ids:
+                return Response({'error': 'Group does not exist'}, status=status.HTTP_404_NOT_FOUND)
+    except (Conversation.DoesNotExist, DjangoValidationError):
+        return Response({'error': 'Conversation does not exist'}, status=status.HTTP_404_NOT_FOUND)
+
+    before = request.query_params.get('before') or None
+    after = request.query_params.get('after') or None
+    if before and after:
+        return Response({'error': 'Use only one of before or after'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        limit = parse_limit(request.query_params.get('limit'))
+    except ValueError:
+        return Response({'error': 'Invalid limit'}, status=status.HTTP_400_BAD_REQUEST)
+
+    messages = matching_messages(query, group_ids, conversation_id)
+    try:
+        page, has_more = keyset_page(messages, limit, before=before, after=after)
+    except InvalidCursor:
+        return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+    snippets = message_snippets(query, page)
+    results = MessageSerializer(page, many=True).data
+    for item, message in zip(results, page):
+        item['snippet'] = snippets[message.id]
     response_data = {
-        'messages': serializer.data
+        'messages': results,
+        **page_cursors(page, has_more, after=after)
     }
     return Response(response_data, status=status.HTTP_200_OK)
 
 
+"""
+API views related to sync
+"""
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@read_from_replica
+def sync(request):
+    """
+    Everything visible to the user that changed after the since cursor.  With
+    no since the current cursor is returned on its own so a freshly loaded
+    client can start syncing from now.  A cursor older than the event log
+    gets 410, and the client has to bootstrap again.
+    """
+    since = request.query_params.get('since')
+    if not since:
+        return Response({'cursor': str(head_cursor()), 'has_more': False}, status=status.HTTP_200_OK)
+
+    try:
+        since = parse_sync_cursor(since)
+    except ValueError:
+        return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        response_data = changes_since(request.user, since)
+    except CursorExpired:
+        return Response({'error': 'Cursor expired, bootstrap again'}, status=status.HTTP_410_GONE)
+    return Response(response_data, status=status.HTTP_200_OK)
+
+
+"""
+Server-sent events
+"""
+
+async def events(request):
+    """
+    Live message, conversation and membership events as a text/event-stream.
+    Async so idle streams don't each hold a worker.  Browsers' EventSource
+    can't set headers, so the token may also come as ?token=.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Method not allowed'}, status=405)
+
+    keyword, _, key = request.headers.get('Authorization', '').partition(' ')
+    if keyword != 'Token' or not key:
+        key = request.GET.get('token')
+    user = await sync_to_async(user_for_token)(key.strip()) if key else None
+    if user is None:
+        return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id') or 0
+    try:
+        last_event_id = parse_sync_cursor(last_event_id)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid Last-Event-ID'}, status=400)
+
+    response = StreamingHttpResponse(sse_stream(user, last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+"""
+Metrics
+"""
+
+def metrics(request):
+    """
+    Request metrics of every worker in the Prometheus text format.  Needs
+    METRICS_TOKEN as a bearer token when one is set, and is only served in
+    DEBUG otherwise.  Behind nginx every request comes from the local
+    socket, so the caller's address can't stand in for the token.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': 'Method not allowed'}, status=405)
+
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        keyword, _, key = request.headers.get('Authorization', '').partition(' ')
+        if keyword != 'Bearer' or not hmac.compare_digest(key.strip().encode(), token.encode()):
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    elif not settings.DEBUG:
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+
+    return HttpResponse(render(collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 """
 API views related to Groups
 """
@@ -96,6 +322,8 @@ def create_group(request):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_from_replica
+@etag(group_etag)
 def get_group(request, group_id):
     try:
         group = Group.objects.get(id=group_id)
@@ -110,6 +338,7 @@ def get_group(request, group_id):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_from_replica
 def get_group_list(request):
     try:
         user = request.user
@@ -125,22 +354,24 @@ def get_group_list(request):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_from_replica
+@etag(group_etag)
 def get_member_list(request, group_id):
     try:
         group = Group.objects.get(id=group_id)
     except Group.DoesnotExist:
         return Response({'error': 'Group does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
-    members = group.members.all()
-    serializer = UserSerializer(members, many=True)
+    members = user_values(group.members.all())
     response_data = {
-        'users': serializer.data
+        'users': user_rows(members)
     }
     return Response(response_data, status=status.HTTP_200_OK)
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@parser_classes([PictureMultiPartParser, JSONParser, MessagePackParser])
 def set_group_picture(request):
     try:
         group_id = request.data.get('groupId')
@@ -148,14 +379,12 @@ def set_group_picture(request):
     except Group.DoesNotExist:
         return Response({'error': 'Group does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
-    base64_image = request.data.get('picture')
-
-    image_data = base64_image.split(';base64,')[-1]
-    image_file = ContentFile(base64.b64decode(image_data))
+    image_file = picture_from_request(request)
+    if image_file is None:
+        return Response({'error': 'No picture provided'}, status=status.HTTP_400_BAD_REQUEST)
     filename = f"group_{group_id}.jpg"
 
-    group.picture.save(filename, image_file)
-    group.save()
+    replace_picture(group, filename, image_file)
     serializer = GroupSerializer(group)
     response_data = {
         'groups': [serializer.data]
@@ -176,7 +405,7 @@ def add_member(request, group_id, user_id):
     except User.DoesNotExist:
         return Response({'error': 'User does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
-    if member not in group.members.all():
+    if not group.members.filter(pk=member.pk).exists():
         group.members.add(member)
         serializer = GroupSerializer(group)
         response_data = {
@@ -200,7 +429,7 @@ def remove_member(request, group_id, user_id):
     except User.DoesNotExist:
         return Response({'error': 'User does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
-    if member in group.members.all():
+    if group.members.filter(pk=member.pk).exists():
         group.members.remove(member)
         serializer = GroupSerializer(group)
         response_data = {
@@ -230,6 +459,8 @@ def create_conversation(request):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_from_replica
+@etag(conversation_etag)
 def get_conversation(request, conversation_id):
     try:
         conversation = Conversation.objects.get(id=conversation_id)
@@ -244,13 +475,13 @@ def get_conversation(request, conversation_id):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_from_replica
+@etag(conversation_list_etag)
 def get_conversation_list(request, group_id):
-    try:
-        group = Group.objects.get(id=group_id)
-    except Group.DoesNotExist:
+    conversations = list(conversations_by_activity(group_id, request.user))
+    if not conversations and not Group.objects.filter(id=group_id).exists():
         return Response({'error': 'Group does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
-    conversations = group.conversations.all()
     serializer = ConversationSerializer(conversations, many=True)
     response_data = {
         'conversations': serializer.data
@@ -260,6 +491,35 @@ def get_conversation_list(request, group_id):
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+def mark_conversation_read(request, conversation_id):
+    """
+    Mark the conversation read up to messageId, or all of it
+    """
+    try:
+        conversation = Conversation.objects.get(id=conversation_id)
+    except Conversation.DoesNotExist:
+        return Response({'error': 'Conversation does not exist'}, status=status.HTTP_404_NOT_FOUND)
+
+    message = None
+    message_id = request.data.get('messageId')
+    if message_id:
+        try:
+            message = Message.objects.get(id=message_id, conversation=conversation)
+        except (Message.DoesNotExist, DjangoValidationError):
+            return Response({'error': 'Message does not exist'}, status=status.HTTP_404_NOT_FOUND)
+
+    mark_read(request.user.id, conversation.id, message)
+    conversation = conversations_by_activity(conversation.group_id, request.user).get(id=conversation.id)
+    serializer = ConversationSerializer(conversation)
+    response_data = {
+        'conversations': [serializer.data]
+    }
+    return Response(response_data, status=status.HTTP_200_OK)
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+@parser_classes([PictureMultiPartParser, JSONParser, MessagePackParser])
 def set_conversation_picture(request):
     try:
         conversation_id = request.data.get('conversationId')
@@ -267,14 +527,12 @@ def set_conversation_picture(request):
     except Conversation.DoesNotExist:
         return Response({'error': 'Conversation does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
-    base64_image = request.data.get('picture')
-
-    image_data = base64_image.split(';base64,')[-1]
-    image_file = ContentFile(base64.b64decode(image_data))
+    image_file = picture_from_request(request)
+    if image_file is None:
+        return Response({'error': 'No picture provided'}, status=status.HTTP_400_BAD_REQUEST)
     filename = f"conversation_{conversation_id}.jpg"
 
-    conversation.picture.save(filename, image_file)
-    conversation.save()
+    replace_picture(conversation, filename, image_file)
     serializer = ConversationSerializer(conversation)
     response_data = {
         'conversations': [serializer.data]
@@ -323,14 +581,15 @@ def remove_friend(request, user_id):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_from_replica
+@etag(user_etag)
 def get_friends_list(request):
     user = request.user
-    friends = user.friends.all()
+    friends = user_values(user.friends.all())
 
     if friends is not None:
-        serializer = UserSerializer(friends, many=True)
         response_data = {
-            'users': serializer.data
+            'users': user_rows(friends)
         }
         return Response(response_data, status=status.HTTP_200_OK)
     else:
@@ -347,7 +606,7 @@ class CreateUserView(generics.CreateAPIView):
             user = User.objects.get(id=response.data['id'])
             password = request.data.get('password')
             user.set_password(password)
-            user.save()
+            user.save(update_fields=['password'])
             serializer = self.get_serializer(user)
             response_data = {
                 'users': [serializer.data]
@@ -371,16 +630,23 @@ def get_user(request, user_id):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@read_from_replica
 def search_users(request, query):
     #query = request.GET.get('query')
 
     if not query or len(query) < 1:
         return Response({'error': 'Please provide a valid search query'}, status=status.HTTP_400_BAD_REQUEST)
 
-    users = User.objects.filter(username__icontains=query).exclude(id=request.user.id)
+    try:
+        limit, offset = parse_search_page(request.query_params.get('limit'), request.query_params.get('offset'))
+    except ValueError:
+        return Response({'error': 'Invalid limit or offset'}, status=status.HTTP_400_BAD_REQUEST)
+
+    users, has_more = find_users(query, request.user, limit, offset)
     serializer = UserSerializer(users, many=True)
     response_data = {
-        'users': serializer.data
+        'users': serializer.data,
+        'next_offset': offset + limit if has_more else None
     }
 
     return Response(response_data, status=status.HTTP_200_OK)
@@ -388,6 +654,7 @@ def search_users(request, query):
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@etag(user_etag)
 def get_current_user(request):
     user = request.user
     if user:
@@ -400,20 +667,49 @@ def get_current_user(request):
         return Response({'error': 'User does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+@read_from_replica
+def bootstrap(request):
+    """
+    Everything the home screen needs at launch in one response: the current
+    user, their friends, and each group with its conversations and members.
+    The query count is the same however many groups there are.  cursor is
+    where sync and the event streams should pick up from.
+    """
+    # Read first, so whatever commits while the rest is read comes again
+    # through sync rather than being skipped
+    cursor = str(head_cursor())
+    user = request.user
+    user_fields = ['id', 'email', 'username', 'picture', 'picture_variants']
+    groups = Group.objects.filter(members=user).only('id', 'name', 'picture', 'picture_variants').prefetch_related(
+        Prefetch('conversations', queryset=conversations_with_unread(user)),
+        Prefetch('members', queryset=User.objects.only(*user_fields).order_by('username'))
+    ).order_by('name')
+    friends = user.friends.only(*user_fields).order_by('username')
+
+    response_data = {
+        'users': [UserSerializer(user).data],
+        'friends': UserSerializer(friends, many=True).data,
+        'groups': GroupDetailSerializer(groups, many=True).data,
+        'cursor': cursor
+    }
+    return Response(response_data, status=status.HTTP_200_OK)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@parser_classes([PictureMultiPartParser, JSONParser, MessagePackParser])
 def set_profile_picture(request):
     user = request.user
 
-    base64_image = request.data.get('picture')
-
-    image_data = base64_image.split(';base64,')[-1]
-    image_file = ContentFile(base64.b64decode(image_data))
+    image_file = picture_from_request(request)
+    if image_file is None:
+        return Response({'error': 'No picture provided'}, status=status.HTTP_400_BAD_REQUEST)
     filename = f"user_{user.id}.jpg"
 
     try:
-        user.picture.save(filename, image_file)
-        user.save()
+        replace_picture(user, filename, image_file)
         serializer = UserSerializer(user)
         response_data = {
             'users': [serializer.data]
@@ -431,7 +727,7 @@ def set_fcm_token(request):
     #logger.info(f"fcm token: {token}")
     try:
         user.fcm_registration_token = token
-        user.save()
+        user.save(update_fields=['fcm_registration_token'])
         serializer = UserSerializer(user)
         response_data = {
             'users': [serializer.data]
@@ -443,6 +739,7 @@ def set_fcm_token(request):
 
 
 
+@method_decorator(compression_exempt, name='dispatch')
 class LoginView(APIView):
     authentication_classes = []
 
@@ -456,6 +753,12 @@ class LoginView(APIView):
         user = authenticate(username=username, password=password)
         if user is not None:
             login(request, user)
+            if request.data.get('token_type') == 'signed':
+                key, expires_at = issue_signed_token(user)
+                response_data = {
+                    'token': {'key': key, 'expires_at': expires_at}
+                }
+                return Response(response_data, status=status.HTTP_200_OK)
             token = Token.objects.get(user=user)
             token_serializer = TokenSerializer(token)
             #user_serializer = UserSerializer(user)
@@ -472,5 +775,6 @@ class LogoutView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
+        revoke_signed_tokens(request.user)
         logout(request)
         return Response({'detail': 'Logged out successfully'})